@@ -0,0 +1,7 @@
+"""Benchmarks of the OpenID library.
+
+Benchmarks are not part of the distributed package. Run them from the root of the repository, e.g.::
+
+    python -m benchmarks.signing
+"""
+from __future__ import unicode_literals
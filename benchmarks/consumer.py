@@ -0,0 +1,268 @@
+"""End-to-end benchmark of the OpenID consumer.
+
+Drives complete logins through L{Consumer.begin}, L{AuthRequest.redirectURL} and L{Consumer.complete} against
+an in-process OpenID provider built on L{Server}. The consumer reaches the provider and the identity pages through
+a local fetcher, so no network is involved. Reports the number of logins per second, latency percentiles of each phase
+and memory allocated in each phase.
+
+Example::
+
+    python -m benchmarks.consumer --scenario smart --format json > results.json
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import sys
+import timeit
+from collections import OrderedDict
+
+from six.moves.urllib.parse import parse_qsl, urlsplit
+
+from openid import fetchers
+from openid.consumer.consumer import SUCCESS, Consumer
+from openid.consumer.discover import OPENID_2_0_TYPE, OPENID_IDP_2_0_TYPE, DiscoveryCache, setDefaultDiscoveryCache
+from openid.fetchers import HTTPFetcher, HTTPResponse
+from openid.server.server import Server
+from openid.store.memstore import MemoryStore
+from openid.yadis.constants import YADIS_CONTENT_TYPE
+
+from .server import percentile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+OP_IDENTIFIER = 'http://op.example.com/'
+REALM = 'http://rp.example.com/'
+RETURN_TO = REALM + 'complete'
+IDENTITY = 'http://user.example.com/'
+
+XRDS = '''<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+<XRD><Service priority="0"><Type>%s</Type><URI>%s</URI></Service></XRD>
+</xrds:XRDS>'''
+
+PHASES = ('begin', 'redirect', 'provider', 'complete')
+
+
+class LocalFetcher(HTTPFetcher):
+    """Fetcher which serves the identity pages and passes direct requests to the provider.
+
+    @ivar server: The OpenID provider.
+    @type server: L{Server}
+    @ivar documents: Bodies and content types of the pages by their URLs.
+    @type documents: Dict[six.text_type, Tuple[six.text_type, six.binary_type]]
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.documents = {
+            IDENTITY: (YADIS_CONTENT_TYPE, (XRDS % (OPENID_2_0_TYPE, OP_ENDPOINT)).encode('utf-8')),
+            OP_IDENTIFIER: (YADIS_CONTENT_TYPE, (XRDS % (OPENID_IDP_2_0_TYPE, OP_ENDPOINT)).encode('utf-8')),
+        }
+
+    def fetch(self, url, body=None, headers=None):
+        if url == OP_ENDPOINT and body is not None:
+            query = dict(parse_qsl(body.decode('utf-8')))
+            web_response = self.server.encodeResponse(self.server.handleRequest(self.server.decodeRequest(query)))
+            return HTTPResponse(url, web_response.code, web_response.headers, web_response.body.encode('utf-8'))
+        if url in self.documents:
+            content_type, document = self.documents[url]
+            return HTTPResponse(url, 200, {'content-type': content_type}, document)
+        return HTTPResponse(url, 404, {}, b'')
+
+
+def answer(server, redirect_url, identity):
+    """Process the checkid request by the provider and return the query of its positive assertion."""
+    request = server.decodeRequest(dict(parse_qsl(urlsplit(redirect_url).query)))
+    if request.idSelect():
+        response = request.answer(True, identity=identity, claimed_id=identity)
+    else:
+        response = request.answer(True)
+    web_response = server.encodeResponse(response)
+    return dict(parse_qsl(urlsplit(web_response.headers['location']).query))
+
+
+class Scenario(object):
+    """Login scenario.
+
+    @ivar identifier: The identifier entered by the user.
+    @ivar stateless: Whether the consumer runs without a store, i.e. in dumb mode.
+    """
+
+    def __init__(self, identifier, stateless):
+        self.identifier = identifier
+        self.stateless = stateless
+
+
+SCENARIOS = OrderedDict([
+    # Responses are verified by an association shared with the provider
+    ('smart', Scenario(IDENTITY, stateless=False)),
+    # Responses are verified by check_authentication requests
+    ('dumb', Scenario(IDENTITY, stateless=True)),
+    # The user enters the provider identifier, so the asserted identity doesn't match the discovered endpoint
+    # and the consumer has to discover it again
+    ('discovery-mismatch', Scenario(OP_IDENTIFIER, stateless=False)),
+])
+
+
+class Login(object):
+    """Runs single logins of the scenario and measures their phases."""
+
+    def __init__(self, scenario, server, store, fetcher):
+        self.scenario = scenario
+        self.server = server
+        self.store = None if scenario.stateless else store
+        self.fetcher = fetcher
+
+    def run(self, measure):
+        """Run one login, call C{measure} with the name of each phase and the callable which runs it."""
+        consumer = Consumer({}, self.store, fetcher=self.fetcher)
+        auth_request = measure('begin', lambda: consumer.begin(self.scenario.identifier))
+        redirect_url = measure('redirect', lambda: auth_request.redirectURL(REALM, RETURN_TO))
+        query = measure('provider', lambda: answer(self.server, redirect_url, IDENTITY))
+        response = measure('complete', lambda: consumer.complete(query, RETURN_TO))
+        if response.status != SUCCESS:
+            raise AssertionError('Login failed: %s' % getattr(response, 'message', response.status))
+
+
+def time_login(login, timer):
+    """Run one login and return durations of its phases."""
+    durations = {}
+
+    def measure(phase, function):
+        start = timer()
+        result = function()
+        durations[phase] = timer() - start
+        return result
+
+    login.run(measure)
+    return durations
+
+
+def trace_login(login):
+    """Run one login and return peak memory allocated in each phase, in bytes."""
+    peaks = {}
+
+    def measure(phase, function):
+        tracemalloc.clear_traces()
+        result = function()
+        peaks[phase] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    login.run(measure)
+    return peaks
+
+
+def run_scenario(name, iterations, allocation_iterations):
+    """Run the scenario and return its statistics.
+
+    The first login negotiates an association in smart mode, it is not included in the statistics.
+
+    @rtype: Dict[six.text_type, Any]
+    """
+    server = Server(MemoryStore(), OP_ENDPOINT)
+    fetcher = LocalFetcher(server)
+    previous_fetcher = fetchers.getDefaultFetcher()
+    fetchers.setDefaultFetcher(fetcher)
+    try:
+        login = Login(SCENARIOS[name], server, MemoryStore(), fetcher)
+        timer = timeit.default_timer
+        time_login(login, timer)
+
+        phases = OrderedDict((phase, []) for phase in PHASES)
+        start = timer()
+        for _ in range(iterations):
+            for phase, duration in time_login(login, timer).items():
+                phases[phase].append(duration * 1000)
+        total = timer() - start
+
+        allocations = OrderedDict((phase, []) for phase in PHASES)
+        if tracemalloc is not None and allocation_iterations:
+            tracemalloc.start()
+            try:
+                for _ in range(allocation_iterations):
+                    for phase, peak in trace_login(login).items():
+                        allocations[phase].append(peak / 1024)
+            finally:
+                tracemalloc.stop()
+    finally:
+        fetchers.setDefaultFetcher(previous_fetcher, wrap_exceptions=False)
+
+    latency = OrderedDict()
+    for phase, milliseconds in phases.items():
+        milliseconds.sort()
+        latency[phase] = OrderedDict([
+            ('mean', sum(milliseconds) / len(milliseconds)),
+            ('p50', percentile(milliseconds, 50)),
+            ('p90', percentile(milliseconds, 90)),
+            ('p99', percentile(milliseconds, 99)),
+            ('max', milliseconds[-1]),
+        ])
+    peak_kib = OrderedDict((phase, sum(kib) / len(kib)) for phase, kib in allocations.items() if kib)
+    return OrderedDict([
+        ('logins', iterations),
+        ('logins_per_second', iterations / total),
+        ('latency_ms', latency),
+        ('peak_allocated_kib', peak_kib),
+    ])
+
+
+def run(iterations, allocation_iterations, scenarios, discovery_cache):
+    """Run the scenarios and return the results.
+
+    @rtype: Dict[six.text_type, Any]
+    """
+    results = OrderedDict()
+    for scenario in scenarios:
+        setDefaultDiscoveryCache(DiscoveryCache() if discovery_cache else None)
+        try:
+            results[scenario] = run_scenario(scenario, iterations, allocation_iterations)
+        finally:
+            setDefaultDiscoveryCache(None)
+    return OrderedDict([
+        ('python', sys.version.split()[0]),
+        ('iterations', iterations),
+        ('discovery_cache', discovery_cache),
+        ('scenarios', results),
+    ])
+
+
+def format_text(results):
+    """Return the results as a human readable table."""
+    lines = ['python: %s, discovery cache: %s' % (results['python'], 'yes' if results['discovery_cache'] else 'no')]
+    for scenario, stats in results['scenarios'].items():
+        lines.append('')
+        lines.append('%s: %.1f logins/s' % (scenario, stats['logins_per_second']))
+        lines.append('  %-10s %9s %9s %9s %9s %10s' % ('phase', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak KiB'))
+        for phase, latency in stats['latency_ms'].items():
+            peak = stats['peak_allocated_kib'].get(phase)
+            lines.append('  %-10s %9.3f %9.3f %9.3f %9.3f %10s' % (
+                phase, latency['p50'], latency['p90'], latency['p99'], latency['max'],
+                '-' if peak is None else '%.1f' % peak))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=500, help='number of logins in each scenario')
+    parser.add_argument('--allocation-iterations', type=int, default=50,
+                        help='number of logins traced for memory allocations, 0 disables tracing')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), dest='scenarios',
+                        help='scenario to run, may be repeated, all scenarios are run by default')
+    parser.add_argument('--discovery-cache', action='store_true', help='cache discovered services')
+    parser.add_argument('--format', choices=('text', 'json'), default='text', help='output format')
+    options = parser.parse_args()
+    results = run(options.iterations, options.allocation_iterations, options.scenarios or list(SCENARIOS),
+                  options.discovery_cache)
+    if options.format == 'json':
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_text(results))
+
+
+if __name__ == '__main__':
+    main()
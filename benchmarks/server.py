@@ -0,0 +1,257 @@
+"""End-to-end benchmark of the OpenID provider.
+
+Drives L{Server.decodeRequest}, L{Server.handleRequest} or L{CheckIDRequest.answer} and L{Server.encodeResponse} with
+generated traffic and reports the number of requests per second and latency percentiles for each scenario.
+The checkid_setup requests carry AX, SReg and PAPE requests, which are answered by the benchmark.
+
+Example::
+
+    python -m benchmarks.server --store sqlite --format json > results.json
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+from itertools import cycle
+
+from openid.dh import DiffieHellman
+from openid.extensions import ax, pape, sreg
+from openid.message import OPENID2_NS, Message
+from openid.server.server import BROWSER_REQUEST_MODES, Server
+from openid.store.filestore import FileOpenIDStore
+from openid.store.memstore import MemoryStore
+from openid.store.sqlstore import SQLiteStore
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+REALM = 'http://rp.example.com/'
+IDENTITY = 'http://user.example.com/'
+
+# Attributes requested by AX and their values
+AX_ATTRIBUTES = {
+    'http://axschema.org/contact/email': 'user@example.com',
+    'http://axschema.org/namePerson': 'Example User',
+    'http://axschema.org/namePerson/friendly': 'user',
+    'http://axschema.org/pref/language': 'en-US',
+    'http://axschema.org/pref/timezone': 'Europe/Prague',
+    'http://axschema.org/contact/country/home': 'CZ',
+}
+SREG_DATA = {'nickname': 'user', 'email': 'user@example.com', 'fullname': 'Example User', 'language': 'en'}
+# Number of consumer Diffie-Hellman keys used in association requests
+CONSUMER_KEYS = 16
+
+STORES = ('memory', 'file', 'sqlite')
+
+
+def make_store(name, directory):
+    """Return a new store.
+
+    @param name: The name of the store, one of L{STORES}.
+    @param directory: The temporary directory for the store data.
+    """
+    if name == 'memory':
+        return MemoryStore()
+    elif name == 'file':
+        return FileOpenIDStore(directory)
+    else:
+        store = SQLiteStore(sqlite3.connect(os.path.join(directory, 'openid.db')), SQLiteStore.associations_table,
+                            SQLiteStore.nonces_table)
+        store.createTables()
+        return store
+
+
+def checkid_query(assoc_handle=None):
+    """Return a query of checkid_setup request with extensions."""
+    message = Message.fromOpenIDArgs({
+        'ns': OPENID2_NS,
+        'mode': 'checkid_setup',
+        'identity': IDENTITY,
+        'claimed_id': IDENTITY,
+        'return_to': REALM + 'complete',
+        'realm': REALM,
+    })
+    if assoc_handle:
+        message.setArg(OPENID2_NS, 'assoc_handle', assoc_handle)
+    ax_request = ax.FetchRequest()
+    for type_uri in sorted(AX_ATTRIBUTES):
+        ax_request.add(ax.AttrInfo(type_uri, required=True))
+    ax_request.toMessage(message)
+    sreg.SRegRequest(required=['nickname', 'email'], optional=['fullname', 'language']).toMessage(message)
+    pape.Request([pape.AUTH_MULTI_FACTOR], max_auth_age=3600).toMessage(message)
+    return message.toPostArgs()
+
+
+def answer_checkid(request):
+    """Return a positive response to the checkid request, with the requested extensions."""
+    response = request.answer(True)
+
+    ax_request = ax.FetchRequest.fromOpenIDRequest(request)
+    if ax_request is not None:
+        ax_response = ax.FetchResponse(ax_request)
+        for type_uri in ax_request.requested_attributes:
+            if type_uri in AX_ATTRIBUTES:
+                ax_response.addValue(type_uri, AX_ATTRIBUTES[type_uri])
+        response.addExtension(ax_response)
+
+    sreg_request = sreg.SRegRequest.fromOpenIDRequest(request)
+    response.addExtension(sreg.SRegResponse.extractResponse(sreg_request, SREG_DATA))
+
+    if pape.Request.fromOpenIDRequest(request) is not None:
+        response.addExtension(pape.Response([pape.AUTH_MULTI_FACTOR], auth_time='2020-01-01T00:00:00Z'))
+    return response
+
+
+def process(server, query):
+    """Process the request from decoding its query to encoding the response.
+
+    @rtype: L{openid.server.server.WebResponse}
+    """
+    request = server.decodeRequest(query)
+    if request.mode in BROWSER_REQUEST_MODES:
+        response = answer_checkid(request)
+    else:
+        response = server.handleRequest(request)
+    return server.encodeResponse(response)
+
+
+def associate_queries(assoc_type, session_type):
+    """Return a generator of associate request queries."""
+    def generate(server, iterations):
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.assoc_type': assoc_type,
+            'openid.session_type': session_type,
+        }
+        if session_type == 'no-encryption':
+            return [query] * iterations
+        keys = cycle([DiffieHellman.fromDefaults().public_key for _ in range(min(iterations, CONSUMER_KEYS))])
+        return [dict(query, **{'openid.dh_consumer_public': next(keys)}) for _ in range(iterations)]
+    return generate
+
+
+def checkid_smart_queries(server, iterations):
+    """Return queries of checkid_setup requests with an association."""
+    assoc = server.signatory.createAssociation(dumb=False, assoc_type='HMAC-SHA256')
+    return [checkid_query(assoc.handle)] * iterations
+
+
+def checkid_dumb_queries(server, iterations):
+    """Return queries of checkid_setup requests in dumb mode."""
+    return [checkid_query()] * iterations
+
+
+def check_authentication_queries(server, iterations):
+    """Return queries of check_authentication requests, each for a different response signed in dumb mode."""
+    queries = []
+    query = checkid_query()
+    for _ in range(iterations):
+        request = server.decodeRequest(query)
+        message = server.signatory.sign(answer_checkid(request)).fields.copy()
+        message.setArg(OPENID2_NS, 'mode', 'check_authentication')
+        queries.append(message.toPostArgs())
+    return queries
+
+
+SCENARIOS = OrderedDict([
+    ('associate-no-encryption', associate_queries('HMAC-SHA256', 'no-encryption')),
+    ('associate-dh-sha1', associate_queries('HMAC-SHA1', 'DH-SHA1')),
+    ('associate-dh-sha256', associate_queries('HMAC-SHA256', 'DH-SHA256')),
+    ('checkid_setup-smart', checkid_smart_queries),
+    ('checkid_setup-dumb', checkid_dumb_queries),
+    ('check_authentication', check_authentication_queries),
+])
+
+
+def percentile(durations, percent):
+    """Return the percentile of the sorted durations, by the nearest rank method."""
+    rank = int(math.ceil(len(durations) * percent / 100.0))
+    return durations[max(rank, 1) - 1]
+
+
+def run_scenario(server, scenario, iterations):
+    """Run the scenario and return its statistics.
+
+    @rtype: Dict[six.text_type, Any]
+    """
+    queries = SCENARIOS[scenario](server, iterations)
+    durations = []
+    timer = timeit.default_timer
+    start = timer()
+    for query in queries:
+        request_start = timer()
+        process(server, query)
+        durations.append(timer() - request_start)
+    total = timer() - start
+
+    durations.sort()
+    milliseconds = [d * 1000 for d in durations]
+    return OrderedDict([
+        ('requests', iterations),
+        ('requests_per_second', iterations / total),
+        ('latency_ms', OrderedDict([
+            ('mean', sum(milliseconds) / len(milliseconds)),
+            ('p50', percentile(milliseconds, 50)),
+            ('p90', percentile(milliseconds, 90)),
+            ('p99', percentile(milliseconds, 99)),
+            ('max', milliseconds[-1]),
+        ])),
+    ])
+
+
+def run(store_name, iterations, scenarios):
+    """Run the scenarios against a new store and return the results.
+
+    @rtype: Dict[six.text_type, Any]
+    """
+    directory = tempfile.mkdtemp(prefix='openid-benchmark-')
+    try:
+        server = Server(make_store(store_name, directory), OP_ENDPOINT)
+        results = OrderedDict()
+        for scenario in scenarios:
+            results[scenario] = run_scenario(server, scenario, iterations)
+    finally:
+        shutil.rmtree(directory)
+    return OrderedDict([
+        ('python', sys.version.split()[0]),
+        ('store', store_name),
+        ('iterations', iterations),
+        ('scenarios', results),
+    ])
+
+
+def format_text(results):
+    """Return the results as a human readable table."""
+    lines = ['store: %s, python: %s' % (results['store'], results['python']),
+             '%-24s %10s %9s %9s %9s %9s' % ('scenario', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+    for scenario, stats in results['scenarios'].items():
+        latency = stats['latency_ms']
+        lines.append('%-24s %10.1f %9.3f %9.3f %9.3f %9.3f' % (
+            scenario, stats['requests_per_second'], latency['p50'], latency['p90'], latency['p99'], latency['max']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=1000, help='number of requests in each scenario')
+    parser.add_argument('--store', choices=STORES, default='memory', help='store used by the server')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), dest='scenarios',
+                        help='scenario to run, may be repeated, all scenarios are run by default')
+    parser.add_argument('--format', choices=('text', 'json'), default='text', help='output format')
+    options = parser.parse_args()
+    results = run(options.store, options.iterations, options.scenarios or list(SCENARIOS))
+    if options.format == 'json':
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_text(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark signing of checkid_setup responses.
+
+Measures how many positive checkid_setup responses the L{Signatory} signs per second.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import timeit
+from functools import partial
+
+from openid.cache import LRUCache
+from openid.message import OPENID2_NS
+from openid.server.server import Server, Signatory
+from openid.store.memstore import MemoryStore
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+REALM = 'http://rp.example.com/'
+
+
+def make_response(server, assoc_handle=None):
+    """Return a positive response to a checkid_setup request."""
+    query = {
+        'openid.ns': OPENID2_NS,
+        'openid.mode': 'checkid_setup',
+        'openid.identity': 'http://user.example.com/',
+        'openid.claimed_id': 'http://user.example.com/',
+        'openid.return_to': REALM + 'complete',
+        'openid.realm': REALM,
+    }
+    if assoc_handle:
+        query['openid.assoc_handle'] = assoc_handle
+    request = server.decodeRequest(query)
+    response = request.answer(True)
+    # Add some payload, similar to the one of extensions.
+    response.fields.updateArgs('http://example.com/ext', {'key%d' % i: 'value%d' % i for i in range(10)})
+    return response
+
+
+def run(iterations, dumb=False, cache_size=None):
+    """Sign responses and return the number of signed responses per second.
+
+    @rtype: float
+    """
+    if cache_size:
+        signatory_class = partial(Signatory, cache=LRUCache(cache_size))
+    else:
+        signatory_class = Signatory
+    server = Server(MemoryStore(), OP_ENDPOINT, signatoryClass=signatory_class)
+    if dumb:
+        assoc_handle = None
+    else:
+        assoc_handle = server.signatory.createAssociation(dumb=False, assoc_type='HMAC-SHA256').handle
+    response = make_response(server, assoc_handle)
+
+    start = timeit.default_timer()
+    for _ in range(iterations):
+        server.signatory.sign(response)
+    return iterations / (timeit.default_timer() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=10000, help='number of signed responses')
+    parser.add_argument('--dumb', action='store_true', help='sign responses in dumb (stateless) mode')
+    parser.add_argument('--cache', type=int, metavar='SIZE', help='use association cache of the given size')
+    options = parser.parse_args()
+    rate = run(options.iterations, options.dumb, options.cache)
+    print('checkid_setup responses signed per second: %.1f' % rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,7 @@ __version__ = '3.2'
 
 __all__ = [
     'association',
+    'cache',
     'consumer',
     'cryptutil',
     'dh',
@@ -40,6 +41,7 @@ __all__ = [
     'server',
     'sreg',
     'store',
+    'tracing',
     'urinorm',
     'yadis',
 ]
@@ -500,13 +500,16 @@ class Association(object):
 
         signed_message = message.copy()
         signed_message.setArg(OPENID_NS, 'assoc_handle', self.handle)
-        message_keys = signed_message.toPostArgs().keys()
-        signed_list = [k[7:] for k in message_keys
-                       if k.startswith('openid.')]
+        # Compute the signed list and the signed pairs from a single serialization of the message.
+        data = signed_message.toPostArgs()
+        signed_list = [k[7:] for k in data if k.startswith('openid.')]
         signed_list.append('signed')
         signed_list.sort()
-        signed_message.setArg(OPENID_NS, 'signed', ','.join(signed_list))
-        sig = self.getMessageSignature(signed_message)
+        signed = ','.join(signed_list)
+        signed_message.setArg(OPENID_NS, 'signed', signed)
+        data['openid.signed'] = signed
+        pairs = [(field, data['openid.' + field]) for field in signed_list]
+        sig = oidutil.toBase64(self.sign(pairs))
         signed_message.setArg(OPENID_NS, 'sig', sig)
         return signed_message
 
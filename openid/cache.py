@@ -0,0 +1,217 @@
+"""In-process caches used by the OpenID library."""
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+
+__all__ = ['LRUCache', 'SingleFlight', 'copyException', 'getHTTPExpiration']
+
+
+class LRUCache(object):
+    """Bounded in-process cache with expiring entries.
+
+    When the cache is full, the least recently used entry is removed. Entries
+    may have an expiration time, expired entries are never returned.
+
+    The cache is thread safe.
+
+    @ivar max_size: The maximal number of entries in the cache.
+    @type max_size: int
+
+    @ivar hits: The number of successful lookups.
+    @type hits: int
+
+    @ivar misses: The number of failed lookups.
+    @type misses: int
+    """
+
+    def __init__(self, max_size=1000):
+        """Create a new cache.
+
+        @param max_size: The maximal number of entries in the cache.
+        @type max_size: int
+        """
+        if max_size < 1:
+            raise ValueError("Cache size must be positive, not %r" % (max_size,))
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for the key or C{default} if it is not cached or expired."""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+            # Reinsert the entry to mark it as the most recently used.
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires=None):
+        """Cache the value.
+
+        @param expires: Timestamp when the entry expires, C{None} for entries which do not expire.
+        @type expires: Optional[float]
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove the key from the cache and return its value or C{default} if it is not cached or expired."""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return default
+        if expires is not None and expires <= time.time():
+            return default
+        return value
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def copyException(error):
+    """Return a new instance of the exception, which can be raised instead of a cached one.
+
+    Raising the same instance again extends its traceback and keeps the
+    frames of all the previous raises alive. The copy has the type,
+    arguments and attributes of the exception, but no traceback. The
+    constructor of the exception is not called. If the exception can't be
+    copied, its traceback is cleared instead.
+
+    @type error: Exception
+    @rtype: Exception
+    """
+    error_class = type(error)
+    try:
+        copied = error_class.__new__(error_class, *error.args)
+        copied.args = error.args
+        copied.__dict__.update(error.__dict__)
+        return copied
+    except Exception:
+        error.__traceback__ = None
+        error.__context__ = None
+        return error
+
+
+class _Call(object):
+    """Call in progress in L{SingleFlight}."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key.
+
+    If a call with the same key is already in progress, wait for it and
+    share its result instead of making another call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, function, *args, **kwargs):
+        """Call the function, unless a call with the same key is already in progress.
+
+        @return: Result of the function.
+        @raises Exception: Any exception raised by the function.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise copyException(call.error)
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def isRunning(self, key):
+        """Return whether a call with the key is in progress.
+
+        @rtype: bool
+        """
+        with self._lock:
+            return key in self._calls
+
+
+def getHTTPExpiration(headers, now=None):
+    """Return the expiration time of a HTTP response from its cache headers.
+
+    C{Cache-Control} header takes precedence over C{Expires} header.
+
+    @param headers: HTTP headers with lower case names.
+    @type headers: Dict[six.text_type, six.text_type]
+
+    @return: The expiration timestamp or C{None} if the headers don't define any.
+    @rtype: Optional[float]
+    """
+    if now is None:
+        now = time.time()
+    if not headers:
+        return None
+
+    cache_control = headers.get('cache-control')
+    if cache_control:
+        directives = {}
+        for directive in cache_control.split(','):
+            name, _, value = directive.strip().partition('=')
+            directives[name.strip().lower()] = value.strip().strip('"')
+        if 'no-store' in directives or 'no-cache' in directives:
+            return now
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    return now + max(0, int(directives[name]))
+                except ValueError:
+                    return now
+
+    expires = headers.get('expires')
+    if expires:
+        parsed = parsedate_tz(expires)
+        if parsed is None:
+            # Invalid dates represent a time in the past.
+            return now
+        return mktime_tz(parsed)
+    return None
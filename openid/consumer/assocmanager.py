@@ -0,0 +1,167 @@
+"""Negotiation of consumer associations in the background.
+
+The L{AssociationManager} keeps the users from waiting for association
+requests. The consumer uses only the associations which are already in
+the store and falls back to stateless mode while the manager negotiates
+the missing associations in an executor.
+
+Example::
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    manager = AssociationManager(store, ThreadPoolExecutor(4))
+    consumer = Consumer(session, store, association_manager=manager)
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from openid.association import default_negotiator
+from openid.cache import LRUCache
+from openid.consumer.consumer import GenericConsumer
+
+__all__ = ['AssociationManager']
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AssociationManager(object):
+    """Negotiate associations with OpenID providers in the background.
+
+    OP endpoints without a valid association are queued to the executor,
+    each endpoint at most once at a time. Associations which expire in
+    less than C{renew_before} seconds are renewed, while the current
+    association is still in use. If the negotiation fails, the endpoint
+    isn't queued again for C{retry_delay} seconds.
+
+    @ivar store: The store for the negotiated associations.
+    @type store: L{openid.store.interface.OpenIDStore}
+
+    @ivar executor: The executor which runs the negotiations.
+    @type executor: concurrent.futures.Executor
+
+    @ivar renew_before: Number of seconds before the expiration when the association is renewed.
+    @type renew_before: int
+
+    @ivar retry_delay: Number of seconds to wait after failed negotiation.
+    @type retry_delay: int
+
+    @ivar negotiator: The negotiator of association and session types.
+    @type negotiator: L{openid.association.SessionNegotiator}
+
+    @ivar consumer_class: The class of consumer which negotiates the associations.
+    @type consumer_class: Type[L{GenericConsumer}]
+    """
+
+    def __init__(self, store, executor, renew_before=3600, retry_delay=600, negotiator=None,
+                 consumer_class=GenericConsumer, max_failures=1000):
+        """Create a new association manager.
+
+        @param store: The store for the negotiated associations.
+        @type store: L{openid.store.interface.OpenIDStore}
+
+        @param executor: The executor which runs the negotiations.
+        @type executor: concurrent.futures.Executor
+
+        @param negotiator: The negotiator of association and session types, copy of the default one if not provided.
+        @type negotiator: Optional[L{openid.association.SessionNegotiator}]
+
+        @param max_failures: The maximal number of remembered failed negotiations.
+        @type max_failures: int
+        """
+        self.store = store
+        self.executor = executor
+        self.renew_before = renew_before
+        self.retry_delay = retry_delay
+        if negotiator is None:
+            negotiator = default_negotiator.copy()
+        self.negotiator = negotiator
+        self.consumer_class = consumer_class
+        self._pending = set()
+        self._failures = LRUCache(max_failures)
+        self._lock = threading.Lock()
+
+    def getAssociation(self, endpoint):
+        """Return the association for the endpoint from the store, never negotiate it.
+
+        Schedules the negotiation of a new association if the current one
+        is missing, expired or about to expire.
+
+        @type endpoint: L{openid.consumer.discover.OpenIDServiceEndpoint}
+
+        @returns: A valid association for the endpoint's server_url or C{None}
+        @rtype: Optional[L{openid.association.Association}]
+        """
+        assoc = self.store.getAssociation(endpoint.server_url)
+        if assoc is None or assoc.expiresIn <= 0:
+            self.schedule(endpoint)
+            return None
+        if assoc.expiresIn <= self.renew_before:
+            self.schedule(endpoint)
+        return assoc
+
+    def schedule(self, endpoint):
+        """Schedule the negotiation of a new association with the endpoint.
+
+        @type endpoint: L{openid.consumer.discover.OpenIDServiceEndpoint}
+
+        @return: Future with the new association or C{None} if negotiation
+            with the endpoint is already scheduled or it recently failed.
+        @rtype: Optional[concurrent.futures.Future]
+        """
+        server_url = endpoint.server_url
+        with self._lock:
+            if server_url in self._pending or server_url in self._failures:
+                return None
+            self._pending.add(server_url)
+
+        try:
+            return self.executor.submit(self._negotiate, endpoint)
+        except Exception:
+            self._done(server_url)
+            raise
+
+    def isPending(self, server_url):
+        """Return whether a negotiation with the OP endpoint is scheduled or running.
+
+        @rtype: bool
+        """
+        with self._lock:
+            return server_url in self._pending
+
+    def _done(self, server_url):
+        with self._lock:
+            self._pending.discard(server_url)
+
+    def _negotiate(self, endpoint):
+        """Negotiate a new association and store it.
+
+        @rtype: Optional[L{openid.association.Association}]
+        """
+        try:
+            return self._negotiateAssociation(endpoint)
+        finally:
+            self._done(endpoint.server_url)
+
+    def _negotiateAssociation(self, endpoint):
+        """Negotiate the association using the consumer, remember failures."""
+        consumer = self.consumer_class(self.store)
+        consumer.negotiator = self.negotiator
+        start = time.time()
+        try:
+            assoc = consumer._negotiateAssociation(endpoint)
+        except Exception:
+            _LOGGER.exception('Negotiation of association with %s failed', endpoint.server_url)
+            assoc = None
+
+        if assoc is None:
+            _LOGGER.warning('Failed to make an association with %s, retry in %d seconds', endpoint.server_url,
+                            self.retry_delay)
+            self._failures.set(endpoint.server_url, True, expires=time.time() + self.retry_delay)
+            return None
+
+        self.store.storeAssociation(endpoint.server_url, assoc)
+        _LOGGER.info('Associated with %s in %.2f seconds', endpoint.server_url, time.time() - start)
+        return assoc
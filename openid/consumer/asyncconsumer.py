@@ -0,0 +1,470 @@
+"""Asynchronous OpenID consumer for asyncio based applications.
+
+This module requires python 3.5 or newer.
+
+The L{AsyncConsumer} mirrors the L{Consumer<openid.consumer.consumer.Consumer>},
+but its methods which access the store or the network are coroutines. It uses
+an asynchronous store and an asynchronous fetcher, see
+L{openid.executor} for their description and for
+L{ExecutorStore<openid.executor.ExecutorStore>} and
+L{ExecutorFetcher<openid.executor.ExecutorFetcher>}, which adapt the
+synchronous ones.
+
+The steps of the protocol are shared with the synchronous consumer, only the
+discovery, the direct requests to the OpenID provider and the store access
+are asynchronous.
+
+Example::
+
+    oidconsumer = AsyncConsumer(session, ExecutorStore(FileOpenIDStore(data_path)))
+    auth_request = await oidconsumer.begin(user_url)
+    ...
+    response = await oidconsumer.complete(query, current_url)
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import functools
+import inspect
+import logging
+
+import six
+
+from openid import fetchers
+from openid.cache import copyException
+from openid.consumer.consumer import (Consumer, DiscoveryFailure, GenericConsumer, ProtocolError, _Call,
+                                      _httpResponseToMessage, _StoreKey)
+from openid.consumer.discover import (OpenIDServiceEndpoint, _getHTMLServices, _getXRIServices, _getYadisServices,
+                                      _normalizeURI, getDefaultDiscoveryCache, normalizeURL, normalizeXRI)
+from openid.executor import ExecutorFetcher
+from openid.message import Message
+from openid.yadis import xri
+from openid.yadis.discover import DiscoveryResult, iterDiscoverySteps
+from openid.yadis.etxrd import XRDSError
+from openid.yadis.manager import Discovery
+from openid.yadis.xrires import ProxyResolver
+
+__all__ = ['AsyncConsumer', 'AsyncGenericConsumer', 'discover']
+
+_LOGGER = logging.getLogger(__name__)
+
+# Discoveries in progress, by event loop and normalized identifier
+_discoveries = {}
+
+
+async def discover(identifier, fetcher):
+    """Discover OpenID services for the identifier using the asynchronous fetcher.
+
+    If the default discovery cache is set, the services are taken from it.
+    Concurrent discoveries of the same identifier share a single discovery.
+
+    @param fetcher: The asynchronous fetcher.
+
+    @return: (claimed_id, services)
+    @rtype: (six.text_type, List[OpenIDServiceEndpoint])
+
+    @raises DiscoveryFailure: When the discovery fails.
+    """
+    cache = getDefaultDiscoveryCache()
+    if cache is None:
+        if xri.identifierScheme(identifier) == "XRI":
+            key = normalizeXRI(identifier)
+        else:
+            key = _normalizeURI(identifier)
+        result = None
+    else:
+        key = cache.getKey(identifier)
+        result = cache.get(key)
+
+    if result is None:
+        discovery_key = (asyncio.get_event_loop(), key)
+        discovery = _discoveries.get(discovery_key)
+        if discovery is None:
+            discovery = asyncio.ensure_future(_discover(key, fetcher, cache))
+            _discoveries[discovery_key] = discovery
+            discovery.add_done_callback(functools.partial(_discoveries.pop, discovery_key))
+        # Shield the shared discovery from cancellation of a single request.
+        result, error = await asyncio.shield(discovery)
+        if error is not None:
+            # Each request raises its own copy, the shared error would collect their tracebacks.
+            raise copyException(error)
+        claimed_id, services = result
+        # Callers consume the list of services, return a copy.
+        result = claimed_id, list(services)
+    return result
+
+
+async def _discover(key, fetcher, cache):
+    """Run the discovery and cache its result.
+
+    @return: The result of the discovery and the error.
+    """
+    cached_errors = () if cache is None else cache.cached_errors
+    try:
+        if xri.identifierScheme(key) == "XRI":
+            claimed_id, services = await discoverXRI(key, fetcher)
+            expires = None
+        else:
+            claimed_id, services, expires = await _discoverURIExpiration(key, fetcher)
+    except cached_errors as error:
+        # Cache the error without its traceback, it would keep the frames of the discovery alive
+        error = copyException(error)
+        cache.set(key, None, error=error)
+        return None, error
+    except Exception as error:
+        return None, error
+    if cache is not None:
+        cache.set(key, (claimed_id, services), expires)
+    return (claimed_id, services), None
+
+
+async def discoverURI(uri, fetcher):
+    """Discover OpenID services for the URI identifier using the asynchronous fetcher.
+
+    @see: L{openid.consumer.discover.discoverURI}
+    """
+    return (await _discoverURIExpiration(_normalizeURI(uri), fetcher))[:2]
+
+
+async def _discoverURIExpiration(uri, fetcher):
+    steps = iterDiscoverySteps(uri)
+    step = next(steps)
+    while not isinstance(step, DiscoveryResult):
+        url, headers = step
+        step = steps.send(await fetcher.fetch(url, headers=headers))
+
+    result = _getYadisServices(step)
+    if result is None:
+        # if we got the Yadis content-type or followed the Yadis
+        # header, re-fetch the document without following the Yadis
+        # header, with no Accept header.
+        result = _getHTMLServices(await fetcher.fetch(uri))
+    claimed_id, openid_services, expires = result
+    return normalizeURL(claimed_id), openid_services, expires
+
+
+async def discoverXRI(iname, fetcher):
+    """Discover OpenID services for the XRI using the asynchronous fetcher.
+
+    @see: L{openid.consumer.discover.discoverXRI}
+    """
+    iname = normalizeXRI(iname)
+    resolver = ProxyResolver()
+    canonicalID = None
+    services = []
+    try:
+        for service_type in OpenIDServiceEndpoint.openid_type_uris:
+            result = resolver.parseResponse(iname, await fetcher.fetch(resolver.queryURL(iname, service_type)))
+            if result is None:
+                continue
+            canonicalID, some_services = result
+            services.extend(some_services)
+    except XRDSError:
+        _LOGGER.info('xrds error on %s', iname)
+        return iname, []
+    return _getXRIServices(iname, canonicalID, services)
+
+
+async def _runSteps(steps):
+    """Drive the steps of the consumer, await the results of the calls.
+
+    @see: L{_runSteps<openid.consumer.consumer._runSteps>}
+    @return: The result of the steps.
+    """
+    step = next(steps)
+    while isinstance(step, _Call):
+        try:
+            result = step.function(*step.args)
+            if inspect.isawaitable(result):
+                result = await result
+        except BaseException as error:
+            # Let the steps handle the error or clean up.
+            step = steps.throw(error)
+        else:
+            step = steps.send(result)
+    steps.close()
+    return step
+
+
+class AsyncGenericConsumer(GenericConsumer):
+    """Implementation of the common logic for asynchronous OpenID consumers.
+
+    I'm an asynchronous counterpart of L{GenericConsumer<openid.consumer.consumer.GenericConsumer>}.
+    The methods L{begin} and L{complete} are coroutines. Concurrent requests
+    for an association with the same OP endpoint share a single negotiation.
+    The association manager is not supported.
+
+    I drive the same steps as the L{GenericConsumer<openid.consumer.consumer.GenericConsumer>},
+    only the calls of the store, the fetcher and the discovery are awaited.
+
+    @ivar store: The asynchronous store or C{None} for the stateless mode.
+    @type store: L{ExecutorStore<openid.executor.ExecutorStore>} or other asynchronous store
+
+    @ivar fetcher: The asynchronous fetcher.
+    @type fetcher: L{ExecutorFetcher<openid.executor.ExecutorFetcher>} or other asynchronous fetcher
+
+    @ivar executor: I use this to run Diffie-Hellman key exchange,
+        C{None} for the default executor of the event loop.
+    @type executor: Optional[concurrent.futures.Executor]
+    """
+
+    # Negotiations of associations in progress, by event loop, store and OP endpoint
+    _async_negotiations = {}
+
+    def __init__(self, store, fetcher=None, executor=None):
+        super(AsyncGenericConsumer, self).__init__(store)
+        if fetcher is None:
+            fetcher = ExecutorFetcher()
+        self.fetcher = fetcher
+        self.executor = executor
+
+    async def _discover(self, identifier):
+        return await discover(identifier, self.fetcher)
+
+    async def begin(self, service_endpoint):
+        """Create an AuthRequest object for the specified
+        service_endpoint. This method will create an association if
+        necessary."""
+        if self.store is None:
+            assoc = None
+        else:
+            assoc = await self._getAssociation(service_endpoint)
+        return self._createAuthRequest(service_endpoint, assoc)
+
+    async def complete(self, message, endpoint, return_to):
+        """Process the OpenID message, using the specified endpoint
+        and return_to URL as context.
+
+        @see: L{GenericConsumer.complete<openid.consumer.consumer.GenericConsumer.complete>}
+        """
+        response = super(AsyncGenericConsumer, self).complete(message, endpoint, return_to)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def _complete_id_res(self, message, endpoint, return_to):
+        return await _runSteps(self._iterCompleteIdRes(message, endpoint, return_to))
+
+    async def _makeKVPost(self, request_message, server_url):
+        """Make a Direct Request to an OpenID Provider using my fetcher.
+
+        @see: L{makeKVPost<openid.consumer.consumer.makeKVPost>}
+        """
+        response = await self.fetcher.fetch(server_url, body=request_message.toURLEncoded().encode('utf-8'))
+        return _httpResponseToMessage(response, server_url)
+
+    async def _doIdRes(self, message, endpoint, return_to):
+        """Handle id_res responses that are not cancellations of
+        immediate mode requests.
+
+        @see: L{GenericConsumer._doIdRes<openid.consumer.consumer.GenericConsumer._doIdRes>}
+        """
+        return await _runSteps(self._iterDoIdRes(message, endpoint, return_to))
+
+    async def _idResCheckNonce(self, message, endpoint):
+        return await _runSteps(self._iterIdResCheckNonce(message, endpoint))
+
+    async def _idResCheckSignature(self, message, server_url):
+        return await _runSteps(self._iterIdResCheckSignature(message, server_url))
+
+    async def _verifyDiscoveryResults(self, resp_msg, endpoint=None):
+        """Extract the information from an OpenID assertion message and
+        verify it against the original.
+
+        @returns: the verified endpoint
+        """
+        return await _runSteps(self._iterVerifyDiscoveryResults(resp_msg, endpoint))
+
+    async def _verifyDiscoveryResultsOpenID2(self, resp_msg, endpoint):
+        return await _runSteps(self._iterVerifyDiscoveryResultsOpenID2(resp_msg, endpoint))
+
+    async def _verifyDiscoveryResultsOpenID1(self, resp_msg, endpoint):
+        return await _runSteps(self._iterVerifyDiscoveryResultsOpenID1(resp_msg, endpoint))
+
+    async def _discoverAndVerify(self, claimed_id, to_match_endpoints):
+        """Perform discovery and verify the discovery results.
+
+        @see: L{GenericConsumer._discoverAndVerify<openid.consumer.consumer.GenericConsumer._discoverAndVerify>}
+        """
+        return await _runSteps(self._iterDiscoverAndVerify(claimed_id, to_match_endpoints))
+
+    async def _checkAuth(self, message, server_url):
+        """Make a check_authentication request to verify this message.
+
+        @returns: True if the request is valid.
+        @rtype: bool
+        """
+        return await _runSteps(self._iterCheckAuth(message, server_url))
+
+    async def _processCheckAuthResponse(self, response, server_url):
+        """Process the response message from a check_authentication
+        request, invalidating associations if requested.
+        """
+        return await _runSteps(self._iterProcessCheckAuthResponse(response, server_url))
+
+    async def _getAssociation(self, endpoint):
+        """Get an association for the endpoint's server_url.
+
+        @see: L{GenericConsumer._getAssociation<openid.consumer.consumer.GenericConsumer._getAssociation>}
+        @rtype: Optional[L{openid.association.Association}]
+        """
+        assoc = await self.store.getAssociation(endpoint.server_url)
+        if assoc is not None and assoc.expiresIn > 0:
+            return assoc
+
+        key = (asyncio.get_event_loop(), _StoreKey(self.store), endpoint.server_url)
+        negotiation = self._async_negotiations.get(key)
+        if negotiation is None:
+            negotiation = asyncio.ensure_future(self._createAssociation(endpoint))
+            self._async_negotiations[key] = negotiation
+            negotiation.add_done_callback(functools.partial(self._async_negotiations.pop, key))
+        elif not self.association_wait:
+            _LOGGER.info('Association with %s is being negotiated, using stateless mode.', endpoint.server_url)
+            return None
+        # Shield the shared negotiation from cancellation of a single request.
+        return await asyncio.shield(negotiation)
+
+    async def _createAssociation(self, endpoint):
+        """Negotiate a new association with the server and store it.
+
+        @rtype: Optional[L{openid.association.Association}]
+        """
+        return await _runSteps(self._iterCreateAssociation(endpoint))
+
+    async def _negotiateAssociation(self, endpoint):
+        """Make association requests to the server, attempting to
+        create a new association.
+
+        @see: L{GenericConsumer._negotiateAssociation<openid.consumer.consumer.GenericConsumer._negotiateAssociation>}
+        @rtype: Optional[L{openid.association.Association}]
+        """
+        return await _runSteps(self._iterNegotiateAssociation(endpoint))
+
+    async def _requestAssociation(self, endpoint, assoc_type, session_type):
+        """Make and process one association request to this endpoint's
+        OP endpoint URL.
+
+        @returns: An association object or None if the association
+            processing failed.
+
+        @raises ServerError: when the remote OpenID server returns an error.
+        """
+        return await _runSteps(self._iterRequestAssociation(endpoint, assoc_type, session_type))
+
+    async def _createAssociateRequest(self, endpoint, assoc_type, session_type):
+        """Create an association request in my executor, it runs Diffie-Hellman key exchange.
+
+        @see: L{GenericConsumer._createAssociateRequest
+            <openid.consumer.consumer.GenericConsumer._createAssociateRequest>}
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, super(AsyncGenericConsumer, self)._createAssociateRequest, endpoint, assoc_type,
+            session_type)
+
+    async def _extractAssociation(self, assoc_response, assoc_session):
+        """Extract an association from the response in my executor, it runs Diffie-Hellman key exchange.
+
+        @see: L{GenericConsumer._extractAssociation<openid.consumer.consumer.GenericConsumer._extractAssociation>}
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, super(AsyncGenericConsumer, self)._extractAssociation, assoc_response, assoc_session)
+
+
+class AsyncConsumer(Consumer):
+    """An asynchronous OpenID consumer that performs discovery and
+    does session management.
+
+    I'm an asynchronous counterpart of L{Consumer<openid.consumer.consumer.Consumer>}.
+    The methods L{begin}, L{beginWithoutDiscovery} and L{complete} are coroutines.
+
+    @ivar consumer: an instance of an object implementing the OpenID
+        protocol, but doing no discovery or session management.
+    @type consumer: L{AsyncGenericConsumer}
+    """
+
+    def __init__(self, session, store, consumer_class=None, fetcher=None, executor=None):
+        """Initialize an AsyncConsumer instance.
+
+        @param session: See L{the session instance variable<openid.consumer.consumer.Consumer.session>}
+
+        @param store: The asynchronous store or C{None} for the stateless mode.
+        @type store: L{ExecutorStore<openid.executor.ExecutorStore>} or other asynchronous store
+
+        @param consumer_class: The class of the consumer, L{AsyncGenericConsumer} by default.
+
+        @param fetcher: The asynchronous fetcher,
+            L{ExecutorFetcher<openid.executor.ExecutorFetcher>} by default.
+
+        @param executor: Executor for Diffie-Hellman key exchange.
+        @type executor: Optional[concurrent.futures.Executor]
+        """
+        self.session = session
+        if consumer_class is None:
+            consumer_class = AsyncGenericConsumer
+        self.consumer = consumer_class(store, fetcher=fetcher, executor=executor)
+        self._token_key = self.session_key_prefix + self._token
+
+    async def begin(self, user_url, anonymous=False):
+        """Start the OpenID authentication process.
+
+        @see: L{Consumer.begin<openid.consumer.consumer.Consumer.begin>}
+        @returntype: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+
+        @raises openid.consumer.discover.DiscoveryFailure: when I fail to
+            find an OpenID server for this URL.
+        """
+        disco = Discovery(self.session, user_url, self.session_key_prefix, OpenIDServiceEndpoint)
+        if disco.getManager():
+            result = None
+        else:
+            try:
+                result = await self.consumer._discover(disco.url)
+            except fetchers.HTTPFetchingError as why:
+                raise DiscoveryFailure('Error fetching XRDS document: %s' % six.text_type(why), None)
+        service = disco.getNextService(lambda url: result)
+
+        if service is None:
+            raise DiscoveryFailure(
+                'No usable OpenID services found for %s' % (user_url,), None)
+        else:
+            return await self.beginWithoutDiscovery(service, anonymous)
+
+    async def beginWithoutDiscovery(self, service, anonymous=False):
+        """Start OpenID verification without doing OpenID server discovery.
+
+        @see: L{Consumer.beginWithoutDiscovery<openid.consumer.consumer.Consumer.beginWithoutDiscovery>}
+        @rtype: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+        """
+        auth_req = await self.consumer.begin(service)
+        self._storeEndpoint(auth_req.endpoint)
+
+        try:
+            auth_req.setAnonymous(anonymous)
+        except ValueError as why:
+            raise ProtocolError(six.text_type(why))
+
+        return auth_req
+
+    async def complete(self, query, current_url):
+        """Called to interpret the server's response to an OpenID request.
+
+        @see: L{Consumer.complete<openid.consumer.consumer.Consumer.complete>}
+        @returns: a subclass of Response.
+        """
+        endpoint = self._loadEndpoint()
+
+        message = Message.fromPostArgs(query)
+        response = await self.consumer.complete(message, endpoint, current_url)
+
+        try:
+            del self.session[self._token_key]
+        except KeyError:
+            pass
+
+        if (response.status in ['success', 'cancel'] and response.identity_url is not None):
+            disco = Discovery(self.session, response.identity_url, self.session_key_prefix, OpenIDServiceEndpoint)
+            # This is OK to do even if we did not do discovery in
+            # the first place.
+            disco.cleanup(force=True)
+
+        return response
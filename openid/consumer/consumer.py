@@ -191,6 +191,9 @@ from __future__ import unicode_literals
 import base64
 import copy
 import logging
+import sys
+import threading
+import time
 import warnings
 
 import six
@@ -199,33 +202,44 @@ from six.moves.urllib.parse import parse_qsl, urldefrag, urlparse
 
 from openid import cryptutil, fetchers, oidutil, urinorm
 from openid.association import Association, SessionNegotiator, default_negotiator
+from openid.cache import LRUCache, SingleFlight
 from openid.consumer.discover import (OPENID_1_0_TYPE, OPENID_1_1_TYPE, OPENID_2_0_TYPE, DiscoveryFailure,
-                                      OpenIDServiceEndpoint, discover)
+                                      OpenIDServiceEndpoint, discover, getDefaultDiscoveryCache)
 from openid.dh import DiffieHellman
 from openid.message import BARE_NS, IDENTIFIER_SELECT, OPENID1_NS, OPENID2_NS, OPENID_NS, Message, no_default
 from openid.oidutil import string_to_text
-from openid.store.nonce import mkNonce, split as splitNonce
+from openid.store.nonce import SKEW, mkNonce, split as splitNonce
 from openid.yadis.manager import Discovery
 
 __all__ = ['AuthRequest', 'Consumer', 'SuccessResponse',
            'SetupNeededResponse', 'CancelResponse', 'FailureResponse',
            'SUCCESS', 'FAILURE', 'CANCEL', 'SETUP_NEEDED',
+           'OPCapabilityCache', 'getDefaultCapabilityCache', 'setDefaultCapabilityCache',
+           'OPCircuitBreaker', 'getDefaultCircuitBreaker', 'setDefaultCircuitBreaker',
+           'NonceReplayFilter', 'getDefaultReplayFilter', 'setDefaultReplayFilter',
            ]
 
 _LOGGER = logging.getLogger(__name__)
 
 
-def makeKVPost(request_message, server_url):
+def makeKVPost(request_message, server_url, fetcher=None):
     """Make a Direct Request to an OpenID Provider and return the
     result as a Message object.
 
+    @param fetcher: The fetcher which makes the request, the default fetcher if C{None}.
+    @type fetcher: Optional[L{openid.fetchers.HTTPFetcher}]
+
     @raises openid.fetchers.HTTPFetchingError: if an error is
         encountered in making the HTTP post.
 
     @rtype: L{openid.message.Message}
     """
     # XXX: TESTME
-    resp = fetchers.fetch(server_url, body=request_message.toURLEncoded().encode('utf-8'))
+    body = request_message.toURLEncoded().encode('utf-8')
+    if fetcher is None:
+        resp = fetchers.fetch(server_url, body=body)
+    else:
+        resp = fetcher.fetch(server_url, body=body)
 
     # Process response in separate function that can be shared by async code.
     return _httpResponseToMessage(resp, server_url)
@@ -257,6 +271,70 @@ def _httpResponseToMessage(response, server_url):
     return response_message
 
 
+class _Call(object):
+    """Call requested by the steps of the consumer.
+
+    The steps of the consumer, e.g. L{GenericConsumer._iterDoIdRes}, make
+    no requests and don't access the store. They are generators, which
+    yield the calls which may do so and expect their results to be sent
+    back, or their exceptions to be thrown in. The last value yielded is
+    the result of the steps. This way the steps are driven by
+    L{GenericConsumer}, see L{_runSteps}, as well as by the asynchronous
+    consumer, which awaits the results of the calls.
+
+    @ivar function: The function, usually a method of the consumer or of its store.
+    @ivar args: The positional arguments of the function.
+    """
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+def _runSteps(steps):
+    """Drive the steps of the consumer, make the calls synchronously.
+
+    @return: The result of the steps.
+    """
+    step = next(steps)
+    while isinstance(step, _Call):
+        try:
+            result = step.function(*step.args)
+        except BaseException as error:
+            # Let the steps handle the error or clean up.
+            step = steps.throw(error)
+        else:
+            step = steps.send(result)
+    steps.close()
+    return step
+
+
+class _StoreKey(object):
+    """Key of the store by its identity.
+
+    The key refers to the store, so the id of the store isn't reused
+    while the key is in use. Stores don't need to be hashable.
+
+    @ivar store: The store.
+    """
+
+    __slots__ = ('store', )
+
+    def __init__(self, store):
+        self.store = store
+
+    def __hash__(self):
+        return id(self.store)
+
+    def __eq__(self, other):
+        return isinstance(other, _StoreKey) and self.store is other.store
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class Consumer(object):
     """An OpenID consumer implementation that performs discovery and
     does session management.
@@ -280,7 +358,7 @@ class Consumer(object):
 
     _discover = staticmethod(discover)
 
-    def __init__(self, session, store, consumer_class=None):
+    def __init__(self, session, store, consumer_class=None, association_manager=None, fetcher=None):
         """Initialize a Consumer instance.
 
         You should create a new instance of the Consumer object with
@@ -295,6 +373,18 @@ class Consumer(object):
 
         @type store: C{L{openid.store.interface.OpenIDStore}}
 
+        @param association_manager: Manager which negotiates associations
+            in the background. If set, users never wait for association
+            requests.
+        @type association_manager: Optional[L{AssociationManager<openid.consumer.assocmanager.AssociationManager>}]
+
+        @param fetcher: The fetcher for direct requests to OpenID providers,
+            e.g. L{PooledHTTPFetcher<openid.fetchers.PooledHTTPFetcher>}
+            which reuses the connections. Its exceptions are wrapped
+            by L{ExceptionWrappingFetcher<openid.fetchers.ExceptionWrappingFetcher>}.
+            The default fetcher is used if not provided.
+        @type fetcher: Optional[L{openid.fetchers.HTTPFetcher}]
+
         @see: L{openid.store.interface}
         @see: L{openid.store}
         """
@@ -302,6 +392,10 @@ class Consumer(object):
         if consumer_class is None:
             consumer_class = GenericConsumer
         self.consumer = consumer_class(store)
+        if association_manager is not None:
+            self.consumer.association_manager = association_manager
+        if fetcher is not None:
+            self.consumer.fetcher = fetchers.ExceptionWrappingFetcher(fetcher)
         self._token_key = self.session_key_prefix + self._token
 
     def begin(self, user_url, anonymous=False):
@@ -340,7 +434,7 @@ class Consumer(object):
             is available, L{openid.consumer.discover.DiscoveryFailure} is
             an alias for C{yadis.discover.DiscoveryFailure}.
         """
-        disco = Discovery(self.session, user_url, self.session_key_prefix)
+        disco = Discovery(self.session, user_url, self.session_key_prefix, OpenIDServiceEndpoint)
         try:
             service = disco.getNextService(self._discover)
         except fetchers.HTTPFetchingError as why:
@@ -374,7 +468,7 @@ class Consumer(object):
         @see: openid.consumer.discover
         """
         auth_req = self.consumer.begin(service)
-        self.session[self._token_key] = auth_req.endpoint
+        self._storeEndpoint(auth_req.endpoint)
 
         try:
             auth_req.setAnonymous(anonymous)
@@ -408,7 +502,7 @@ class Consumer(object):
         @see: L{FailureResponse<openid.consumer.consumer.FailureResponse>}
         """
 
-        endpoint = self.session.get(self._token_key)
+        endpoint = self._loadEndpoint()
 
         message = Message.fromPostArgs(query)
         response = self.consumer.complete(message, endpoint, current_url)
@@ -422,13 +516,33 @@ class Consumer(object):
 
             disco = Discovery(self.session,
                               response.identity_url,
-                              self.session_key_prefix)
+                              self.session_key_prefix,
+                              OpenIDServiceEndpoint)
             # This is OK to do even if we did not do discovery in
             # the first place.
             disco.cleanup(force=True)
 
         return response
 
+    def _storeEndpoint(self, endpoint):
+        """Store the endpoint in the session in the compact form."""
+        self.session[self._token_key] = endpoint.toSessionData()
+
+    def _loadEndpoint(self):
+        """Return the endpoint from the session or C{None} if there isn't one.
+
+        @rtype: Optional[OpenIDServiceEndpoint]
+        """
+        endpoint = self.session.get(self._token_key)
+        if isinstance(endpoint, (list, tuple)):
+            try:
+                endpoint = OpenIDServiceEndpoint.fromSessionData(endpoint)
+            except ValueError as error:
+                _LOGGER.warning('Discarding endpoint from the session: %s', error)
+                endpoint = None
+        # Otherwise the endpoint object was stored by a previous version.
+        return endpoint
+
     def setAssociationPreference(self, association_preferences):
         """Set the order in which association types/sessions should be
         attempted. For instance, to only allow HMAC-SHA256
@@ -563,6 +677,373 @@ class ServerError(Exception):
         return cls(error_text, error_code, message)
 
 
+class _OPCapabilities(object):
+    """Association capabilities of an OP endpoint learned from negotiations."""
+
+    def __init__(self):
+        # The association and session type of the last successful negotiation
+        self.supported = None
+        # The association and session types refused by the OP
+        self.refused = set()
+        # Number of consecutive failed negotiations
+        self.failures = 0
+        self.last_failure = None
+
+
+class OPCapabilityCache(object):
+    """Cache of association capabilities of OP endpoints.
+
+    The cache remembers the association and session type which the OP
+    accepted and the types which it refused, so the next negotiation
+    starts with a type which works. After failed negotiations, new ones
+    are not attempted for C{backoff} seconds, doubled with each
+    consecutive failure up to C{max_backoff} seconds.
+
+    Example::
+
+        setDefaultCapabilityCache(OPCapabilityCache())
+
+    @ivar backoff: Number of seconds to wait after the first failed negotiation.
+    @type backoff: int
+
+    @ivar max_backoff: Maximal number of seconds to wait after failed negotiations.
+    @type max_backoff: int
+    """
+
+    def __init__(self, max_size=1000, backoff=30, max_backoff=3600):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def _getEntry(self, server_url):
+        with self._lock:
+            entry = self.cache.get(server_url)
+            if entry is None:
+                entry = _OPCapabilities()
+                self.cache.set(server_url, entry)
+            return entry
+
+    def getPreferredType(self, server_url, negotiator):
+        """Return the association and session type to request from the OP endpoint.
+
+        @type negotiator: L{openid.association.SessionNegotiator}
+        @rtype: Tuple[six.text_type, six.text_type]
+        """
+        entry = self.cache.get(server_url)
+        if entry is not None:
+            if entry.supported is not None and negotiator.isAllowed(*entry.supported):
+                return entry.supported
+            for allowed_type in negotiator.allowed_types:
+                if allowed_type not in entry.refused:
+                    return allowed_type
+        return negotiator.getAllowedType()
+
+    def isBackingOff(self, server_url):
+        """Return whether the negotiation with the OP endpoint should not be attempted yet.
+
+        @rtype: bool
+        """
+        entry = self.cache.get(server_url)
+        if entry is None or not entry.failures:
+            return False
+        delay = min(self.backoff * 2 ** (entry.failures - 1), self.max_backoff)
+        return time.time() < entry.last_failure + delay
+
+    def addSupported(self, server_url, assoc_type, session_type):
+        """Record the successful negotiation."""
+        entry = self._getEntry(server_url)
+        entry.supported = (assoc_type, session_type)
+        entry.refused.discard(entry.supported)
+        entry.failures = 0
+        entry.last_failure = None
+
+    def addRefused(self, server_url, assoc_type, session_type):
+        """Record the association and session type refused by the OP endpoint."""
+        entry = self._getEntry(server_url)
+        entry.refused.add((assoc_type, session_type))
+        if entry.supported == (assoc_type, session_type):
+            entry.supported = None
+
+    def addFailure(self, server_url):
+        """Record the failed negotiation."""
+        entry = self._getEntry(server_url)
+        entry.failures += 1
+        entry.last_failure = time.time()
+
+
+# Contains the currently set capability cache. If it is set to None,
+# the capabilities of OP endpoints are not remembered. Do not access
+# this variable outside of this module.
+_default_capability_cache = None
+
+
+def getDefaultCapabilityCache():
+    """Return the cache used by L{GenericConsumer} or C{None} if it isn't set.
+
+    @rtype: Optional[OPCapabilityCache]
+    """
+    return _default_capability_cache
+
+
+def setDefaultCapabilityCache(cache):
+    """Set the cache used by L{GenericConsumer}.
+
+    @param cache: The cache or C{None} to disable caching.
+    @type cache: Optional[OPCapabilityCache]
+    """
+    global _default_capability_cache
+    _default_capability_cache = cache
+
+
+class _CircuitState(object):
+    """State of the circuit of an OP endpoint."""
+
+    def __init__(self):
+        self.state = OPCircuitBreaker.CLOSED
+        # Number of consecutive failed negotiations
+        self.failures = 0
+        # Time when the circuit was opened or the last probe was allowed
+        self.changed = None
+        self.counters = {'successes': 0, 'failures': 0, 'rejections': 0, 'openings': 0}
+
+
+class OPCircuitBreaker(object):
+    """Circuit breaker for association negotiations with OP endpoints.
+
+    The circuit of an OP endpoint is closed while the negotiations
+    succeed. After C{failure_threshold} consecutive failed negotiations,
+    the circuit opens and the consumer uses the stateless mode without
+    any association request. After C{reset_timeout} seconds, the circuit
+    is half-open and a single negotiation probes the OP endpoint. The
+    circuit closes if the probe succeeds, otherwise it opens again.
+
+    Example::
+
+        setDefaultCircuitBreaker(OPCircuitBreaker())
+
+    @cvar CLOSED: The state in which negotiations are made.
+    @cvar OPEN: The state in which negotiations are not made.
+    @cvar HALF_OPEN: The state in which a single negotiation probes the OP endpoint.
+
+    @ivar failure_threshold: Number of consecutive failed negotiations which open the circuit.
+    @type failure_threshold: int
+
+    @ivar reset_timeout: Number of seconds after which an open circuit is probed.
+    @type reset_timeout: int
+
+    @ivar slow_threshold: Number of seconds after which a negotiation is
+        considered failed, even if it succeeded. If C{None}, the duration
+        of negotiations is not checked.
+    @type slow_threshold: Optional[float]
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, slow_threshold=None, max_size=1000):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_threshold = slow_threshold
+        self.cache = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def _getEntry(self, server_url):
+        entry = self.cache.get(server_url)
+        if entry is None:
+            entry = _CircuitState()
+            self.cache.set(server_url, entry)
+        return entry
+
+    def allowRequest(self, server_url):
+        """Return whether the negotiation with the OP endpoint may be attempted.
+
+        If the circuit is open for C{reset_timeout} seconds, it becomes
+        half-open and the caller is allowed to make the probe.
+
+        @rtype: bool
+        """
+        with self._lock:
+            entry = self.cache.get(server_url)
+            if entry is None or entry.state == self.CLOSED:
+                return True
+            # The probe is allowed again if the previous one didn't report its result in time.
+            if time.time() >= entry.changed + self.reset_timeout:
+                entry.state = self.HALF_OPEN
+                entry.changed = time.time()
+                return True
+            entry.counters['rejections'] += 1
+            return False
+
+    def addResult(self, server_url, success, duration=None):
+        """Record the result of the negotiation.
+
+        @param success: Whether the negotiation succeeded.
+        @type success: bool
+        @param duration: Number of seconds the negotiation took.
+        @type duration: Optional[float]
+        """
+        if success and self.slow_threshold is not None and duration is not None and duration > self.slow_threshold:
+            _LOGGER.info('Association with %s took %.3f seconds, counted as failure.', server_url, duration)
+            success = False
+        with self._lock:
+            entry = self._getEntry(server_url)
+            if success:
+                entry.counters['successes'] += 1
+                entry.state = self.CLOSED
+                entry.failures = 0
+                entry.changed = None
+                return
+            entry.counters['failures'] += 1
+            entry.failures += 1
+            if entry.state == self.HALF_OPEN or entry.failures >= self.failure_threshold:
+                if entry.state != self.OPEN:
+                    _LOGGER.warning('Circuit of %s is open after %d failed associations.', server_url,
+                                    entry.failures)
+                    entry.counters['openings'] += 1
+                entry.state = self.OPEN
+                entry.changed = time.time()
+
+    def getState(self, server_url):
+        """Return the state of the circuit of the OP endpoint.
+
+        @return: One of L{CLOSED}, L{OPEN} and L{HALF_OPEN}.
+        @rtype: six.text_type
+        """
+        entry = self.cache.get(server_url)
+        if entry is None:
+            return self.CLOSED
+        return entry.state
+
+    def getCounters(self, server_url):
+        """Return the counters of the OP endpoint.
+
+        @return: Numbers of successful and failed negotiations, of
+            negotiations rejected by the open circuit and of openings of
+            the circuit.
+        @rtype: Dict[six.text_type, int]
+        """
+        entry = self.cache.get(server_url)
+        if entry is None:
+            return _CircuitState().counters
+        with self._lock:
+            return dict(entry.counters)
+
+
+# Contains the currently set circuit breaker. If it is set to None,
+# association negotiations are not guarded. Do not access this
+# variable outside of this module.
+_default_circuit_breaker = None
+
+
+def getDefaultCircuitBreaker():
+    """Return the circuit breaker used by L{GenericConsumer} or C{None} if it isn't set.
+
+    @rtype: Optional[OPCircuitBreaker]
+    """
+    return _default_circuit_breaker
+
+
+def setDefaultCircuitBreaker(breaker):
+    """Set the circuit breaker used by L{GenericConsumer}.
+
+    @param breaker: The circuit breaker or C{None} to disable it.
+    @type breaker: Optional[OPCircuitBreaker]
+    """
+    global _default_circuit_breaker
+    _default_circuit_breaker = breaker
+
+
+class NonceReplayFilter(object):
+    """In-process filter of replayed response nonces.
+
+    The filter remembers nonces accepted by the store, so repeated
+    responses, e.g. double submitted callbacks, are rejected without
+    a store access. The store stays authoritative for nonces which are
+    not in the filter. Nonces are kept in buckets by their timestamps
+    and the buckets older than C{skew} seconds are dropped, as the store
+    rejects such nonces anyway.
+
+    Example::
+
+        setDefaultReplayFilter(NonceReplayFilter())
+
+    @ivar skew: Number of seconds for which the nonces are remembered.
+    @type skew: int
+
+    @ivar bucket_size: Number of seconds of nonce timestamps in a bucket.
+    @type bucket_size: int
+
+    @ivar replays: Number of nonces rejected by the filter.
+    @type replays: int
+    """
+
+    def __init__(self, skew=SKEW, bucket_size=60):
+        self.skew = skew
+        self.bucket_size = bucket_size
+        self.replays = 0
+        self._buckets = {}
+        self._oldest_bucket = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def _evict(self, now):
+        oldest_bucket = (now - self.skew) // self.bucket_size
+        if self._oldest_bucket is not None and oldest_bucket <= self._oldest_bucket:
+            return
+        for key in [k for k in self._buckets if k < oldest_bucket]:
+            del self._buckets[key]
+        self._oldest_bucket = oldest_bucket
+
+    def isReplayed(self, server_url, timestamp, salt):
+        """Return whether the nonce was already accepted.
+
+        @rtype: bool
+        """
+        with self._lock:
+            bucket = self._buckets.get(timestamp // self.bucket_size)
+            if bucket is not None and (server_url, timestamp, salt) in bucket:
+                self.replays += 1
+                return True
+            return False
+
+    def add(self, server_url, timestamp, salt):
+        """Remember the nonce accepted by the store."""
+        now = int(time.time())
+        if timestamp < now - self.skew:
+            return
+        with self._lock:
+            self._evict(now)
+            self._buckets.setdefault(timestamp // self.bucket_size, set()).add((server_url, timestamp, salt))
+
+
+# Contains the currently set replay filter. If it is set to None, all
+# nonces are checked by the store. Do not access this variable outside
+# of this module.
+_default_replay_filter = None
+
+
+def getDefaultReplayFilter():
+    """Return the replay filter used by L{GenericConsumer} or C{None} if it isn't set.
+
+    @rtype: Optional[NonceReplayFilter]
+    """
+    return _default_replay_filter
+
+
+def setDefaultReplayFilter(replay_filter):
+    """Set the replay filter used by L{GenericConsumer}.
+
+    @param replay_filter: The replay filter or C{None} to disable it.
+    @type replay_filter: Optional[NonceReplayFilter]
+    """
+    global _default_replay_filter
+    _default_replay_filter = replay_filter
+
+
 class GenericConsumer(object):
     """This is the implementation of the common logic for OpenID
     consumers. It is unaware of the application in which it is
@@ -574,6 +1055,31 @@ class GenericConsumer(object):
         different negotiator to it if you have specific requirements
         for how associations are made.
     @type negotiator: C{L{openid.association.SessionNegotiator}}
+
+    @ivar association_manager: Manager which negotiates associations in
+        the background, if set the consumer never makes association
+        requests itself.
+    @type association_manager: Optional[L{AssociationManager<openid.consumer.assocmanager.AssociationManager>}]
+
+    @ivar association_wait: Whether to wait for the association which is
+        negotiated by another thread. If C{False}, the stateless mode is
+        used until the association is ready.
+    @type association_wait: bool
+
+    @ivar association_lease: Number of seconds of the lease of the
+        association negotiation, which is shared by processes through
+        the store, see
+        L{OpenIDStore.acquireLease<openid.store.interface.OpenIDStore.acquireLease>}.
+        Only the process which holds the lease negotiates the association
+        with an OP endpoint, other processes use the stateless mode
+        meanwhile. The lease is released if the negotiation fails. If
+        C{None}, the negotiations are coalesced only within the process.
+    @type association_lease: Optional[int]
+
+    @ivar fetcher: The fetcher for direct requests to OpenID providers,
+        i.e. association and check_authentication requests. The default
+        fetcher is used if C{None}.
+    @type fetcher: Optional[L{openid.fetchers.HTTPFetcher}]
     """
 
     # The name of the query parameter that gets added to the return_to
@@ -597,9 +1103,18 @@ class GenericConsumer(object):
 
     _discover = staticmethod(discover)
 
-    def __init__(self, store):
+    association_manager = None
+    fetcher = None
+    association_wait = True
+    association_lease = None
+
+    # Negotiations of associations in progress, shared by all consumers in the process
+    _negotiations = SingleFlight()
+
+    def __init__(self, store, association_manager=None):
         self.store = store
         self.negotiator = default_negotiator.copy()
+        self.association_manager = association_manager
 
     def begin(self, service_endpoint):
         """Create an AuthRequest object for the specified
@@ -609,7 +1124,10 @@ class GenericConsumer(object):
             assoc = None
         else:
             assoc = self._getAssociation(service_endpoint)
+        return self._createAuthRequest(service_endpoint, assoc)
 
+    def _createAuthRequest(self, service_endpoint, assoc):
+        """Create an AuthRequest object for the service_endpoint and association."""
         request = AuthRequest(service_endpoint, assoc)
         request.return_to_args[self.openid1_nonce_query_arg_name] = mkNonce()
 
@@ -650,15 +1168,20 @@ class GenericConsumer(object):
         return SetupNeededResponse(endpoint, user_setup_url)
 
     def _complete_id_res(self, message, endpoint, return_to):
+        return _runSteps(self._iterCompleteIdRes(message, endpoint, return_to))
+
+    def _iterCompleteIdRes(self, message, endpoint, return_to):
+        """Steps of L{_complete_id_res}, see L{_Call}."""
         try:
             self._checkSetupNeeded(message)
         except SetupNeededError as why:
-            return SetupNeededResponse(endpoint, why.user_setup_url)
+            response = SetupNeededResponse(endpoint, why.user_setup_url)
         else:
             try:
-                return self._doIdRes(message, endpoint, return_to)
+                response = yield _Call(self._doIdRes, message, endpoint, return_to)
             except (ProtocolError, DiscoveryFailure) as why:
-                return FailureResponse(endpoint, six.text_type(why))
+                response = FailureResponse(endpoint, six.text_type(why))
+        yield response
 
     def _completeInvalid(self, message, endpoint, _):
         mode = message.getArg(OPENID_NS, 'mode', '<No mode set>')
@@ -694,7 +1217,8 @@ class GenericConsumer(object):
 
         return True
 
-    _makeKVPost = staticmethod(makeKVPost)
+    def _makeKVPost(self, request_message, server_url):
+        return makeKVPost(request_message, server_url, self.fetcher)
 
     def _checkSetupNeeded(self, message):
         """Check an id_res message to see if it is a
@@ -729,6 +1253,10 @@ class GenericConsumer(object):
 
         @returntype: L{Response}
         """
+        return _runSteps(self._iterDoIdRes(message, endpoint, return_to))
+
+    def _iterDoIdRes(self, message, endpoint, return_to):
+        """Steps of L{_doIdRes}, see L{_Call}."""
         # Checks for presence of appropriate fields (and checks
         # signed list fields)
         self._idResCheckForFields(message)
@@ -739,19 +1267,19 @@ class GenericConsumer(object):
                 % (return_to, message.getArg(OPENID_NS, 'return_to')))
 
         # Verify discovery information:
-        endpoint = self._verifyDiscoveryResults(message, endpoint)
+        endpoint = yield _Call(self._verifyDiscoveryResults, message, endpoint)
         _LOGGER.info("Received id_res response from %s using association %s",
                      endpoint.server_url, message.getArg(OPENID_NS, 'assoc_handle'))
 
-        self._idResCheckSignature(message, endpoint.server_url)
+        yield _Call(self._idResCheckSignature, message, endpoint.server_url)
 
         # Will raise a ProtocolError if the nonce is bad
-        self._idResCheckNonce(message, endpoint)
+        yield _Call(self._idResCheckNonce, message, endpoint)
 
         signed_list_str = message.getArg(OPENID_NS, 'signed', no_default)
         signed_list = signed_list_str.split(',')
         signed_fields = ["openid." + s for s in signed_list]
-        return SuccessResponse(endpoint, message, signed_fields)
+        yield SuccessResponse(endpoint, message, signed_fields)
 
     def _idResGetNonceOpenID1(self, message, endpoint):
         """Extract the nonce from an OpenID 1 response.  Return the
@@ -766,6 +1294,28 @@ class GenericConsumer(object):
         return message.getArg(BARE_NS, self.openid1_nonce_query_arg_name)
 
     def _idResCheckNonce(self, message, endpoint):
+        return _runSteps(self._iterIdResCheckNonce(message, endpoint))
+
+    def _iterIdResCheckNonce(self, message, endpoint):
+        """Steps of L{_idResCheckNonce}, see L{_Call}."""
+        server_url, timestamp, salt = self._idResGetNonce(message, endpoint)
+        if self.store is None:
+            yield None
+            return
+        replay_filter = getDefaultReplayFilter()
+        if replay_filter is not None and replay_filter.isReplayed(server_url, timestamp, salt):
+            raise ProtocolError('Nonce already used or out of range')
+        if not (yield _Call(self.store.useNonce, server_url, timestamp, salt)):
+            raise ProtocolError('Nonce already used or out of range')
+        if replay_filter is not None:
+            replay_filter.add(server_url, timestamp, salt)
+        yield None
+
+    def _idResGetNonce(self, message, endpoint):
+        """Return the server URL, timestamp and salt of the response nonce.
+
+        @raises ProtocolError: If the nonce is missing or malformed.
+        """
         if message.isOpenID1():
             # This indicates that the nonce was generated by the consumer
             nonce = self._idResGetNonceOpenID1(message, endpoint)
@@ -781,37 +1331,44 @@ class GenericConsumer(object):
             timestamp, salt = splitNonce(nonce)
         except ValueError as why:
             raise ProtocolError('Malformed nonce: %s' % six.text_type(why))
-
-        if (self.store is not None and not self.store.useNonce(server_url, timestamp, salt)):
-            raise ProtocolError('Nonce already used or out of range')
+        return server_url, timestamp, salt
 
     def _idResCheckSignature(self, message, server_url):
+        return _runSteps(self._iterIdResCheckSignature(message, server_url))
+
+    def _iterIdResCheckSignature(self, message, server_url):
+        """Steps of L{_idResCheckSignature}, see L{_Call}."""
         assoc_handle = message.getArg(OPENID_NS, 'assoc_handle')
         if self.store is None:
             assoc = None
         else:
-            assoc = self.store.getAssociation(server_url, assoc_handle)
+            assoc = yield _Call(self.store.getAssociation, server_url, assoc_handle)
 
         if assoc:
-            if assoc.getExpiresIn() <= 0:
-                # XXX: It might be a good idea sometimes to re-start the
-                # authentication with a new association. Doing it
-                # automatically opens the possibility for
-                # denial-of-service by a server that just returns expired
-                # associations (or really short-lived associations)
-                raise ProtocolError(
-                    'Association with %s expired' % (server_url,))
-
-            if not assoc.checkMessageSignature(message):
-                raise ProtocolError('Bad signature')
-
+            self._idResCheckAssociationSignature(message, server_url, assoc)
         else:
             # It's not an association we know about.  Stateless mode is our
             # only possible path for recovery.
-            # XXX - async framework will not want to block on this call to
-            # _checkAuth.
-            if not self._checkAuth(message, server_url):
+            if not (yield _Call(self._checkAuth, message, server_url)):
                 raise ProtocolError('Server denied check_authentication')
+        yield None
+
+    def _idResCheckAssociationSignature(self, message, server_url, assoc):
+        """Check the signature of the message by the association.
+
+        @raises ProtocolError: If the association is expired or the signature is bad.
+        """
+        if assoc.getExpiresIn() <= 0:
+            # XXX: It might be a good idea sometimes to re-start the
+            # authentication with a new association. Doing it
+            # automatically opens the possibility for
+            # denial-of-service by a server that just returns expired
+            # associations (or really short-lived associations)
+            raise ProtocolError(
+                'Association with %s expired' % (server_url,))
+
+        if not assoc.checkMessageSignature(message):
+            raise ProtocolError('Bad signature')
 
     def _idResCheckForFields(self, message):
         # XXX: this should be handled by the code that processes the
@@ -888,36 +1445,29 @@ class GenericConsumer(object):
 
         @returns: the verified endpoint
         """
+        return _runSteps(self._iterVerifyDiscoveryResults(resp_msg, endpoint))
+
+    def _iterVerifyDiscoveryResults(self, resp_msg, endpoint):
+        """Steps of L{_verifyDiscoveryResults}, see L{_Call}."""
         if resp_msg.getOpenIDNamespace() == OPENID2_NS:
-            return self._verifyDiscoveryResultsOpenID2(resp_msg, endpoint)
+            endpoint = yield _Call(self._verifyDiscoveryResultsOpenID2, resp_msg, endpoint)
         else:
-            return self._verifyDiscoveryResultsOpenID1(resp_msg, endpoint)
+            endpoint = yield _Call(self._verifyDiscoveryResultsOpenID1, resp_msg, endpoint)
+        yield endpoint
 
     def _verifyDiscoveryResultsOpenID2(self, resp_msg, endpoint):
-        to_match = OpenIDServiceEndpoint()
-        to_match.type_uris = [OPENID_2_0_TYPE]
-        to_match.claimed_id = resp_msg.getArg(OPENID2_NS, 'claimed_id')
-        to_match.local_id = resp_msg.getArg(OPENID2_NS, 'identity')
-
-        # Raises a KeyError when the op_endpoint is not present
-        to_match.server_url = resp_msg.getArg(
-            OPENID2_NS, 'op_endpoint', no_default)
-
-        # claimed_id and identifier must both be present or both
-        # be absent
-        if (to_match.claimed_id is None and to_match.local_id is not None):
-            raise ProtocolError(
-                'openid.identity is present without openid.claimed_id')
+        return _runSteps(self._iterVerifyDiscoveryResultsOpenID2(resp_msg, endpoint))
 
-        elif (to_match.claimed_id is not None and to_match.local_id is None):
-            raise ProtocolError(
-                'openid.claimed_id is present without openid.identity')
+    def _iterVerifyDiscoveryResultsOpenID2(self, resp_msg, endpoint):
+        """Steps of L{_verifyDiscoveryResultsOpenID2}, see L{_Call}."""
+        to_match = self._getOpenID2ToMatch(resp_msg)
 
         # This is a response without identifiers, so there's really no
         # checking that we can do, so return an endpoint that's for
         # the specified `openid.op_endpoint'
-        elif to_match.claimed_id is None:
-            return OpenIDServiceEndpoint.fromOPEndpointURL(to_match.server_url)
+        if to_match.claimed_id is None:
+            yield OpenIDServiceEndpoint.fromOPEndpointURL(to_match.server_url)
+            return
 
         # The claimed ID doesn't match, so we have to do discovery
         # again. This covers not using sessions, OP identifier
@@ -925,7 +1475,7 @@ class GenericConsumer(object):
         # request.
         if not endpoint:
             _LOGGER.info('No pre-discovered information supplied.')
-            endpoint = self._discoverAndVerify(to_match.claimed_id, [to_match])
+            endpoint = yield _Call(self._discoverAndVerify, to_match.claimed_id, [to_match])
         else:
             # The claimed ID matches, so we use the endpoint that we
             # discovered in initiation. This should be the most common
@@ -935,9 +1485,37 @@ class GenericConsumer(object):
             except ProtocolError as e:
                 _LOGGER.info("Unable to use stored discovery information: %s", e)
                 _LOGGER.info("Attempting discovery to verify endpoint")
-                endpoint = self._discoverAndVerify(
-                    to_match.claimed_id, [to_match])
+                endpoint = yield _Call(self._discoverAndVerify, to_match.claimed_id, [to_match])
+
+        yield self._getVerifiedEndpoint(endpoint, to_match)
+
+    def _getOpenID2ToMatch(self, resp_msg):
+        """Return the endpoint from the information in the OpenID 2 response.
+
+        @raises ProtocolError: If the claimed ID or the identity is missing.
+        """
+        to_match = OpenIDServiceEndpoint()
+        to_match.type_uris = [OPENID_2_0_TYPE]
+        to_match.claimed_id = resp_msg.getArg(OPENID2_NS, 'claimed_id')
+        to_match.local_id = resp_msg.getArg(OPENID2_NS, 'identity')
+
+        # Raises a KeyError when the op_endpoint is not present
+        to_match.server_url = resp_msg.getArg(
+            OPENID2_NS, 'op_endpoint', no_default)
+
+        # claimed_id and identifier must both be present or both
+        # be absent
+        if (to_match.claimed_id is None and to_match.local_id is not None):
+            raise ProtocolError(
+                'openid.identity is present without openid.claimed_id')
+
+        elif (to_match.claimed_id is not None and to_match.local_id is None):
+            raise ProtocolError(
+                'openid.claimed_id is present without openid.identity')
+        return to_match
 
+    def _getVerifiedEndpoint(self, endpoint, to_match):
+        """Return the verified endpoint with the claimed ID from the response."""
         # The endpoint we return should have the claimed ID from the
         # message we just verified, fragment and all.
         if endpoint.claimed_id != to_match.claimed_id:
@@ -946,6 +1524,22 @@ class GenericConsumer(object):
         return endpoint
 
     def _verifyDiscoveryResultsOpenID1(self, resp_msg, endpoint):
+        return _runSteps(self._iterVerifyDiscoveryResultsOpenID1(resp_msg, endpoint))
+
+    def _iterVerifyDiscoveryResultsOpenID1(self, resp_msg, endpoint):
+        """Steps of L{_verifyDiscoveryResultsOpenID1}, see L{_Call}."""
+        claimed_id, to_match, to_match_1_0 = self._getOpenID1ToMatch(resp_msg, endpoint)
+
+        if endpoint is None or not self._verifyStoredEndpointOpenID1(endpoint, to_match, to_match_1_0):
+            # Endpoint is either bad (failed verification) or None
+            endpoint = yield _Call(self._discoverAndVerify, claimed_id, [to_match, to_match_1_0])
+        yield endpoint
+
+    def _getOpenID1ToMatch(self, resp_msg, endpoint):
+        """Return the claimed ID and the endpoints from the information in the OpenID 1 response.
+
+        @raises ProtocolError: If the identity is missing.
+        """
         claimed_id = resp_msg.getArg(BARE_NS, self.openid1_return_to_identifier_name)
 
         if endpoint is None and claimed_id is None:
@@ -968,21 +1562,20 @@ class GenericConsumer(object):
 
         to_match_1_0 = copy.copy(to_match)
         to_match_1_0.type_uris = [OPENID_1_0_TYPE]
+        return claimed_id, to_match, to_match_1_0
 
-        if endpoint is not None:
+    def _verifyStoredEndpointOpenID1(self, endpoint, to_match, to_match_1_0):
+        """Return whether the endpoint from the session matches the OpenID 1 response."""
+        try:
             try:
-                try:
-                    self._verifyDiscoverySingle(endpoint, to_match)
-                except TypeURIMismatch:
-                    self._verifyDiscoverySingle(endpoint, to_match_1_0)
-            except ProtocolError as e:
-                _LOGGER.info("Unable to use stored discovery information: %s", e)
-                _LOGGER.info("Attempting discovery to verify endpoint")
-            else:
-                return endpoint
-
-        # Endpoint is either bad (failed verification) or None
-        return self._discoverAndVerify(claimed_id, [to_match, to_match_1_0])
+                self._verifyDiscoverySingle(endpoint, to_match)
+            except TypeURIMismatch:
+                self._verifyDiscoverySingle(endpoint, to_match_1_0)
+        except ProtocolError as e:
+            _LOGGER.info("Unable to use stored discovery information: %s", e)
+            _LOGGER.info("Attempting discovery to verify endpoint")
+            return False
+        return True
 
     def _verifyDiscoverySingle(self, endpoint, to_match):
         """Verify that the given endpoint matches the information
@@ -1047,13 +1640,31 @@ class GenericConsumer(object):
 
         @raises DiscoveryFailure: when discovery fails.
         """
+        return _runSteps(self._iterDiscoverAndVerify(claimed_id, to_match_endpoints))
+
+    def _iterDiscoverAndVerify(self, claimed_id, to_match_endpoints):
+        """Steps of L{_discoverAndVerify}, see L{_Call}."""
         _LOGGER.info('Performing discovery on %s', claimed_id)
-        _, services = self._discover(claimed_id)
+        _, services = yield _Call(self._discover, claimed_id)
         if not services:
             raise DiscoveryFailure('No OpenID information found at %s' %
                                    (claimed_id,), None)
-        return self._verifyDiscoveredServices(claimed_id, services,
-                                              to_match_endpoints)
+        try:
+            endpoint = self._verifyDiscoveredServices(claimed_id, services,
+                                                      to_match_endpoints)
+        except DiscoveryFailure:
+            # The services may come from the discovery cache and be stale,
+            # discover them again.
+            cache = getDefaultDiscoveryCache()
+            if cache is None or not cache.invalidate(claimed_id):
+                raise
+        else:
+            yield endpoint
+            return
+        _LOGGER.info('Performing discovery on %s without cache', claimed_id)
+        _, services = yield _Call(self._discover, claimed_id)
+        yield self._verifyDiscoveredServices(claimed_id, services,
+                                             to_match_endpoints)
 
     def _verifyDiscoveredServices(self, claimed_id, services, to_match_endpoints):
         """See @L{_discoverAndVerify}"""
@@ -1087,17 +1698,23 @@ class GenericConsumer(object):
         @returns: True if the request is valid.
         @rtype: bool
         """
+        return _runSteps(self._iterCheckAuth(message, server_url))
+
+    def _iterCheckAuth(self, message, server_url):
+        """Steps of L{_checkAuth}, see L{_Call}."""
         _LOGGER.info('Using OpenID check_authentication')
         request = self._createCheckAuthRequest(message)
         if request is None:
-            return False
+            yield False
+            return
         try:
-            response = self._makeKVPost(request, server_url)
+            response = yield _Call(self._makeKVPost, request, server_url)
         except (fetchers.HTTPFetchingError, ServerError) as e:
             _LOGGER.info('check_authentication failed: %s', e)
-            return False
+            valid = False
         else:
-            return self._processCheckAuthResponse(response, server_url)
+            valid = yield _Call(self._processCheckAuthResponse, response, server_url)
+        yield valid
 
     def _createCheckAuthRequest(self, message):
         """Generate a check_authentication request message given an
@@ -1122,17 +1739,23 @@ class GenericConsumer(object):
         """Process the response message from a check_authentication
         request, invalidating associations if requested.
         """
-        is_valid = response.getArg(OPENID_NS, 'is_valid', 'false')
+        return _runSteps(self._iterProcessCheckAuthResponse(response, server_url))
 
+    def _iterProcessCheckAuthResponse(self, response, server_url):
+        """Steps of L{_processCheckAuthResponse}, see L{_Call}."""
         invalidate_handle = response.getArg(OPENID_NS, 'invalidate_handle')
         if invalidate_handle is not None:
             _LOGGER.info('Received "invalidate_handle" from server %s', server_url)
             if self.store is None:
                 _LOGGER.warning('Unexpectedly got invalidate_handle without a store!')
             else:
-                self.store.removeAssociation(server_url, invalidate_handle)
+                yield _Call(self.store.removeAssociation, server_url, invalidate_handle)
+
+        yield self._isCheckAuthValid(response)
 
-        if is_valid == 'true':
+    def _isCheckAuthValid(self, response):
+        """Return whether the check_authentication response confirms the message."""
+        if response.getArg(OPENID_NS, 'is_valid', 'false') == 'true':
             return True
         else:
             _LOGGER.info('Server responds that checkAuth call is not valid')
@@ -1143,22 +1766,72 @@ class GenericConsumer(object):
 
         First try seeing if we have a good association in the
         store. If we do not, then attempt to negotiate an association
-        with the server.
+        with the server. Only one association with the server is
+        negotiated at a time, concurrent callers wait for its result.
 
         If we negotiate a good association, it will get stored.
 
+        If the association manager is set, the association is only
+        taken from the store and the manager negotiates the new
+        associations in the background.
+
         @returns: A valid association for the endpoint's server_url or None
         @rtype: openid.association.Association or NoneType
         """
+        if self.association_manager is not None:
+            return self.association_manager.getAssociation(endpoint)
+
         assoc = self.store.getAssociation(endpoint.server_url)
 
         if assoc is None or assoc.expiresIn <= 0:
-            assoc = self._negotiateAssociation(endpoint)
-            if assoc is not None:
-                self.store.storeAssociation(endpoint.server_url, assoc)
+            key = (_StoreKey(self.store), endpoint.server_url)
+            if not self.association_wait and self._negotiations.isRunning(key):
+                _LOGGER.info('Association with %s is being negotiated, using stateless mode.', endpoint.server_url)
+                return None
+            assoc = self._negotiations.call(key, self._createAssociation, endpoint)
 
         return assoc
 
+    def _createAssociation(self, endpoint):
+        """Negotiate a new association with the server and store it.
+
+        @returns: A valid association for the endpoint's server_url or None
+        @rtype: openid.association.Association or NoneType
+        """
+        return _runSteps(self._iterCreateAssociation(endpoint))
+
+    def _iterCreateAssociation(self, endpoint):
+        """Steps of L{_createAssociation}, see L{_Call}."""
+        # The association may have been just stored by the previous negotiation.
+        assoc = yield _Call(self.store.getAssociation, endpoint.server_url)
+        if assoc is not None and assoc.expiresIn > 0:
+            yield assoc
+            return
+
+        lease = None
+        if self.association_lease is not None:
+            lease = yield _Call(self.store.acquireLease, endpoint.server_url, self.association_lease)
+            if lease is None:
+                _LOGGER.info('Association with %s is being negotiated by another process, using stateless mode.',
+                             endpoint.server_url)
+                yield None
+                return
+
+        error = None
+        try:
+            assoc = yield _Call(self._negotiateAssociation, endpoint)
+            if assoc is not None:
+                yield _Call(self.store.storeAssociation, endpoint.server_url, assoc)
+        except Exception:
+            assoc = None
+            error = sys.exc_info()
+        # The lease of the stored association is kept until it expires, so other processes use the association.
+        if lease is not None and assoc is None:
+            yield _Call(self.store.releaseLease, endpoint.server_url, lease)
+        if error is not None:
+            six.reraise(*error)
+        yield assoc
+
     def _negotiateAssociation(self, endpoint):
         """Make association requests to the server, attempting to
         create a new association.
@@ -1167,34 +1840,64 @@ class GenericConsumer(object):
 
         @rtype: L{openid.association.Association}
         """
-        # Get our preferred session/association type from the negotiatior.
-        assoc_type, session_type = self.negotiator.getAllowedType()
-
+        return _runSteps(self._iterNegotiateAssociation(endpoint))
+
+    def _iterNegotiateAssociation(self, endpoint):
+        """Steps of L{_negotiateAssociation}, see L{_Call}."""
+        # Check the backoff first, the circuit breaker lets the caller probe the OP endpoint.
+        capabilities = getDefaultCapabilityCache()
+        if capabilities is not None and capabilities.isBackingOff(endpoint.server_url):
+            _LOGGER.info('Association with %s failed recently, using stateless mode.', endpoint.server_url)
+            yield None
+            return
+        breaker = getDefaultCircuitBreaker()
+        if breaker is not None and not breaker.allowRequest(endpoint.server_url):
+            _LOGGER.info('Circuit of %s is open, using stateless mode.', endpoint.server_url)
+            yield None
+            return
+        start = time.time()
+
+        assoc = None
         try:
-            assoc = self._requestAssociation(
-                endpoint, assoc_type, session_type)
-        except ServerError as why:
-            supportedTypes = self._extractSupportedAssociationType(why,
-                                                                   endpoint,
-                                                                   assoc_type)
-            if supportedTypes is not None:
-                assoc_type, session_type = supportedTypes
-                # Attempt to create an association from the assoc_type
-                # and session_type that the server told us it
-                # supported.
-                try:
-                    assoc = self._requestAssociation(
-                        endpoint, assoc_type, session_type)
-                except ServerError:
-                    # Do not keep trying, since it rejected the
-                    # association type that it told us to use.
-                    _LOGGER.error('Server %s refused its suggested association type: session_type=%s, assoc_type=%s',
-                                  endpoint.server_url, session_type, assoc_type)
-                    return None
+            if capabilities is None:
+                # Get our preferred session/association type from the negotiatior.
+                assoc_type, session_type = self.negotiator.getAllowedType()
+            else:
+                # Get the session/association type which works with the server.
+                assoc_type, session_type = capabilities.getPreferredType(endpoint.server_url, self.negotiator)
+
+            try:
+                assoc = yield _Call(self._requestAssociation, endpoint, assoc_type, session_type)
+            except ServerError as why:
+                if capabilities is not None and why.error_code == 'unsupported-type':
+                    capabilities.addRefused(endpoint.server_url, assoc_type, session_type)
+                supportedTypes = self._extractSupportedAssociationType(why,
+                                                                       endpoint,
+                                                                       assoc_type)
+                if supportedTypes is not None:
+                    assoc_type, session_type = supportedTypes
+                    # Attempt to create an association from the assoc_type
+                    # and session_type that the server told us it
+                    # supported.
+                    try:
+                        assoc = yield _Call(self._requestAssociation, endpoint, assoc_type, session_type)
+                    except ServerError:
+                        # Do not keep trying, since it rejected the
+                        # association type that it told us to use.
+                        _LOGGER.error('Server %s refused its suggested association type: session_type=%s, '
+                                      'assoc_type=%s', endpoint.server_url, session_type, assoc_type)
+                        if capabilities is not None:
+                            capabilities.addRefused(endpoint.server_url, assoc_type, session_type)
+        finally:
+            # Report the result even if the negotiation raised an error, the breaker waits for it.
+            if capabilities is not None:
+                if assoc is None:
+                    capabilities.addFailure(endpoint.server_url)
                 else:
-                    return assoc
-        else:
-            return assoc
+                    capabilities.addSupported(endpoint.server_url, assoc_type, session_type)
+            if breaker is not None:
+                breaker.addResult(endpoint.server_url, assoc is not None, time.time() - start)
+        yield assoc
 
     def _extractSupportedAssociationType(self, server_error, endpoint,
                                          assoc_type):
@@ -1241,25 +1944,28 @@ class GenericConsumer(object):
 
         @raises ServerError: when the remote OpenID server returns an error.
         """
-        assoc_session, args = self._createAssociateRequest(
-            endpoint, assoc_type, session_type)
+        return _runSteps(self._iterRequestAssociation(endpoint, assoc_type, session_type))
+
+    def _iterRequestAssociation(self, endpoint, assoc_type, session_type):
+        """Steps of L{_requestAssociation}, see L{_Call}."""
+        assoc_session, args = yield _Call(self._createAssociateRequest, endpoint, assoc_type, session_type)
 
         try:
-            response = self._makeKVPost(args, endpoint.server_url)
+            response = yield _Call(self._makeKVPost, args, endpoint.server_url)
         except fetchers.HTTPFetchingError as why:
             _LOGGER.warning('openid.associate request failed: %s', why)
-            return None
+            yield None
+            return
 
         try:
-            assoc = self._extractAssociation(response, assoc_session)
+            assoc = yield _Call(self._extractAssociation, response, assoc_session)
         except KeyError as why:
             _LOGGER.exception('Missing required parameter in response from %s: %s', endpoint.server_url, why)
-            return None
+            assoc = None
         except ProtocolError as why:
             _LOGGER.exception('Protocol error parsing response from %s: %s', endpoint.server_url, why)
-            return None
-        else:
-            return assoc
+            assoc = None
+        yield assoc
 
     def _createAssociateRequest(self, endpoint, assoc_type, session_type):
         """Create an association request for the given assoc_type and
@@ -1,7 +1,11 @@
 """Functions to discover OpenID endpoints from identifiers."""
 from __future__ import unicode_literals
 
+import json
 import logging
+import math
+import time
+from hashlib import sha256
 
 import six
 from lxml.etree import LxmlError
@@ -9,15 +13,18 @@ from lxml.html import document_fromstring
 from six.moves.urllib.parse import urldefrag, urlparse
 
 from openid import fetchers, urinorm
+from openid.cache import LRUCache, SingleFlight, copyException, getHTTPExpiration
 from openid.message import OPENID1_NS as OPENID_1_0_MESSAGE_NS, OPENID2_NS as OPENID_2_0_MESSAGE_NS
 from openid.oidutil import string_to_text
 from openid.yadis import filters, xri, xrires
 from openid.yadis.discover import DiscoveryFailure, discover as yadisDiscover
 from openid.yadis.etxrd import XRD_NS_2_0, XRDSError, nsTag
-from openid.yadis.services import applyFilter as extractServices
+from openid.yadis.services import applyFilter as extractServices, getXRDSEndpointsExpiration
 
 __all__ = [
+    'DiscoveryCache',
     'DiscoveryFailure',
+    'MemcachedDiscoveryBackend',
     'OPENID_1_0_NS',
     'OPENID_1_0_TYPE',
     'OPENID_1_1_TYPE',
@@ -25,6 +32,8 @@ __all__ = [
     'OPENID_IDP_2_0_TYPE',
     'OpenIDServiceEndpoint',
     'discover',
+    'getDefaultDiscoveryCache',
+    'setDefaultDiscoveryCache',
 ]
 
 _LOGGER = logging.getLogger(__name__)
@@ -55,6 +64,9 @@ class OpenIDServiceEndpoint(object):
         OPENID_1_0_TYPE,
     ]
 
+    # Version of the compact session data format
+    session_data_version = 1
+
     def __init__(self):
         self.claimed_id = None
         self.server_url = None
@@ -124,6 +136,43 @@ class OpenIDServiceEndpoint(object):
         else:
             return self.local_id or self.canonicalID
 
+    def toSessionData(self):
+        """Return the compact representation of this endpoint for a session.
+
+        The representation is a list of strings, numbers and booleans, so
+        any session backend can store it, including JSON based ones. The
+        OpenID type URIs are replaced by their index in L{openid_type_uris}.
+
+        @rtype: list
+        """
+        type_uris = [self.openid_type_uris.index(t) if t in self.openid_type_uris else t for t in self.type_uris]
+        data = [self.session_data_version, self.server_url, self.claimed_id, type_uris, self.local_id,
+                self.canonicalID, self.used_yadis, self.display_identifier]
+        # Trailing empty values are left out.
+        while data[-1] is None or data[-1] is False:
+            data.pop()
+        return data
+
+    @classmethod
+    def fromSessionData(cls, data):
+        """Create an endpoint from its compact representation.
+
+        @see: L{toSessionData}
+        @raises ValueError: If the data are not in a supported format.
+        """
+        if not isinstance(data, (list, tuple)) or not 4 <= len(data) <= 8 or data[0] != cls.session_data_version:
+            raise ValueError('Unsupported session data of endpoint: %r' % (data,))
+        data = list(data) + [None] * (8 - len(data))
+        self = cls()
+        (_, self.server_url, self.claimed_id, type_uris, self.local_id, self.canonicalID, used_yadis,
+         self.display_identifier) = data
+        try:
+            self.type_uris = [self.openid_type_uris[t] if isinstance(t, int) else t for t in type_uris]
+        except (IndexError, TypeError):
+            raise ValueError('Unsupported session data of endpoint: %r' % (data,))
+        self.used_yadis = bool(used_yadis)
+        return self
+
     @classmethod
     def fromBasicServiceEndpoint(cls, endpoint):
         """Create a new instance of this class from the endpoint
@@ -378,16 +427,40 @@ def discoverYadis(uri):
     @raises DiscoveryFailure: when discovery fails.
     """
     uri = string_to_text(uri, "Binary values for discoverYadis are deprecated. Use text input instead.")
+    return _discoverYadisExpiration(uri)[:2]
+
+
+def _discoverYadisExpiration(uri):
+    """Discover OpenID services for a URI and return them with their expiration.
+
+    @rtype: (six.text_type, list(OpenIDServiceEndpoint), Optional[float])
+    """
     # Might raise a yadis.discover.DiscoveryFailure if no document
     # came back for that URI at all.  I don't think falling back
     # to OpenID 1.0 discovery on the same URL will help, so don't
     # bother to catch it.
     response = yadisDiscover(uri)
+    result = _getYadisServices(response)
+    if result is None:
+        # if we got the Yadis content-type or followed the Yadis
+        # header, re-fetch the document without following the Yadis
+        # header, with no Accept header.
+        return _discoverNoYadisExpiration(uri)
+    return result
 
+
+def _getYadisServices(response):
+    """Return OpenID services from the result of Yadis discovery with their expiration.
+
+    @type response: L{openid.yadis.discover.DiscoveryResult}
+    @return: (claimed_id, services, expires) or C{None} if the document needs to be fetched without Yadis.
+    @rtype: Optional[(six.text_type, list(OpenIDServiceEndpoint), Optional[float])]
+    """
     yadis_url = response.normalized_uri
     body = response.response_text
     try:
-        openid_services = OpenIDServiceEndpoint.fromXRDS(yadis_url, body)
+        openid_services, expires = getXRDSEndpointsExpiration(
+            yadis_url, body, response.headers, OpenIDServiceEndpoint)
     except XRDSError:
         # Does not parse as a Yadis XRDS file
         openid_services = []
@@ -396,25 +469,35 @@ def discoverYadis(uri):
         # Either not an XRDS or there are no OpenID services.
 
         if response.isXRDS():
-            # if we got the Yadis content-type or followed the Yadis
-            # header, re-fetch the document without following the Yadis
-            # header, with no Accept header.
-            return discoverNoYadis(uri)
+            return None
 
         # Try to parse the response as HTML.
         # <link rel="...">
         openid_services = OpenIDServiceEndpoint.fromHTML(yadis_url, body)
+        expires = getHTTPExpiration(response.headers)
 
-    return (yadis_url, getOPOrUserServices(openid_services))
+    return (yadis_url, getOPOrUserServices(openid_services), expires)
 
 
 def discoverXRI(iname):
-    endpoints = []
     iname = normalizeXRI(iname)
     try:
         canonicalID, services = xrires.ProxyResolver().query(
             iname, OpenIDServiceEndpoint.openid_type_uris)
+    except XRDSError:
+        _LOGGER.info('xrds error on %s', iname)
+        return iname, []
+    return _getXRIServices(iname, canonicalID, services)
 
+
+def _getXRIServices(iname, canonicalID, services):
+    """Return OpenID services from the result of XRI resolution.
+
+    @return: (claimed_id, services)
+    @rtype: (six.text_type, list(OpenIDServiceEndpoint))
+    """
+    endpoints = []
+    try:
         if canonicalID is None:
             raise XRDSError('No CanonicalID found for XRI %r' % (iname,))
 
@@ -436,7 +519,20 @@ def discoverXRI(iname):
 
 
 def discoverNoYadis(uri):
-    http_resp = fetchers.fetch(uri)
+    return _discoverNoYadisExpiration(uri)[:2]
+
+
+def _discoverNoYadisExpiration(uri):
+    return _getHTMLServices(fetchers.fetch(uri))
+
+
+def _getHTMLServices(http_resp):
+    """Return OpenID services from the HTML document with their expiration.
+
+    @type http_resp: L{openid.fetchers.HTTPResponse}
+    @rtype: (six.text_type, list(OpenIDServiceEndpoint), Optional[float])
+    @raises DiscoveryFailure: If the response is not successful.
+    """
     if http_resp.status not in (200, 206):
         raise DiscoveryFailure(
             'HTTP Response status from identity URL host is not 200. '
@@ -445,10 +541,14 @@ def discoverNoYadis(uri):
     claimed_id = http_resp.final_url
     openid_services = OpenIDServiceEndpoint.fromHTML(
         claimed_id, http_resp.body)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, getHTTPExpiration(http_resp.headers)
 
 
-def discoverURI(uri):
+def _normalizeURI(uri):
+    """Return the normalized URL of the URI identifier.
+
+    @raises DiscoveryFailure: If the URI scheme is not HTTP or HTTPS.
+    """
     parsed = urlparse(uri)
     if parsed[0] and parsed[1]:
         if parsed[0] not in ['http', 'https']:
@@ -456,13 +556,287 @@ def discoverURI(uri):
     else:
         uri = 'http://' + uri
 
-    uri = normalizeURL(uri)
-    claimed_id, openid_services = discoverYadis(uri)
+    return normalizeURL(uri)
+
+
+def discoverURI(uri):
+    return _discoverURIExpiration(uri)[:2]
+
+
+def _discoverURIExpiration(uri):
+    uri = _normalizeURI(uri)
+    claimed_id, openid_services, expires = _discoverYadisExpiration(uri)
     claimed_id = normalizeURL(claimed_id)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, expires
+
+
+class DiscoveryCache(object):
+    """Cache of discovered OpenID services.
+
+    The services are cached by the normalized identifier until the
+    expiration defined by the XRD C{Expires} element or HTTP cache
+    headers, or for C{default_ttl} seconds if no expiration is defined.
+    Failed discoveries and identifiers without OpenID services are
+    cached for C{negative_ttl} seconds.
+
+    Concurrent requests for the same identifier share a single discovery.
+
+    The cache may be backed by a second tier shared by many processes,
+    see L{MemcachedDiscoveryBackend}. The backend has to provide
+    C{get(key)}, C{set(key, value, expires)} and C{pop(key)} methods,
+    like L{LRUCache<openid.cache.LRUCache>}. The values are tuples of
+    C{(claimed_id, services)}, C{None} and the expiration timestamp.
+    Only successful discoveries are stored in the backend.
+
+    Example::
+
+        setDefaultDiscoveryCache(DiscoveryCache())
+
+    @ivar default_ttl: Number of seconds to cache the services if the identifier doesn't define expiration.
+    @type default_ttl: int
+
+    @ivar min_ttl: Minimal number of seconds to cache the services.
+    @type min_ttl: int
+
+    @ivar max_ttl: Maximal number of seconds to cache the services.
+    @type max_ttl: int
+
+    @ivar negative_ttl: Number of seconds to cache failures.
+    @type negative_ttl: int
+
+    @ivar backend: The second tier of the cache or C{None}.
+    @type backend: Optional[L{MemcachedDiscoveryBackend}]
+
+    @cvar cached_errors: Exceptions which are cached as failures.
+    @type cached_errors: Tuple[Type[Exception], ...]
+    """
+
+    cached_errors = (DiscoveryFailure, fetchers.HTTPFetchingError)
+
+    def __init__(self, max_size=1000, default_ttl=3600, min_ttl=0, max_ttl=86400, negative_ttl=60, backend=None):
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.backend = backend
+        self.cache = LRUCache(max_size)
+        self._single_flight = SingleFlight()
+
+    def discover(self, identifier):
+        """Discover OpenID services for the identifier or return them from the cache.
+
+        @return: (claimed_id, services)
+        @rtype: (six.text_type, List[OpenIDServiceEndpoint])
+
+        @raises DiscoveryFailure: When the discovery fails, possibly a cached failure.
+        @raises openid.fetchers.HTTPFetchingError: When a fetch fails, possibly a cached failure.
+        """
+        key = self.getKey(identifier)
+        result = self.get(key)
+        if result is None:
+            result, error = self._single_flight.call(key, self._discover, key)
+            if error is not None:
+                raise copyException(error)
+            claimed_id, services = result
+            # Callers consume the list of services, return a copy.
+            result = claimed_id, list(services)
+        return result
+
+    def getKey(self, identifier):
+        """Return the key of the identifier in the cache, i.e. the normalized identifier.
+
+        @rtype: six.text_type
+        @raises DiscoveryFailure: When the identifier can't be normalized.
+        """
+        if xri.identifierScheme(identifier) == "XRI":
+            return normalizeXRI(identifier)
+        else:
+            return _normalizeURI(identifier)
+
+    def _discover(self, key):
+        """Run the discovery and cache its result.
+
+        @return: The result of the discovery and the error.
+        """
+        try:
+            if xri.identifierScheme(key) == "XRI":
+                claimed_id, services = discoverXRI(key)
+                expires = None
+            else:
+                claimed_id, services, expires = _discoverURIExpiration(key)
+        except self.cached_errors as error:
+            # Cache the error without its traceback, it would keep the frames of the discovery alive
+            error = copyException(error)
+            self.set(key, None, error=error)
+            return None, error
+        self.set(key, (claimed_id, services), expires)
+        return (claimed_id, services), None
+
+    def get(self, key):
+        """Return the cached services from the cache or its backend.
+
+        @param key: The key of the identifier, see L{getKey}.
+        @type key: six.text_type
+
+        @return: (claimed_id, services) or C{None} if they are not cached.
+        @rtype: Optional[Tuple[six.text_type, List[OpenIDServiceEndpoint]]]
+        @raises Exception: The cached failure of the discovery, see L{cached_errors}.
+        """
+        entry = self.cache.get(key)
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self.cache.set(key, entry, expires=entry[2])
+        if entry is None:
+            return None
+        result, error, _ = entry
+        if error is not None:
+            raise copyException(error)
+        claimed_id, services = result
+        # Callers consume the list of services, return a copy.
+        return claimed_id, list(services)
+
+    def set(self, key, result, expires=None, error=None):
+        """Cache the result of the discovery.
+
+        @param key: The key of the identifier, see L{getKey}.
+        @type key: six.text_type
+        @param result: (claimed_id, services), C{None} if the discovery failed.
+        @type result: Optional[Tuple[six.text_type, List[OpenIDServiceEndpoint]]]
+        @param expires: The expiration timestamp defined by the identifier.
+        @type expires: Optional[float]
+        @param error: The failure of the discovery, it's cached for C{negative_ttl} seconds.
+        @type error: Optional[Exception]
+        """
+        now = time.time()
+        if error is not None or not result[1]:
+            expires = now + self.negative_ttl
+        else:
+            if expires is None:
+                expires = now + self.default_ttl
+            expires = min(max(expires, now + self.min_ttl), now + self.max_ttl)
+        if expires > now:
+            entry = (result, error, expires)
+            self.cache.set(key, entry, expires=expires)
+            if self.backend is not None and error is None:
+                self.backend.set(key, entry, expires)
+
+    def invalidate(self, identifier):
+        """Remove the identifier from the cache.
+
+        @return: Whether the identifier was cached.
+        @rtype: bool
+        """
+        try:
+            key = self.getKey(identifier)
+        except DiscoveryFailure:
+            return False
+        cached = self.cache.pop(key) is not None
+        if self.backend is not None:
+            cached = self.backend.pop(key) is not None or cached
+        return cached
+
+
+class MemcachedDiscoveryBackend(object):
+    """Second tier of L{DiscoveryCache} in memcached, shared by many processes.
+
+    The services are stored as JSON in their compact representation, see
+    L{OpenIDServiceEndpoint.toSessionData}, so nothing is unpickled from
+    the shared cache. Invalid entries are discarded.
+
+    Example::
+
+        client = pymemcache.client.base.Client(('localhost', 11211))
+        setDefaultDiscoveryCache(DiscoveryCache(backend=MemcachedDiscoveryBackend(client)))
+
+    @ivar client: The memcached client, e.g. from C{pymemcache} or
+        C{python-memcached}. It has to provide C{get(key)},
+        C{set(key, value, expire)} and C{delete(key)} methods.
+
+    @ivar prefix: The prefix of the memcached keys.
+    @type prefix: six.text_type
+    """
+
+    # Version of the format of the entries
+    data_version = 1
+
+    def __init__(self, client, prefix='openid-discovery:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _getClientKey(self, key):
+        # Memcached keys are limited to 250 characters without whitespace.
+        return self.prefix + sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached entry or C{None} if it isn't cached."""
+        data = self.client.get(self._getClientKey(key))
+        if data is None:
+            return None
+        try:
+            if isinstance(data, six.binary_type):
+                data = data.decode('utf-8')
+            version, claimed_id, services, expires = json.loads(data)
+            if version != self.data_version:
+                raise ValueError('Unsupported version of discovery cache entry: %r' % (version,))
+            services = [OpenIDServiceEndpoint.fromSessionData(service) for service in services]
+        except (TypeError, ValueError) as error:
+            _LOGGER.warning('Discarding discovery cache entry of %s: %s', key, error)
+            return None
+        return (claimed_id, services), None, expires
+
+    def set(self, key, entry, expires):
+        """Store the entry until the C{expires} timestamp."""
+        (claimed_id, services), _, _ = entry
+        data = json.dumps([self.data_version, claimed_id, [service.toSessionData() for service in services],
+                           expires])
+        ttl = max(int(math.ceil(expires - time.time())), 1)
+        self.client.set(self._getClientKey(key), data.encode('utf-8'), ttl)
+
+    def pop(self, key):
+        """Remove the entry and return it or C{None} if it wasn't cached."""
+        entry = self.get(key)
+        self.client.delete(self._getClientKey(key))
+        return entry
+
+
+# Contains the currently set discovery cache. If it is set to None,
+# discovered services are not cached. Do not access this variable outside of
+# this module.
+_default_discovery_cache = None
+
+
+def getDefaultDiscoveryCache():
+    """Return the cache used by L{discover} or C{None} if it isn't set.
+
+    @rtype: Optional[DiscoveryCache]
+    """
+    return _default_discovery_cache
+
+
+def setDefaultDiscoveryCache(cache):
+    """Set the cache used by L{discover}.
+
+    @param cache: The cache or C{None} to disable caching.
+    @type cache: Optional[DiscoveryCache]
+    """
+    global _default_discovery_cache
+    _default_discovery_cache = cache
 
 
 def discover(identifier):
+    """Discover OpenID services for the identifier.
+
+    If the default discovery cache is set, the services are taken from it.
+
+    @return: (claimed_id, services)
+    @rtype: (six.text_type, List[OpenIDServiceEndpoint])
+
+    @raises DiscoveryFailure: When the discovery fails.
+    """
+    cache = getDefaultDiscoveryCache()
+    if cache is not None:
+        return cache.discover(identifier)
     if xri.identifierScheme(identifier) == "XRI":
         return discoverXRI(identifier)
     else:
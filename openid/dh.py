@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 
 import base64
+import logging
+import threading
 import warnings
 
 import six
@@ -13,6 +15,8 @@ from openid import cryptutil
 from openid.constants import DEFAULT_DH_GENERATOR, DEFAULT_DH_MODULUS
 from openid.oidutil import toBase64
 
+_LOGGER = logging.getLogger(__name__)
+
 
 def _xor(a_b):
     # Python 2 only
@@ -31,6 +35,185 @@ def strxor(x, y):
         return bytes((a ^ b) for a, b in zip(x, y))
 
 
+class DiffieHellmanKeyPool(object):
+    """Pool of pre-generated Diffie-Hellman private keys.
+
+    Generation of a private key is expensive, the pool allows to generate
+    the keys in advance, e.g. in a background thread, instead of generating
+    them while handling a request. If the pool is empty, the key is
+    generated synchronously.
+
+    Example::
+
+        pool = DiffieHellmanKeyPool(size=500)
+        pool.start()
+        setDefaultKeyPool(pool)
+
+    @ivar size: The number of keys kept for each parameters.
+    @type size: int
+
+    @ivar hits: The number of keys taken from the pool.
+    @type hits: int
+
+    @ivar misses: The number of keys generated synchronously, because the pool was empty.
+    @type misses: int
+    """
+
+    def __init__(self, size=100, parameters=None):
+        """Create a new pool.
+
+        @param size: The number of keys kept for each parameters.
+        @type size: int
+
+        @param parameters: Base64 encoded modulus and generator pairs
+            the keys are pooled for. Default modulus and generator are
+            used if not provided.
+        @type parameters: Optional[List[Tuple[six.text_type, six.text_type]]]
+        """
+        if parameters is None:
+            parameters = [(DEFAULT_DH_MODULUS, DEFAULT_DH_GENERATOR)]
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # Map (modulus, generator) -> (DHParameters, list of private keys)
+        self._pools = {}
+        for modulus, generator in parameters:
+            parameter_numbers = DHParameterNumbers(cryptutil.base64ToLong(modulus), cryptutil.base64ToLong(generator))
+            self._pools[(parameter_numbers.p, parameter_numbers.g)] = (
+                parameter_numbers.parameters(default_backend()), [])
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def get(self, parameter_numbers):
+        """Return a private key for the parameters.
+
+        @type parameter_numbers: DHParameterNumbers
+        @rtype: DHPrivateKey
+        """
+        pool = self._pools.get((parameter_numbers.p, parameter_numbers.g))
+        if pool is None:
+            # These parameters are not pooled.
+            return parameter_numbers.parameters(default_backend()).generate_private_key()
+
+        parameters, keys = pool
+        with self._condition:
+            if keys:
+                self.hits += 1
+                private_key = keys.pop()
+                self._condition.notify()
+                return private_key
+            self.misses += 1
+        return parameters.generate_private_key()
+
+    def depth(self, modulus=DEFAULT_DH_MODULUS, generator=DEFAULT_DH_GENERATOR):
+        """Return the number of keys available for the parameters.
+
+        @type modulus: six.text_type
+        @type generator: six.text_type
+        @rtype: int
+        """
+        pool = self._pools.get((cryptutil.base64ToLong(modulus), cryptutil.base64ToLong(generator)))
+        if pool is None:
+            return 0
+        return len(pool[1])
+
+    def _getMissing(self):
+        """Return parameters and keys of a pool which isn't full or C{None} if all pools are full."""
+        for parameters, keys in self._pools.values():
+            if len(keys) < self.size:
+                return parameters, keys
+        return None
+
+    def fill(self):
+        """Fill the pool synchronously.
+
+        @return: The number of generated keys.
+        @rtype: int
+        """
+        generated = 0
+        while True:
+            with self._condition:
+                missing = self._getMissing()
+            if missing is None:
+                return generated
+            parameters, keys = missing
+            private_key = parameters.generate_private_key()
+            with self._condition:
+                keys.append(private_key)
+            generated += 1
+
+    def _run(self):
+        """Keep the pool filled until stopped or until the key generation fails."""
+        try:
+            while True:
+                with self._condition:
+                    missing = self._getMissing()
+                    while self._running and missing is None:
+                        self._condition.wait()
+                        missing = self._getMissing()
+                    if not self._running:
+                        return
+                parameters, keys = missing
+                try:
+                    private_key = parameters.generate_private_key()
+                except Exception:
+                    _LOGGER.exception("Failed to generate Diffie-Hellman private key.")
+                    return
+                with self._condition:
+                    keys.append(private_key)
+        finally:
+            with self._condition:
+                # The pool may have been stopped and started again meanwhile.
+                if self._thread is threading.current_thread():
+                    self._running = False
+                    self._thread = None
+
+    def start(self):
+        """Start a background thread which keeps the pool filled."""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='DiffieHellmanKeyPool')
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+
+
+# Contains the currently set key pool. If it is set to None,
+# the private keys are always generated synchronously. Do not access this
+# variable outside of this module.
+_default_key_pool = None
+
+
+def getDefaultKeyPool():
+    """Return the default key pool or C{None} if it isn't set.
+
+    @rtype: Optional[DiffieHellmanKeyPool]
+    """
+    return _default_key_pool
+
+
+def setDefaultKeyPool(pool):
+    """Set the default key pool, used by all new L{DiffieHellman} instances.
+
+    @param pool: The pool or C{None} to disable pooling.
+    @type pool: Optional[DiffieHellmanKeyPool]
+    """
+    global _default_key_pool
+    _default_key_pool = pool
+
+
 class DiffieHellman(object):
     """Utility for Diffie-Hellman key exchange."""
 
@@ -50,8 +233,26 @@ class DiffieHellman(object):
             generator = cryptutil.base64ToLong(generator)
 
         self.parameter_numbers = DHParameterNumbers(modulus, generator)
-        parameters = self.parameter_numbers.parameters(default_backend())
-        self.private_key = parameters.generate_private_key()
+        # The private key is generated when it's first needed.
+        self._private_key = None
+
+    @property
+    def private_key(self):
+        """Return the private key, generate it if necessary.
+
+        @rtype: DHPrivateKey
+        """
+        if self._private_key is None:
+            if _default_key_pool is None:
+                parameters = self.parameter_numbers.parameters(default_backend())
+                self._private_key = parameters.generate_private_key()
+            else:
+                self._private_key = _default_key_pool.get(self.parameter_numbers)
+        return self._private_key
+
+    @private_key.setter
+    def private_key(self, value):
+        self._private_key = value
 
     @classmethod
     def fromDefaults(cls):
@@ -0,0 +1,78 @@
+"""Asynchronous adapters of synchronous stores and fetchers for asyncio based applications.
+
+This module requires python 3.5 or newer.
+
+The asynchronous server and consumer use an asynchronous store and an
+asynchronous fetcher, which have the same methods as
+L{OpenIDStore<openid.store.interface.OpenIDStore>} and
+L{HTTPFetcher<openid.fetchers.HTTPFetcher>}, only they are coroutines.
+Synchronous stores and fetchers can be used through L{ExecutorStore} and
+L{ExecutorFetcher}, which run them in an executor.
+
+Example::
+
+    store = ExecutorStore(FileOpenIDStore(data_path))
+    fetcher = ExecutorFetcher()
+"""
+from __future__ import unicode_literals
+
+import asyncio
+
+from openid import fetchers
+
+__all__ = ['ExecutorFetcher', 'ExecutorStore']
+
+
+class ExecutorStore(object):
+    """Asynchronous store which runs a synchronous store in an executor.
+
+    @ivar store: The synchronous store.
+    @type store: L{openid.store.interface.OpenIDStore}
+
+    @ivar executor: The executor, C{None} for the default executor of the event loop.
+    @type executor: Optional[concurrent.futures.Executor]
+    """
+
+    def __init__(self, store, executor=None):
+        self.store = store
+        self.executor = executor
+
+    def _run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def storeAssociation(self, server_url, association):
+        return await self._run(self.store.storeAssociation, server_url, association)
+
+    async def getAssociation(self, server_url, handle=None):
+        return await self._run(self.store.getAssociation, server_url, handle)
+
+    async def removeAssociation(self, server_url, handle):
+        return await self._run(self.store.removeAssociation, server_url, handle)
+
+    async def useNonce(self, server_url, timestamp, salt):
+        return await self._run(self.store.useNonce, server_url, timestamp, salt)
+
+    async def acquireLease(self, key, duration):
+        return await self._run(self.store.acquireLease, key, duration)
+
+    async def releaseLease(self, key, token):
+        return await self._run(self.store.releaseLease, key, token)
+
+
+class ExecutorFetcher(object):
+    """Asynchronous fetcher which runs a synchronous fetcher in an executor.
+
+    @ivar fetcher: The synchronous fetcher, C{None} for the default fetcher.
+    @type fetcher: Optional[L{openid.fetchers.HTTPFetcher}]
+
+    @ivar executor: The executor, C{None} for the default executor of the event loop.
+    @type executor: Optional[concurrent.futures.Executor]
+    """
+
+    def __init__(self, fetcher=None, executor=None):
+        self.fetcher = fetcher
+        self.executor = executor
+
+    async def fetch(self, url, body=None, headers=None):
+        fetcher = self.fetcher or fetchers.getDefaultFetcher()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fetcher.fetch, url, body, headers)
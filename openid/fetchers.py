@@ -1,12 +1,17 @@
 """This module contains the HTTP fetcher interface and several implementations."""
 from __future__ import unicode_literals
 
+import errno
+import socket
 import sys
+import threading
 import time
 
 import six
 from six import BytesIO
+from six.moves import http_client
 from six.moves.urllib.error import HTTPError as UrllibHTTPError
+from six.moves.urllib.parse import urljoin, urlsplit
 from six.moves.urllib.request import Request, urlopen
 
 import openid
@@ -14,7 +19,7 @@ import openid.urinorm
 
 __all__ = ['fetch', 'getDefaultFetcher', 'setDefaultFetcher', 'HTTPResponse',
            'HTTPFetcher', 'createHTTPFetcher', 'HTTPFetchingError',
-           'HTTPError']
+           'HTTPError', 'PooledHTTPFetcher']
 
 # Try to import httplib2 for caching support
 # http://bitworking.org/projects/httplib2/
@@ -481,3 +486,193 @@ class RequestsFetcher(HTTPFetcher):
             method = 'GET'
         response = requests.request(method, url, data=body, headers=headers)
         return HTTPResponse(response.url, response.status_code, response.headers, response.content)
+
+
+def _isClosedConnectionError(error, sent):
+    """Return whether the error shows that the server closed the idle connection
+    before any response, so the request can be safely sent again.
+
+    @param sent: Whether the request was sent and the error comes from reading the response.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if sent:
+        # Includes RemoteDisconnected on python 3
+        return isinstance(error, http_client.BadStatusLine)
+    # BrokenPipeError and ConnectionResetError on python 3
+    return isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET)
+
+
+class PooledHTTPFetcher(HTTPFetcher):
+    """An C{L{HTTPFetcher}} which keeps persistent connections to the hosts.
+
+    Connections are returned to a per-host pool after the response is read
+    and reused by the following requests to the same host, which saves the
+    TCP connection and the TLS handshake. This is useful for direct requests,
+    which are repeatedly made to a few OpenID providers.
+
+    If a reused connection turns out to be closed by the server before it
+    responded, the request is sent again over a new connection. Requests which
+    time out or fail in other ways are never sent again.
+
+    @ivar max_connections: Maximal number of idle connections kept for a host.
+    @type max_connections: int
+
+    @ivar idle_timeout: Number of seconds after which an idle connection is closed.
+    @type idle_timeout: float
+
+    @ivar timeout: Timeout of socket operations in seconds, C{None} for the default timeout.
+    @type timeout: Optional[float]
+
+    @ivar max_redirects: Maximal number of followed redirects.
+    @type max_redirects: int
+
+    @ivar ssl_context: The SSL context for HTTPS connections, C{None} for the default one.
+    @type ssl_context: Optional[ssl.SSLContext]
+
+    @ivar connections_created: Number of connections opened by the fetcher.
+    @type connections_created: int
+
+    @ivar connections_reused: Number of requests sent over a reused connection.
+    @type connections_reused: int
+    """
+
+    # Redirects which change the method to GET
+    _get_redirects = (301, 302, 303)
+    _redirects = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_connections=4, idle_timeout=60, timeout=None, max_redirects=5, ssl_context=None):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.ssl_context = ssl_context
+        self.connections_created = 0
+        self.connections_reused = 0
+        # Idle connections and the time of their last use, by scheme, host and port
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url, body=None, headers=None):
+        """Perform an HTTP request
+
+        @raises Exception: Any exception that can be raised by C{httplib}
+
+        @see: C{L{HTTPFetcher.fetch}}
+        """
+        assert body is None or isinstance(body, six.binary_type)
+
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', "%s Python-httplib" % USER_AGENT)
+
+        for _ in range(self.max_redirects + 1):
+            if not _allowedURL(url):
+                raise ValueError('Bad URL scheme: %r' % (url,))
+            status, response_headers, response_body = self._request(url, body, headers)
+            location = response_headers.get('location')
+            if status not in self._redirects or not location:
+                return HTTPResponse(url, status, response_headers, response_body)
+            url = urljoin(url, location)
+            if status in self._get_redirects:
+                body = None
+        raise HTTPError("Too many redirects while fetching %r" % (url,))
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools = self._pools
+            self._pools = {}
+        for pool in pools.values():
+            for connection, _ in pool:
+                connection.close()
+
+    def _request(self, url, body, headers):
+        """Make a single request, without following redirects.
+
+        @return: The status, the headers with lower case names and the body of the response.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = 'POST' if body else 'GET'
+
+        connection, reused = self._getConnection(key)
+        sent = False
+        try:
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+            except Exception as error:
+                if not reused or not _isClosedConnectionError(error, sent):
+                    raise
+                # The idle connection was closed by the server, retry over a new one.
+                connection.close()
+                connection, reused = self._connect(key), False
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            response_body = response.read(MAX_RESPONSE_KB * 1024)
+        except Exception:
+            connection.close()
+            raise
+
+        response_headers = {}
+        for name, value in response.getheaders():
+            name = name.lower()
+            if name in response_headers:
+                value = response_headers[name] + ', ' + value
+            response_headers[name] = value
+
+        # Only connections with completely read responses can be reused.
+        if response.isclosed() and not response.will_close:
+            self._releaseConnection(key, connection)
+        else:
+            connection.close()
+        return response.status, response_headers, response_body
+
+    def _getConnection(self, key):
+        """Return an idle connection to the host or a new one.
+
+        @return: The connection and whether it is reused.
+        """
+        now = time.time()
+        expired = []
+        connection = None
+        with self._lock:
+            # The pool is ordered by the time of the last use.
+            pool = self._pools.get(key, [])
+            while pool and now - pool[0][1] >= self.idle_timeout:
+                expired.append(pool.pop(0)[0])
+            if pool:
+                connection = pool.pop()[0]
+                self.connections_reused += 1
+        for idle in expired:
+            idle.close()
+        if connection is not None:
+            return connection, True
+        return self._connect(key), False
+
+    def _connect(self, key):
+        """Return a new connection to the host."""
+        scheme, host, port = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            connection = http_client.HTTPSConnection(host, port, context=self.ssl_context, **kwargs)
+        else:
+            connection = http_client.HTTPConnection(host, port, **kwargs)
+        with self._lock:
+            self.connections_created += 1
+        return connection
+
+    def _releaseConnection(self, key, connection):
+        """Return the connection to the pool of idle connections."""
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.max_connections:
+                pool.append((connection, time.time()))
+                return
+        connection.close()
@@ -3,11 +3,13 @@
 from __future__ import unicode_literals
 
 import copy
+import re
 import warnings
+from collections import OrderedDict
 
 import six
 from lxml import etree as ElementTree
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import quote_plus, urlencode
 
 from openid import kvform, oidutil
 
@@ -124,6 +126,72 @@ def registerNamespaceAlias(namespace_uri, alias):
     registered_aliases[alias] = namespace_uri
 
 
+# Strings which lxml refuses to serialize, markup containing them is left to lxml to fail.
+_XML_INCOMPATIBLE_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+# Attribute names which are serialized verbatim.
+_XML_ATTRIBUTE_NAME_RE = re.compile(r'^[A-Za-z_][-A-Za-z0-9_.]*\Z')
+
+
+def _escapeAttribute(value):
+    """Escape the attribute value the same way as lxml does."""
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\n' in value:
+        value = value.replace('\n', '&#10;')
+    if '\r' in value:
+        value = value.replace('\r', '&#13;')
+    if '\t' in value:
+        value = value.replace('\t', '&#9;')
+    return value
+
+
+def _isSafeText(value):
+    """Return whether the value can be serialized without lxml."""
+    return isinstance(value, six.text_type) and _XML_INCOMPATIBLE_RE.search(value) is None
+
+
+def _renderTemplate(tag, attributes):
+    """Serialize the element by lxml, so the template has the same attribute order as lxml output."""
+    return ElementTree.tostring(ElementTree.Element(tag, attributes), encoding='unicode')
+
+
+# Templates of the form inputs, the attributes are in the same order as in Message._toFormMarkupXML
+_HIDDEN_INPUT_TEMPLATE = _renderTemplate('input', {'type': 'hidden', 'name': '%(name)s', 'value': '%(value)s'})
+_SUBMIT_INPUT_TEMPLATE = _renderTemplate('input', {'type': 'submit', 'value': '%(value)s'})
+
+
+# Quoted keys and namespace URIs, they repeat across messages. Other values are never cached,
+# they may be secret or unique to the message.
+_quoted_args = {}
+_QUOTED_ARGS_MAX_SIZE = 1000
+
+
+def _quoteArg(value):
+    """Quote the query argument the same way as C{urlencode} in L{oidutil.appendArgs}."""
+    quoted = quote_plus(value.encode('utf-8'))
+    if isinstance(quoted, six.binary_type):
+        # Python 2 returns a binary string
+        quoted = quoted.decode('utf-8')
+    return quoted
+
+
+def _quoteCachedArg(value):
+    """Quote the key or the namespace URI, see L{_quoteArg}."""
+    quoted = _quoted_args.get(value)
+    if quoted is None:
+        quoted = _quoteArg(value)
+        if len(_quoted_args) >= _QUOTED_ARGS_MAX_SIZE:
+            _quoted_args.clear()
+        _quoted_args[value] = quoted
+    return quoted
+
+
 class Message(object):
     """
     In the implementation of this object, None represents the global
@@ -136,10 +204,17 @@ class Message(object):
     @ivar ns_args: two-level dictionary of the values in this message,
         grouped by namespace URI. The first level is the namespace
         URI.
+
+    @ivar args: dictionary of the values in this message, keyed by
+        namespace URI and key. Messages created by L{fromPostArgs} build
+        it on the first access.
     """
 
     allowed_openid_namespaces = [OPENID1_NS, THE_OTHER_OPENID1_NS, OPENID2_NS]
 
+    # Raw openid and bare arguments which are not yet indexed in args.
+    _pending_args = None
+
     def __init__(self, openid_namespace=None, implicit_namespace=None):
         """Create an empty Message.
 
@@ -149,7 +224,7 @@ class Message(object):
         @raises InvalidOpenIDNamespace: if openid_namespace is not in
             L{Message.allowed_openid_namespaces}
         """
-        self.args = {}
+        self._args = {}
         self.namespaces = NamespaceMap()
         if openid_namespace is not None:
             if implicit_namespace is None:
@@ -166,24 +241,33 @@ class Message(object):
         openid_args = {}
         bare_args = {}
         for key, value in args.items():
-            if isinstance(value, list):
-                raise TypeError("query dict must have one value for each key, "
-                                "not lists of values.  Query is %r" % (args,))
-
-            try:
-                prefix, rest = key.split('.', 1)
-            except ValueError:
-                prefix = None
-
-            if prefix != 'openid':
-                bare_args[key] = value
+            if not isinstance(value, six.text_type):
+                if isinstance(value, list):
+                    raise TypeError("query dict must have one value for each key, "
+                                    "not lists of values.  Query is %r" % (args,))
+                if key.startswith('openid.'):
+                    value = string_to_text(
+                        value, "Binary values in message creations are deprecated. Use text input instead.")
+
+            if key.startswith('openid.'):
+                openid_args[key[7:]] = value
             else:
-                openid_args[rest] = value
-
-        self = cls._fromOpenIDArgs(openid_args)
+                bare_args[key] = value
 
-        for key, value in bare_args.items():
-            self.args[(BARE_NS, key)] = value
+        # Resolve the OpenID namespace and namespace aliases right away, so
+        # the errors are raised here. The arguments are indexed only when needed.
+        openid_namespace = openid_args.get('ns')
+        if openid_namespace is None:
+            self = cls(OPENID1_NS, True)
+        else:
+            self = cls(openid_namespace, False)
+        for key, value in six.iteritems(openid_args):
+            if key.startswith('ns.'):
+                self.namespaces.addAlias(value, key[3:])
+        self._pending_args = (openid_args, bare_args)
+        if not self.isOpenID2():
+            # OpenID 1 messages may define namespaces implicitly by the arguments.
+            self._indexArgs()
         return self
 
     @classmethod
@@ -245,6 +329,53 @@ class Message(object):
             self.setArg(ns_uri, ns_key, value)
         return self
 
+    def __setstate__(self, state):
+        # Messages pickled by older versions have the arguments in 'args'.
+        if 'args' in state:
+            state['_args'] = state.pop('args')
+        self.__dict__.update(state)
+
+    @property
+    def args(self):
+        if self._pending_args is not None:
+            self._indexArgs()
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._pending_args = None
+        self._args = value
+
+    def _indexArgs(self):
+        """Put the pending arguments into the appropriate namespaces."""
+        openid_args, bare_args = self._pending_args
+        self._pending_args = None
+        args = self._args
+        openid_namespace = self.getOpenIDNamespace()
+        for key, value in six.iteritems(openid_args):
+            ns_alias, sep, ns_key = key.partition('.')
+            if not sep:
+                if key != 'ns':
+                    args[(openid_namespace, key)] = value
+                continue
+            if ns_alias == 'ns':
+                # Namespace aliases are already defined.
+                continue
+
+            ns_uri = self.namespaces.getNamespaceURI(ns_alias)
+            if ns_uri is None:
+                # we found a namespaced arg without a namespace URI defined
+                ns_uri = self._getDefaultNamespace(ns_alias)
+                if ns_uri is None:
+                    ns_uri = openid_namespace
+                    ns_key = key
+                else:
+                    self.namespaces.addAlias(ns_uri, ns_alias, implicit=True)
+            self.setArg(ns_uri, ns_key, value)
+
+        for key, value in six.iteritems(bare_args):
+            args[(BARE_NS, key)] = value
+
     def _getDefaultNamespace(self, mystery_alias):
         """OpenID 1 compatibility: look for a default namespace URI to
         use for this alias."""
@@ -292,7 +423,16 @@ class Message(object):
         return cls.fromOpenIDArgs(kvform.kvToDict(kvform_string))
 
     def copy(self):
-        return copy.deepcopy(self)
+        """Return a copy of this message.
+
+        Keys and values of the message are immutable, so only the containers are copied.
+
+        @rtype: L{Message}
+        """
+        message = copy.copy(self)
+        message.args = self.args.copy()
+        message.namespaces = self.namespaces.copy()
+        return message
 
     def toPostArgs(self):
         """Return all arguments with openid. in front of namespaced arguments.
@@ -358,18 +498,56 @@ class Message(object):
         assert action_url is not None
         action_url = string_to_text(action_url, "Binary values for action_url is deprecated. Use text input instead.")
 
-        form = ElementTree.Element('form')
-
+        form_attrs = OrderedDict()
         if form_tag_attrs:
             for name, attr in form_tag_attrs.items():
-                form.attrib[name] = attr
+                form_attrs[name] = attr
+        form_attrs['action'] = action_url
+        form_attrs['method'] = 'post'
+        form_attrs['accept-charset'] = 'UTF-8'
+        form_attrs['enctype'] = 'application/x-www-form-urlencoded'
+        post_args = self.toPostArgs()
 
-        form.attrib['action'] = action_url
-        form.attrib['method'] = 'post'
-        form.attrib['accept-charset'] = 'UTF-8'
-        form.attrib['enctype'] = 'application/x-www-form-urlencoded'
+        # Render the markup directly, unless some of the strings are left for lxml to deal with.
+        safe = _isSafeText(submit_text)
+        for name, attr in form_attrs.items():
+            if not safe:
+                break
+            safe = _XML_ATTRIBUTE_NAME_RE.match(name) is not None and _isSafeText(attr)
+        for name, value in six.iteritems(post_args):
+            if not safe:
+                break
+            safe = _isSafeText(name) and _isSafeText(value)
+        if not safe:
+            return self._toFormMarkupXML(form_attrs, post_args, submit_text)
+
+        parts = ['<form']
+        for name, attr in form_attrs.items():
+            parts.append(' %s="%s"' % (name, _escapeAttribute(attr)))
+        parts.append('>')
+        for name, value in six.iteritems(post_args):
+            parts.append(_HIDDEN_INPUT_TEMPLATE % {'name': _escapeAttribute(name), 'value': _escapeAttribute(value)})
+        parts.append(_SUBMIT_INPUT_TEMPLATE % {'value': _escapeAttribute(submit_text)})
+        parts.append('</form>')
+        return ''.join(parts)
+
+    def _toFormMarkupXML(self, form_attrs, post_args, submit_text):
+        """Generate HTML form markup by lxml, see L{toFormMarkup}.
+
+        @param form_attrs: Attributes of the form tag.
+        @type form_attrs: Dict[six.text_type, six.text_type]
+
+        @param post_args: Arguments of the message.
+        @type post_args: Dict[six.text_type, six.text_type]
+
+        @param submit_text: The text of the submit button.
+        @type submit_text: six.text_type
+        """
+        form = ElementTree.Element('form')
+        for name, attr in form_attrs.items():
+            form.attrib[name] = attr
 
-        for name, value in six.iteritems(self.toPostArgs()):
+        for name, value in six.iteritems(post_args):
             attrs = {'type': 'hidden', 'name': name, 'value': value}
             form.append(ElementTree.Element('input', attrs))
 
@@ -381,7 +559,27 @@ class Message(object):
     def toURL(self, base_url):
         """Generate a GET URL with the parameters in this message
         attached as query parameters."""
-        return oidutil.appendArgs(base_url, self.toPostArgs())
+        post_args = self.toPostArgs()
+        if not isinstance(base_url, six.text_type):
+            return oidutil.appendArgs(base_url, post_args)
+        if not post_args:
+            return base_url
+
+        query = []
+        for key, value in sorted(post_args.items()):
+            if not isinstance(key, six.text_type) or not isinstance(value, six.text_type):
+                return oidutil.appendArgs(base_url, post_args)
+            if not key.startswith('openid.'):
+                query.append('%s=%s' % (_quoteArg(key), _quoteArg(value)))
+            elif key == 'openid.ns' or key.startswith('openid.ns.'):
+                query.append('%s=%s' % (_quoteCachedArg(key), _quoteCachedArg(value)))
+            else:
+                query.append('%s=%s' % (_quoteCachedArg(key), _quoteArg(value)))
+        if '?' in base_url:
+            sep = '&'
+        else:
+            sep = '?'
+        return '%s%s%s' % (base_url, sep, '&'.join(query))
 
     def toKVForm(self):
         """Generate a KVForm string that contains the parameters in
@@ -409,17 +607,19 @@ class Message(object):
         @param namespace: The string or constant to convert
         @type namespace: six.text_type or BARE_NS or OPENID_NS
         """
-        if namespace == OPENID_NS:
-            namespace = self.getOpenIDNamespace()
-            if namespace is None:
-                raise UndefinedOpenIDNamespace('OpenID namespace not set')
-
-        if namespace != BARE_NS and not isinstance(namespace, six.string_types):
-            raise TypeError(
-                "Namespace must be BARE_NS, OPENID_NS or a string. got %r"
-                % (namespace,))
+        if not isinstance(namespace, six.string_types):
+            if namespace == OPENID_NS:
+                namespace = self.getOpenIDNamespace()
+                if namespace is None:
+                    raise UndefinedOpenIDNamespace('OpenID namespace not set')
+            elif namespace == BARE_NS:
+                return namespace
+            else:
+                raise TypeError(
+                    "Namespace must be BARE_NS, OPENID_NS or a string. got %r"
+                    % (namespace,))
 
-        if namespace != BARE_NS and ':' not in namespace:
+        if ':' not in namespace:
             fmt = 'OpenID 2.0 namespace identifiers SHOULD be URIs. Got %r'
             warnings.warn(fmt % (namespace,), DeprecationWarning)
 
@@ -432,8 +632,17 @@ class Message(object):
 
     def hasKey(self, namespace, ns_key):
         namespace = self._fixNS(namespace)
+        if self._pending_args is not None and self._isPlainOpenIDKey(namespace, ns_key):
+            return ns_key in self._pending_args[0]
         return (namespace, ns_key) in self.args
 
+    def _isPlainOpenIDKey(self, namespace, key):
+        """Return whether the key is in the OpenID namespace and it doesn't contain an alias.
+
+        Such keys can be looked up in the pending arguments.
+        """
+        return '.' not in key and key != 'ns' and namespace == self.getOpenIDNamespace()
+
     def getKey(self, namespace, ns_key):
         """Get the key for a particular namespaced argument"""
         namespace = self._fixNS(namespace)
@@ -476,9 +685,10 @@ class Message(object):
             namespace = string_to_text(namespace, "Binary values for namespace are deprecated. Use text input instead.")
         key = string_to_text(key, "Binary values for key are deprecated. Use text input instead.")
         namespace = self._fixNS(namespace)
-        args_key = (namespace, key)
         try:
-            return self.args[args_key]
+            if self._pending_args is not None and self._isPlainOpenIDKey(namespace, key):
+                return self._pending_args[0][key]
+            return self.args[(namespace, key)]
         except KeyError:
             if default is no_default:
                 raise KeyError((namespace, key))
@@ -571,6 +781,17 @@ class NamespaceMap(object):
         self.namespace_to_alias = {}
         self.implicit_namespaces = []
 
+    def copy(self):
+        """Return a copy of this namespace map.
+
+        @rtype: L{NamespaceMap}
+        """
+        namespaces = copy.copy(self)
+        namespaces.alias_to_namespace = self.alias_to_namespace.copy()
+        namespaces.namespace_to_alias = self.namespace_to_alias.copy()
+        namespaces.implicit_namespaces = list(self.implicit_namespaces)
+        return namespaces
+
     def getAlias(self, namespace_uri):
         return self.namespace_to_alias.get(namespace_uri)
 
@@ -0,0 +1,489 @@
+"""Asynchronous OpenID server for asyncio based applications.
+
+This module requires python 3.5 or newer.
+
+The L{AsyncServer} mirrors the L{Server<openid.server.server.Server>}, but
+its methods which access the store or the network are coroutines. It uses an
+asynchronous store and an asynchronous fetcher, which have the same methods as
+L{OpenIDStore<openid.store.interface.OpenIDStore>} and
+L{HTTPFetcher<openid.fetchers.HTTPFetcher>}, only they are coroutines.
+Synchronous stores and fetchers can be used through
+L{ExecutorStore<openid.executor.ExecutorStore>} and
+L{ExecutorFetcher<openid.executor.ExecutorFetcher>}, which run them in an
+executor.
+
+Example::
+
+    oserver = AsyncServer(ExecutorStore(FileOpenIDStore(data_path)), "http://example.com/op")
+    request = oserver.decodeRequest(query)
+    if request.mode in ['checkid_immediate', 'checkid_setup']:
+        if await oserver.returnToVerified(request) and self.isAuthorized(request.identity, request.trust_root):
+            response = request.answer(True)
+        ...
+    else:
+        response = await oserver.handleRequest(request)
+
+    webresponse = await oserver.encodeResponse(response)
+
+L{ASGIApplication} provides a minimal ASGI application on top of the L{AsyncServer}.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import copy
+import functools
+import logging
+
+import six
+from six.moves.urllib.parse import parse_qsl
+
+from openid.association import default_negotiator
+from openid.cache import copyException
+from openid.executor import ExecutorFetcher, ExecutorStore
+from openid.kvform import KVFormError
+from openid.message import OPENID_NS
+from openid.oidutil import string_to_text
+from openid.server.server import (BROWSER_REQUEST_MODES, ENCODE_KVFORM, HTTP_ERROR, Decoder,
+                                  DiffieHellmanSHA1ServerSession, Encoder, EncodingError, ProtocolError, Signatory,
+                                  _answerSession)
+from openid.server.trustroot import (RealmVerificationRedirected, TrustRoot, _extractReturnURL,
+                                     _extractReturnURLsExpiration, returnToMatches)
+from openid.yadis.discover import DiscoveryResult, iterDiscoverySteps
+from openid.yadis.services import getEndpointsExpiration
+
+__all__ = ['ASGIApplication', 'AsyncServer', 'AsyncSignatory', 'ExecutorFetcher', 'ExecutorStore']
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSignatory(Signatory):
+    """Signatory which uses an asynchronous store.
+
+    All public methods are coroutines.
+    """
+
+    async def verify(self, assoc_handle, message):
+        """Verify that the signature for some data is valid.
+
+        @type assoc_handle: six.text_type
+        @type message: openid.message.Message
+        @returntype: bool
+        """
+        assoc = await self.getAssociation(assoc_handle, dumb=True)
+        return self._checkSignature(assoc, assoc_handle, message)
+
+    async def sign(self, response):
+        """Sign a response.
+
+        @type response: L{OpenIDResponse}
+        @returns: A signed copy of the response.
+        @returntype: L{OpenIDResponse}
+        """
+        fields = response.fields
+        assoc_handle = response.request.assoc_handle
+        if assoc_handle:
+            # normal mode, see Signatory.sign
+            assoc = await self.getAssociation(assoc_handle, dumb=False, checkExpiration=False)
+
+            if not assoc or assoc.expiresIn <= 0:
+                # fall back to dumb mode
+                fields = fields.copy()
+                fields.setArg(OPENID_NS, 'invalidate_handle', assoc_handle)
+                assoc_type = assoc and assoc.assoc_type or 'HMAC-SHA1'
+                if assoc and assoc.expiresIn <= 0:
+                    await self.invalidate(assoc_handle, dumb=False)
+                assoc = await self.createAssociation(dumb=True, assoc_type=assoc_type)
+        else:
+            # dumb mode.
+            assoc = await self.createAssociation(dumb=True)
+
+        signed_response = copy.copy(response)
+        try:
+            signed_response.fields = assoc.signMessage(fields)
+        except KVFormError as err:
+            raise EncodingError(response, explanation=six.text_type(err))
+        return signed_response
+
+    async def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1'):
+        """Make a new association.
+
+        @type dumb: bool
+        @type assoc_type: six.text_type
+        @returntype: L{openid.association.Association}
+        """
+        key = self._dumb_key if dumb else self._normal_key
+        assoc = self._generateAssociation(assoc_type, key)
+        await self.store.storeAssociation(key, assoc)
+        self._cacheAssociation(key, assoc)
+        return assoc
+
+    async def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
+        """Get the association with the specified handle.
+
+        @type assoc_handle: six.text_type
+        @type dumb: bool
+        @returns: the association, or None if no valid association with that handle was found.
+        @returntype: L{openid.association.Association}
+        """
+        if assoc_handle is None:
+            raise ValueError("assoc_handle must not be None")
+
+        key = self._dumb_key if dumb else self._normal_key
+        if not self._checkHandle(key, assoc_handle, checkExpiration):
+            return None
+        assoc = None
+        if self.cache is not None and not dumb:
+            assoc = self.cache.get((key, assoc_handle))
+        if assoc is None:
+            assoc = await self.store.getAssociation(key, assoc_handle)
+            if assoc is not None and assoc.expiresIn > 0:
+                self._cacheAssociation(key, assoc)
+        if assoc is not None and assoc.expiresIn <= 0:
+            _LOGGER.info("requested %sdumb key %r is expired (by %s seconds)",
+                         (not dumb) and 'not-' or '', assoc_handle, assoc.expiresIn)
+            if checkExpiration:
+                await self.invalidate(assoc_handle, dumb)
+                assoc = None
+        return assoc
+
+    async def invalidate(self, assoc_handle, dumb):
+        """Invalidates the association with the given handle.
+
+        @type assoc_handle: six.text_type
+        @type dumb: bool
+        """
+        key = self._dumb_key if dumb else self._normal_key
+        if not self._checkHandle(key, assoc_handle, checkExpiration=False):
+            return
+        await self.store.removeAssociation(key, assoc_handle)
+        self._evictAssociation(key, assoc_handle)
+
+
+class AsyncServer(object):
+    """I handle requests for an OpenID server in an asyncio event loop.
+
+    I'm an asynchronous counterpart of L{Server<openid.server.server.Server>}.
+    Diffie-Hellman key exchange of association requests is run in my
+    L{executor<AsyncServer.executor>}, the rest of the request handling
+    awaits the store and the fetcher.
+
+    @ivar signatory: I'm using this for associate requests and to sign things.
+    @type signatory: L{AsyncSignatory}
+
+    @ivar fetcher: I'm using this for relying party discovery.
+    @type fetcher: L{ExecutorFetcher<openid.executor.ExecutorFetcher>} or other asynchronous fetcher
+
+    @ivar executor: I use this to run Diffie-Hellman key exchange,
+        C{None} for the default executor of the event loop.
+    @type executor: Optional[concurrent.futures.Executor]
+
+    @ivar verification_cache: Cache of allowed return_to URLs.
+    @type verification_cache: Optional[L{openid.server.trustroot.RealmVerificationCache}]
+    """
+
+    def __init__(self, store, op_endpoint, fetcher=None, executor=None, verification_cache=None,
+                 association_cache=None):
+        """A new L{AsyncServer}.
+
+        @param store: The asynchronous back-end where my associations are stored.
+        @type store: L{ExecutorStore<openid.executor.ExecutorStore>} or other asynchronous store
+
+        @param op_endpoint: My URL, the fully qualified address of this
+            server's endpoint, i.e. C{http://example.com/server}
+        @type op_endpoint: six.text_type
+
+        @param fetcher: The asynchronous fetcher, L{ExecutorFetcher<openid.executor.ExecutorFetcher>} by default.
+
+        @param executor: Executor for Diffie-Hellman key exchange.
+        @type executor: Optional[concurrent.futures.Executor]
+
+        @param verification_cache: Cache of allowed return_to URLs.
+        @type verification_cache: Optional[L{openid.server.trustroot.RealmVerificationCache}]
+
+        @param association_cache: Cache of associations for the signatory.
+        @type association_cache: Optional[L{openid.cache.LRUCache}]
+        """
+        self.store = store
+        self.signatory = AsyncSignatory(store, cache=association_cache)
+        self.encoder = Encoder()
+        self.decoder = Decoder(self)
+        self.negotiator = default_negotiator.copy()
+        self.op_endpoint = string_to_text(op_endpoint,
+                                          "Binary values for op_endpoint are deprecated. Use text input instead.")
+        if fetcher is None:
+            fetcher = ExecutorFetcher()
+        self.fetcher = fetcher
+        self.executor = executor
+        self.verification_cache = verification_cache
+        # Relying party discoveries in progress
+        self._discoveries = {}
+
+    def decodeRequest(self, query):
+        """Transform query parameters into an L{OpenIDRequest}.
+
+        Decoding doesn't block, so it isn't a coroutine.
+
+        @see: L{Decoder.decode}
+        """
+        return self.decoder.decode(query)
+
+    async def handleRequest(self, request):
+        """Handle a request.
+
+        @raises NotImplementedError: When I do not have a handler defined
+            for that type of request.
+
+        @returntype: L{OpenIDResponse}
+        """
+        handler = getattr(self, 'openid_' + request.mode, None)
+        if handler is not None:
+            return await handler(request)
+        else:
+            raise NotImplementedError(
+                "%s has no handler for a request of mode %r." %
+                (self, request.mode))
+
+    async def openid_check_authentication(self, request):
+        """Handle and respond to C{check_authentication} requests.
+
+        @see: L{CheckAuthRequest.answer<openid.server.server.CheckAuthRequest.answer>}
+        @returntype: L{OpenIDResponse}
+        """
+        is_valid = await self.signatory.verify(request.assoc_handle, request.signed)
+        # Now invalidate that assoc_handle so it this checkAuth message cannot
+        # be replayed.
+        await self.signatory.invalidate(request.assoc_handle, dumb=True)
+        invalidate_assoc = None
+        if request.invalidate_handle:
+            invalidate_assoc = await self.signatory.getAssociation(request.invalidate_handle, dumb=False)
+        return request._answer(is_valid, invalidate_assoc)
+
+    async def openid_associate(self, request):
+        """Handle and respond to C{associate} requests.
+
+        @returntype: L{OpenIDResponse}
+        """
+        assoc_type = request.assoc_type
+        session = request.session
+        if not self.negotiator.isAllowed(assoc_type, session.session_type):
+            message = ('Association type %r is not supported with '
+                       'session type %r' % (assoc_type, session.session_type))
+            (preferred_assoc_type, preferred_session_type) = self.negotiator.getAllowedType()
+            return request.answerUnsupported(message, preferred_assoc_type, preferred_session_type)
+
+        assoc = await self.signatory.createAssociation(dumb=False, assoc_type=assoc_type)
+        if isinstance(session, DiffieHellmanSHA1ServerSession) and session.hash_func is None:
+            modulus, generator = session.dh.parameters
+            try:
+                session_fields = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, _answerSession, type(session), modulus, generator, session.consumer_public_key,
+                    assoc.secret)
+            except BaseException:
+                # Nobody receives the association, don't keep it in the store until it expires.
+                await self.signatory.invalidate(assoc.handle, dumb=False)
+                raise
+            return request._answer(assoc, session_fields)
+        return request.answer(assoc)
+
+    async def encodeResponse(self, response):
+        """Encode a response to a L{WebResponse}, signing it first if appropriate.
+
+        @raises EncodingError: When I can't figure out how to encode this
+            message.
+
+        @returntype: L{WebResponse}
+
+        @see: L{SigningEncoder.encode<openid.server.server.SigningEncoder.encode>}
+        """
+        if (not isinstance(response, Exception)) and response.needsSigning():
+            response = await self.signatory.sign(response)
+        return self.encoder.encode(response)
+
+    async def returnToVerified(self, request):
+        """Does the relying party publish the return_to URL for this response under the realm?
+
+        @see: L{CheckIDRequest.returnToVerified<openid.server.server.CheckIDRequest.returnToVerified>}
+        @returntype: bool
+        """
+        return await self.verifyReturnTo(request.trust_root, request.return_to)
+
+    async def verifyReturnTo(self, realm_str, return_to):
+        """Verify that a return_to URL is valid for the given realm.
+
+        @see: L{verifyReturnTo<openid.server.trustroot.verifyReturnTo>}
+        @raises DiscoveryFailure: When Yadis discovery fails
+        @returns: True if the return_to URL is valid for the realm
+        """
+        realm = TrustRoot.parseCached(realm_str)
+        if realm is None:
+            # The realm does not parse as a URL pattern
+            return False
+
+        try:
+            allowable_urls = await self.getAllowedReturnURLs(realm.buildDiscoveryURL())
+        except RealmVerificationRedirected as err:
+            _LOGGER.info(six.text_type(err))
+            return False
+
+        if returnToMatches(allowable_urls, return_to):
+            return True
+        else:
+            _LOGGER.info("Failed to validate return_to %r for realm %r, was not in %s",
+                         return_to, realm_str, allowable_urls)
+            return False
+
+    async def getAllowedReturnURLs(self, relying_party_url):
+        """Given a relying party discovery URL return a list of return_to URLs.
+
+        Concurrent requests for the same relying party share a single discovery.
+
+        @raises DiscoveryFailure: When Yadis discovery fails.
+        @raises RealmVerificationRedirected: When the discovery redirects.
+        @rtype: List[six.text_type]
+        """
+        if self.verification_cache is not None:
+            return_to_urls = self.verification_cache.get(relying_party_url)
+            if return_to_urls is not None:
+                return return_to_urls
+        discovery = self._discoveries.get(relying_party_url)
+        if discovery is None:
+            discovery = asyncio.ensure_future(self._discoverReturnURLs(relying_party_url))
+            self._discoveries[relying_party_url] = discovery
+            discovery.add_done_callback(functools.partial(self._discoveries.pop, relying_party_url))
+        # Shield the shared discovery from cancellation of a single request.
+        return_to_urls, error = await asyncio.shield(discovery)
+        if error is not None:
+            # Each request gets its own instance of the shared error
+            raise copyException(error)
+        return return_to_urls
+
+    async def _discoverReturnURLs(self, relying_party_url):
+        """Run the relying party discovery.
+
+        @return: The return_to URLs and the error.
+        """
+        if self.verification_cache is None:
+            cached_errors = ()
+        else:
+            cached_errors = self.verification_cache.cached_errors
+        try:
+            result = await self._discover(relying_party_url)
+            return_to_urls, expires = _extractReturnURLsExpiration(
+                relying_party_url, getEndpointsExpiration(result, _extractReturnURL))
+        except cached_errors as error:
+            error = copyException(error)
+            self.verification_cache.set(relying_party_url, None, error=error)
+            return (None, error)
+        except Exception as error:
+            return (None, error)
+        if self.verification_cache is not None:
+            self.verification_cache.set(relying_party_url, return_to_urls, expires)
+        return (return_to_urls, None)
+
+    async def _discover(self, uri):
+        """Perform Yadis discovery using my fetcher.
+
+        @rtype: L{openid.yadis.discover.DiscoveryResult}
+        """
+        steps = iterDiscoverySteps(uri)
+        step = next(steps)
+        while not isinstance(step, DiscoveryResult):
+            url, headers = step
+            step = steps.send(await self.fetcher.fetch(url, headers=headers))
+        return step
+
+
+class ASGIApplication(object):
+    """Minimal ASGI application for an OpenID server endpoint.
+
+    Requests other than C{checkid_setup} and C{checkid_immediate} are handled
+    by the L{AsyncServer}. The C{checkid} requests are passed to the handler,
+    a coroutine function which gets the request and the ASGI scope and returns
+    the L{OpenIDResponse}, e.g. C{request.answer(True)}.
+
+    Example::
+
+        async def checkid_handler(request, scope):
+            if await oserver.returnToVerified(request) and is_authorized(request, scope):
+                return request.answer(True)
+            return request.answer(False)
+
+        app = ASGIApplication(oserver, checkid_handler)
+    """
+
+    def __init__(self, server, checkid_handler):
+        """Create the application.
+
+        @type server: L{AsyncServer}
+        @param checkid_handler: Coroutine function handling C{checkid} requests.
+        """
+        self.server = server
+        self.checkid_handler = checkid_handler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported ASGI scope type %r" % scope['type'])
+
+        query = await self._readQuery(scope, receive)
+        try:
+            request = self.server.decodeRequest(query)
+            if request is None:
+                await self._send(send, HTTP_ERROR, "This is an OpenID server endpoint.")
+                return
+            if request.mode in BROWSER_REQUEST_MODES:
+                response = await self.checkid_handler(request, scope)
+            else:
+                response = await self.server.handleRequest(request)
+        except ProtocolError as error:
+            response = error
+
+        try:
+            encode_as = response.whichEncoding()
+            web_response = await self.server.encodeResponse(response)
+        except EncodingError as error:
+            await self._send(send, HTTP_ERROR, six.text_type(error))
+            return
+
+        headers = dict(web_response.headers)
+        if encode_as == ENCODE_KVFORM:
+            headers.setdefault('content-type', 'text/plain; charset=UTF-8')
+        elif web_response.body:
+            headers.setdefault('content-type', 'text/html; charset=UTF-8')
+        await self._send(send, web_response.code, web_response.body, headers)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _readQuery(self, scope, receive):
+        """Return the query arguments of the request, from the body for POST requests."""
+        if scope.get('method') == 'POST':
+            body = b''
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get('body', b'')
+                more_body = message.get('more_body', False)
+            data = body.decode('utf-8')
+        else:
+            data = scope.get('query_string', b'').decode('utf-8')
+        return dict(parse_qsl(data, keep_blank_values=True))
+
+    async def _send(self, send, status, body, headers=None):
+        """Send the HTTP response."""
+        if headers is None:
+            headers = {'content-type': 'text/plain; charset=UTF-8'}
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
@@ -118,25 +118,40 @@ From 1.1 to 2.0
 from __future__ import unicode_literals
 
 import base64
+import copy
+import functools
 import logging
 import os
+import re
+import threading
 import time
 import warnings
-from copy import deepcopy
+from collections import Counter
 
 import six
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import constant_time, hashes
+from cryptography.hazmat.primitives.hmac import HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from openid import cryptutil, kvform, oidutil
-from openid.association import Association, default_negotiator, getSecretSize
+from openid.association import Association, all_association_types, default_negotiator, getSecretSize
 from openid.dh import DiffieHellman
 from openid.message import (IDENTIFIER_SELECT, OPENID1_URL_LIMIT, OPENID2_NS, OPENID_NS, InvalidNamespace,
                             InvalidOpenIDNamespace, Message)
 from openid.oidutil import string_to_text
 from openid.server.trustroot import TrustRoot, verifyReturnTo
 from openid.store.nonce import mkNonce
+from openid.tracing import trace
 from openid.urinorm import urinorm
 
+# Try to import concurrent.futures for asynchronous request handling,
+# it requires futures backport on python 2.
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 _LOGGER = logging.getLogger(__name__)
 
 HTTP_OK = 200
@@ -160,8 +175,12 @@ class OpenIDRequest(object):
 
     @ivar message: Original request message.
     @type message: Message
+
+    @ivar tracer: Tracer of the request phases, set by the L{Decoder}.
+    @type tracer: Optional[L{openid.tracing.Tracer}]
     """
     mode = None
+    tracer = None
 
     def __init__(self, message=None):
         if message is not None:
@@ -263,17 +282,76 @@ class CheckAuthRequest(OpenIDRequest):
         # Now invalidate that assoc_handle so it this checkAuth message cannot
         # be replayed.
         signatory.invalidate(self.assoc_handle, dumb=True)
+        invalidate_assoc = None
+        if self.invalidate_handle:
+            invalidate_assoc = signatory.getAssociation(self.invalidate_handle, dumb=False)
+        return self._answer(is_valid, invalidate_assoc)
+
+    def _answer(self, is_valid, invalidate_assoc):
+        """Respond to this request, see L{answer}.
+
+        @param is_valid: Whether the signature is valid.
+        @type is_valid: bool
+
+        @param invalidate_assoc: The association of the C{invalidate_handle}, if it is valid.
+        @type invalidate_assoc: Optional[L{openid.association.Association}]
+
+        @returntype: L{OpenIDResponse}
+        """
         response = OpenIDResponse(self)
         valid_str = (is_valid and "true") or "false"
         response.fields.setArg(OPENID_NS, 'is_valid', valid_str)
 
-        if self.invalidate_handle:
-            assoc = signatory.getAssociation(self.invalidate_handle, dumb=False)
-            if not assoc:
-                response.fields.setArg(
-                    OPENID_NS, 'invalidate_handle', self.invalidate_handle)
+        if self.invalidate_handle and not invalidate_assoc:
+            response.fields.setArg(
+                OPENID_NS, 'invalidate_handle', self.invalidate_handle)
         return response
 
+    @classmethod
+    def answerAll(cls, requests, signatory):
+        """Respond to many requests at once.
+
+        The responses are the same as if each request was answered by
+        L{answer} in the given order, but each association is fetched only
+        once and all the associations are invalidated together by
+        L{Signatory.invalidateAll}.
+
+        @param requests: The requests to answer.
+        @type requests: Sequence[L{CheckAuthRequest}]
+
+        @param signatory: The L{Signatory} to use to check the signatures.
+        @type signatory: L{Signatory}
+
+        @returns: The responses in the order of the requests.
+        @rtype: List[L{OpenIDResponse}]
+        """
+        # Dumb associations which are invalidated after their first use
+        used_handles = []
+        used = set()
+        # Associations of the invalidate handles
+        normal_assocs = {}
+        results = []
+        for request in requests:
+            if request.assoc_handle in used:
+                # The association was invalidated by the previous request.
+                assoc = None
+            else:
+                assoc = signatory.getAssociation(request.assoc_handle, dumb=True)
+                used.add(request.assoc_handle)
+                used_handles.append(request.assoc_handle)
+            is_valid = signatory._checkSignature(assoc, request.assoc_handle, request.signed)
+
+            invalidate_assoc = None
+            if request.invalidate_handle:
+                if request.invalidate_handle not in normal_assocs:
+                    normal_assocs[request.invalidate_handle] = signatory.getAssociation(request.invalidate_handle,
+                                                                                        dumb=False)
+                invalidate_assoc = normal_assocs[request.invalidate_handle]
+            results.append((request, is_valid, invalidate_assoc))
+
+        signatory.invalidateAll(used_handles, dumb=True)
+        return [request._answer(is_valid, invalidate_assoc) for request, is_valid, invalidate_assoc in results]
+
     def __str__(self):
         if self.invalidate_handle:
             ih = " invalidate? %r" % (self.invalidate_handle,)
@@ -409,6 +487,22 @@ class DiffieHellmanSHA256ServerSession(DiffieHellmanSHA1ServerSession):
     allowed_assoc_types = ['HMAC-SHA256']
 
 
+def _answerSession(session_class, modulus, generator, consumer_public_key, secret):
+    """Answer a Diffie-Hellman association session.
+
+    This is run in an executor, possibly in another process, so it only gets picklable arguments.
+
+    @type session_class: Type[DiffieHellmanSHA1ServerSession]
+    @type modulus: six.text_type
+    @type generator: six.text_type
+    @type consumer_public_key: six.text_type
+    @type secret: six.binary_type
+    @rtype: Dict[six.text_type, six.text_type]
+    """
+    session = session_class(DiffieHellman(modulus, generator), consumer_public_key)
+    return session.answer(secret)
+
+
 class AssociateRequest(OpenIDRequest):
     """A request to establish an X{association}.
 
@@ -504,14 +598,22 @@ class AssociateRequest(OpenIDRequest):
             to the consumer's X{public key} if appropriate.
         @returntype: L{OpenIDResponse}
         """
+        return self._answer(assoc, self.session.answer(assoc.secret))
+
+    def _answer(self, assoc, session_fields):
+        """Respond to this request with an X{association} and the fields returned by the session.
+
+        @type assoc: L{openid.association.Association}
+        @type session_fields: Dict[six.text_type, six.text_type]
+        @returntype: L{OpenIDResponse}
+        """
         response = OpenIDResponse(self)
         response.fields.updateArgs(OPENID_NS, {
             'expires_in': '%d' % (assoc.getExpiresIn(),),
             'assoc_type': self.assoc_type,
             'assoc_handle': assoc.handle,
         })
-        response.fields.updateArgs(OPENID_NS,
-                                   self.session.answer(assoc.secret))
+        response.fields.updateArgs(OPENID_NS, session_fields)
 
         if not (self.session.session_type == 'no-encryption' and self.message.isOpenID1()):
             # The session type "no-encryption" did not have a name
@@ -711,7 +813,7 @@ class CheckIDRequest(OpenIDRequest):
         """
         if not self.trust_root:
             return True
-        tr = TrustRoot.parse(self.trust_root)
+        tr = TrustRoot.parseCached(self.trust_root)
         if tr is None:
             raise MalformedTrustRoot(self.message, self.trust_root)
 
@@ -794,6 +896,11 @@ class CheckIDRequest(OpenIDRequest):
 
         @raises NoReturnError: when I do not have a return_to.
         """
+        with trace(self.tracer, 'answer', mode=self.mode):
+            return self._answer(allow, server_url, identity, claimed_id)
+
+    def _answer(self, allow, server_url, identity, claimed_id):
+        """Respond to this request, see L{answer}."""
         if identity is not None:
             identity = string_to_text(identity, "Binary values for identity are deprecated. Use text input instead.")
         if claimed_id is not None:
@@ -1150,11 +1257,42 @@ class Signatory(object):
     L{OpenIDStore<openid.store.interface.OpenIDStore>}, which means
     I'm not generally pickleable but I am easy to reconstruct.
 
+    I may keep recently used smart-mode associations in an in-process
+    cache, so they don't have to be loaded from the store on every request.
+    Dumb-mode associations are single-use, they are invalidated by
+    C{check_authentication} requests, so they are always read from the
+    store.
+
+    Signatories of different OP endpoints may share a store and a cache,
+    if each of them has its own namespace.
+
+    If I have a handle key, the handles of my associations carry their
+    expiration and a MAC made with the key. Handles with an invalid MAC,
+    e.g. forged handles or handles issued by other servers, and expired
+    handles are rejected without any access to the store. Enabling the
+    handle key, or changing it, invalidates all existing associations.
+
+    Example::
+
+        signatory_class = functools.partial(Signatory, cache=LRUCache(1000))
+        oserver = Server(store, "http://example.com/op", signatoryClass=signatory_class)
+
     @cvar SECRET_LIFETIME: The number of seconds a secret remains valid.
     @type SECRET_LIFETIME: int
+
+    @ivar cache: Cache of associations, C{None} if associations are not cached.
+    @type cache: Optional[L{openid.cache.LRUCache}]
+
+    @ivar tracer: Tracer of signing and store calls, set by the L{Server}.
+    @type tracer: Optional[L{openid.tracing.Tracer}]
+
+    @ivar handle_key: Secret key for the MACs of association handles, C{None} if handles have no MAC.
+    @type handle_key: Optional[six.binary_type]
     """
 
     SECRET_LIFETIME = 14 * 24 * 60 * 60  # 14 days, in seconds
+    tracer = None
+    handle_key = None
 
     # keys have a bogus server URL in them because the filestore
     # really does expect that key to be a URL.  This seems a little
@@ -1163,14 +1301,89 @@ class Signatory(object):
     _normal_key = 'http://localhost/|normal'
     _dumb_key = 'http://localhost/|dumb'
 
-    def __init__(self, store):
+    # Handles with a MAC: {assoc_type}{expiration}{uniq}{mac}
+    _mac_handle_re = re.compile(r'^\{(?P<assoc_type>[^{}]+)\}\{(?P<expires>[0-9a-f]+)\}\{(?P<uniq>[^{}]+)\}'
+                                r'\{(?P<mac>[^{}]+)\}$')
+    # Length of the handle MAC in bytes
+    _handle_mac_length = 12
+
+    def __init__(self, store, cache=None, namespace=None, handle_key=None):
         """Create a new Signatory.
 
         @param store: The back-end where my associations are stored.
         @type store: L{openid.store.interface.OpenIDStore}
+
+        @param cache: Cache of associations.
+        @type cache: Optional[L{openid.cache.LRUCache}]
+
+        @param namespace: Namespace of my associations in the store,
+            usually the OP endpoint URL.
+        @type namespace: Optional[six.text_type]
+
+        @param handle_key: Secret key for the MACs of association handles,
+            at least 16 random bytes.
+        @type handle_key: Optional[six.binary_type]
         """
         assert store is not None
         self.store = store
+        self.cache = cache
+        if namespace is not None:
+            self._normal_key = '%s|normal' % namespace
+            self._dumb_key = '%s|dumb' % namespace
+        if handle_key is not None and len(handle_key) < 16:
+            raise ValueError("Handle key must have at least 16 bytes.")
+        self.handle_key = handle_key
+
+    def _getHandleMAC(self, key, handle_data):
+        """Return the MAC of the association handle data.
+
+        @param key: The store key of the association, the MAC is bound to it.
+        @type key: six.text_type
+
+        @rtype: six.binary_type
+        """
+        hmac = HMAC(self.handle_key, hashes.SHA256(), backend=default_backend())
+        hmac.update(('%s|%s' % (key, handle_data)).encode('utf-8'))
+        return hmac.finalize()[:self._handle_mac_length]
+
+    def _checkHandle(self, key, assoc_handle, checkExpiration=True):
+        """Return whether the association handle may be issued by me.
+
+        The handle is always valid if I don't have a handle key.
+
+        @param key: The store key of the association.
+        @type key: six.text_type
+
+        @rtype: bool
+        """
+        if self.handle_key is None:
+            return True
+        match = self._mac_handle_re.match(assoc_handle)
+        if match is None:
+            _LOGGER.info("rejected association handle %r without MAC", assoc_handle)
+            return False
+        try:
+            mac = oidutil.fromBase64(match.group('mac'))
+        except ValueError:
+            mac = b''
+        handle_data = assoc_handle[:match.start('mac') - 1]
+        if not constant_time.bytes_eq(mac, self._getHandleMAC(key, handle_data)):
+            _LOGGER.info("rejected association handle %r with invalid MAC", assoc_handle)
+            return False
+        if checkExpiration and int(match.group('expires'), 16) <= time.time():
+            _LOGGER.info("rejected expired association handle %r", assoc_handle)
+            return False
+        return True
+
+    def _cacheAssociation(self, key, assoc):
+        """Put the smart-mode association into the cache, it expires with the association."""
+        if self.cache is not None and key == self._normal_key:
+            self.cache.set((key, assoc.handle), assoc, expires=assoc.issued + assoc.lifetime)
+
+    def _evictAssociation(self, key, assoc_handle):
+        """Remove the association from the cache."""
+        if self.cache is not None:
+            self.cache.pop((key, assoc_handle))
 
     def verify(self, assoc_handle, message):
         """Verify that the signature for some data is valid.
@@ -1188,6 +1401,16 @@ class Signatory(object):
         assoc_handle = string_to_text(assoc_handle,
                                       "Binary values for assoc_handle are deprecated. Use text input instead.")
         assoc = self.getAssociation(assoc_handle, dumb=True)
+        return self._checkSignature(assoc, assoc_handle, message)
+
+    def _checkSignature(self, assoc, assoc_handle, message):
+        """Verify the signature of the message with the association, see L{verify}.
+
+        @param assoc: The association or C{None} if it wasn't found.
+        @type assoc: Optional[L{openid.association.Association}]
+
+        @rtype: bool
+        """
         if not assoc:
             _LOGGER.info("failed to get assoc with handle %r to verify message %r", assoc_handle, message)
             return False
@@ -1206,13 +1429,28 @@ class Signatory(object):
         in its L{signed<OpenIDResponse.signed>} list, and return a new
         copy of the response object with that signature included.
 
+        The request of the response is shared by the copy, only the fields
+        are copied.
+
         @param response: A response to sign.
         @type response: L{OpenIDResponse}
 
         @returns: A signed copy of the response.
         @returntype: L{OpenIDResponse}
         """
-        signed_response = deepcopy(response)
+        with trace(self.tracer, 'sign') as phase:
+            signed_response, assoc = self._sign(response)
+            phase.set('assoc_type', assoc.assoc_type)
+        return signed_response
+
+    def _sign(self, response):
+        """Sign a response, see L{sign}.
+
+        @returns: A signed copy of the response and the association used.
+        @returntype: Tuple[L{OpenIDResponse}, L{openid.association.Association}]
+        """
+        signed_response = copy.copy(response)
+        fields = response.fields
         assoc_handle = response.request.assoc_handle
         if assoc_handle:
             # normal mode
@@ -1225,8 +1463,8 @@ class Signatory(object):
 
             if not assoc or assoc.expiresIn <= 0:
                 # fall back to dumb mode
-                signed_response.fields.setArg(
-                    OPENID_NS, 'invalidate_handle', assoc_handle)
+                fields = fields.copy()
+                fields.setArg(OPENID_NS, 'invalidate_handle', assoc_handle)
                 assoc_type = assoc and assoc.assoc_type or 'HMAC-SHA1'
                 if assoc and assoc.expiresIn <= 0:
                     # now do the clean-up that the disabled checkExpiration
@@ -1238,10 +1476,10 @@ class Signatory(object):
             assoc = self.createAssociation(dumb=True)
 
         try:
-            signed_response.fields = assoc.signMessage(signed_response.fields)
+            signed_response.fields = assoc.signMessage(fields)
         except kvform.KVFormError as err:
             raise EncodingError(response, explanation=six.text_type(err))
-        return signed_response
+        return signed_response, assoc
 
     def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1'):
         """Make a new association.
@@ -1257,21 +1495,36 @@ class Signatory(object):
         @returntype: L{openid.association.Association}
         """
         assoc_type = string_to_text(assoc_type, "Binary values for assoc_type are deprecated. Use text input instead.")
-
-        secret = os.urandom(getSecretSize(assoc_type))
-        uniq = oidutil.toBase64(os.urandom(4))
-        handle = '{%s}{%x}{%s}' % (assoc_type, int(time.time()), uniq)
-
-        assoc = Association.fromExpiresIn(
-            self.SECRET_LIFETIME, handle, secret, assoc_type)
-
         if dumb:
             key = self._dumb_key
         else:
             key = self._normal_key
-        self.store.storeAssociation(key, assoc)
+        assoc = self._generateAssociation(assoc_type, key)
+
+        with trace(self.tracer, 'store', operation='storeAssociation'):
+            self.store.storeAssociation(key, assoc)
+        self._cacheAssociation(key, assoc)
         return assoc
 
+    def _generateAssociation(self, assoc_type, key):
+        """Generate a new random association, but don't store it.
+
+        @param key: The store key of the association.
+        @type key: six.text_type
+
+        @rtype: L{openid.association.Association}
+        """
+        secret = os.urandom(getSecretSize(assoc_type))
+        uniq = oidutil.toBase64(os.urandom(4))
+        issued = int(time.time())
+        if self.handle_key is None:
+            handle = '{%s}{%x}{%s}' % (assoc_type, issued, uniq)
+        else:
+            handle_data = '{%s}{%x}{%s}' % (assoc_type, issued + self.SECRET_LIFETIME, uniq)
+            handle = '%s{%s}' % (handle_data, oidutil.toBase64(self._getHandleMAC(key, handle_data)))
+
+        return Association(handle, secret, issued, self.SECRET_LIFETIME, assoc_type)
+
     def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
         """Get the association with the specified handle.
 
@@ -1299,12 +1552,23 @@ class Signatory(object):
             key = self._dumb_key
         else:
             key = self._normal_key
-        assoc = self.store.getAssociation(key, assoc_handle)
+        if not self._checkHandle(key, assoc_handle, checkExpiration):
+            return None
+        assoc = None
+        if self.cache is not None and not dumb:
+            assoc = self.cache.get((key, assoc_handle))
+        if assoc is None:
+            with trace(self.tracer, 'store', operation='getAssociation'):
+                assoc = self.store.getAssociation(key, assoc_handle)
+            if assoc is not None and assoc.expiresIn > 0:
+                self._cacheAssociation(key, assoc)
         if assoc is not None and assoc.expiresIn <= 0:
             _LOGGER.info("requested %sdumb key %r is expired (by %s seconds)",
                          (not dumb) and 'not-' or '', assoc_handle, assoc.expiresIn)
             if checkExpiration:
-                self.store.removeAssociation(key, assoc_handle)
+                with trace(self.tracer, 'store', operation='removeAssociation'):
+                    self.store.removeAssociation(key, assoc_handle)
+                self._evictAssociation(key, assoc_handle)
                 assoc = None
         return assoc
 
@@ -1322,7 +1586,282 @@ class Signatory(object):
             key = self._normal_key
         assoc_handle = string_to_text(assoc_handle,
                                       "Binary values for assoc_handle are deprecated. Use text input instead.")
-        self.store.removeAssociation(key, assoc_handle)
+        if not self._checkHandle(key, assoc_handle, checkExpiration=False):
+            return
+        with trace(self.tracer, 'store', operation='removeAssociation'):
+            self.store.removeAssociation(key, assoc_handle)
+        self._evictAssociation(key, assoc_handle)
+
+    def invalidateAll(self, assoc_handles, dumb):
+        """Invalidates the associations with the given handles.
+
+        The associations are removed by a single call of the store's
+        C{removeAssociations} method, if the store has one.
+
+        @type assoc_handles: Sequence[six.text_type]
+
+        @param dumb: Are these associations used with dumb mode?
+        @type dumb: bool
+        """
+        if dumb:
+            key = self._dumb_key
+        else:
+            key = self._normal_key
+        assoc_handles = [h for h in assoc_handles if self._checkHandle(key, h, checkExpiration=False)]
+        if not assoc_handles:
+            return
+        remove = getattr(self.store, 'removeAssociations', None)
+        if remove is None:
+            for assoc_handle in assoc_handles:
+                with trace(self.tracer, 'store', operation='removeAssociation'):
+                    self.store.removeAssociation(key, assoc_handle)
+        else:
+            with trace(self.tracer, 'store', operation='removeAssociations'):
+                remove(key, assoc_handles)
+        for assoc_handle in assoc_handles:
+            self._evictAssociation(key, assoc_handle)
+
+
+class RevocationSet(object):
+    """In-process set of revoked association handles.
+
+    Handles are kept only until they expire, since an expired association is
+    rejected anyway. The set is thread-safe, it is shared by all threads using
+    the signatory.
+
+    Revocations are not shared between processes. If more processes verify
+    signatures for the same OP, provide an object with the same interface
+    backed by a shared storage.
+    """
+
+    cleanup_interval = 60
+
+    def __init__(self):
+        self._handles = {}
+        self._next_cleanup = 0
+        self._lock = threading.Lock()
+
+    def add(self, handle, expires):
+        """Revoke the handle until the C{expires} timestamp."""
+        now = int(time.time())
+        with self._lock:
+            self._handles[handle] = expires
+            if now >= self._next_cleanup:
+                self._cleanup(now)
+
+    def cleanup(self, now=None):
+        """Remove expired handles.
+
+        @return: the number of removed handles.
+        @rtype: int
+        """
+        if now is None:
+            now = int(time.time())
+        with self._lock:
+            return self._cleanup(now)
+
+    def _cleanup(self, now):
+        """Remove expired handles, the lock must be held."""
+        self._next_cleanup = now + self.cleanup_interval
+        expired = [handle for handle, expires in six.iteritems(self._handles) if expires <= now]
+        for handle in expired:
+            del self._handles[handle]
+        return len(expired)
+
+    def __contains__(self, handle):
+        with self._lock:
+            expires = self._handles.get(handle)
+        return expires is not None and expires > time.time()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._handles)
+
+
+class DerivedKeySignatory(Signatory):
+    """I sign things with associations derived from a master key.
+
+    The secret of each association is derived from a master key by HKDF over
+    the association handle. The handle itself encodes the key ID, association
+    type, expiration and the mode of the association, so the association can
+    be rebuilt from its handle without any access to the store.
+
+    Master keys can be rotated. New associations are always created with the
+    current key, associations created with other known keys remain valid
+    until they expire. Invalidated associations are recorded in a revocation
+    set.
+
+    Example::
+
+        signatory_class = functools.partial(DerivedKeySignatory, master_keys={'k1': key}, current_key_id='k1')
+        oserver = Server(store, "http://example.com/op", signatoryClass=signatory_class)
+
+    @ivar master_keys: Master keys indexed by their key IDs.
+    @type master_keys: Dict[six.text_type, six.binary_type]
+
+    @ivar current_key_id: ID of the key used to create new associations.
+    @type current_key_id: six.text_type
+
+    @ivar revoked: Set of invalidated association handles.
+    @type revoked: L{RevocationSet}
+
+    @ivar namespace: Namespace mixed into the derived secrets, so the
+        associations aren't valid for signatories with other namespaces.
+    @type namespace: Optional[six.text_type]
+    """
+
+    _handle_re = re.compile(r'^\{(?P<assoc_type>[^{}]+)\}\{(?P<key_id>[^{}]+)\}\{(?P<expires>[0-9a-f]+)\}'
+                            r'\{(?P<mode>[dn])\}\{(?P<uniq>[^{}]+)\}$')
+
+    def __init__(self, store=None, master_keys=None, current_key_id=None, revoked=None, namespace=None):
+        """Create a new DerivedKeySignatory.
+
+        @param store: Unused, accepted for compatibility with L{Signatory}.
+        @type store: L{openid.store.interface.OpenIDStore}
+
+        @param master_keys: Master keys indexed by their key IDs. If not
+            provided, a random key is generated for this process only.
+        @type master_keys: Dict[six.text_type, six.binary_type]
+
+        @param current_key_id: ID of the key used to create new associations.
+            May be omitted if there is only one master key.
+        @type current_key_id: six.text_type
+
+        @param revoked: Set of revoked handles, L{RevocationSet} by default.
+
+        @param namespace: Namespace of my associations, usually the OP
+            endpoint URL.
+        @type namespace: Optional[six.text_type]
+        """
+        self.store = store
+        self.namespace = namespace
+        if master_keys is None:
+            master_keys = {'default': os.urandom(32)}
+        if not master_keys:
+            raise ValueError("At least one master key is required.")
+        for key_id in master_keys:
+            if not key_id or '{' in key_id or '}' in key_id:
+                raise ValueError("Invalid master key ID %r" % (key_id,))
+        if current_key_id is None:
+            if len(master_keys) > 1:
+                raise ValueError("current_key_id is required for more than one master key.")
+            current_key_id = next(iter(master_keys))
+        if current_key_id not in master_keys:
+            raise ValueError("Unknown master key ID %r" % (current_key_id,))
+        self.master_keys = dict(master_keys)
+        self.current_key_id = current_key_id
+        if revoked is None:
+            revoked = RevocationSet()
+        self.revoked = revoked
+
+    def _deriveSecret(self, key_id, handle, assoc_type):
+        """Return the association secret for the handle."""
+        info = handle
+        if self.namespace is not None:
+            info = '%s|%s' % (self.namespace, handle)
+        kdf = HKDF(algorithm=hashes.SHA256(), length=getSecretSize(assoc_type), salt=None,
+                   info=info.encode('utf-8'), backend=default_backend())
+        return kdf.derive(self.master_keys[key_id])
+
+    def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1'):
+        """Make a new association.
+
+        The association is not stored anywhere, its secret is derived from
+        the current master key.
+
+        @param dumb: Is this association for a dumb-mode transaction?
+        @type dumb: bool
+
+        @param assoc_type: The type of association to create.
+        @type assoc_type: six.text_type, six.binary_type is deprecated
+
+        @returns: the new association.
+        @returntype: L{openid.association.Association}
+        """
+        assoc_type = string_to_text(assoc_type, "Binary values for assoc_type are deprecated. Use text input instead.")
+        issued = int(time.time())
+        uniq = oidutil.toBase64(os.urandom(6))
+        handle = '{%s}{%s}{%x}{%s}{%s}' % (assoc_type, self.current_key_id, issued + self.SECRET_LIFETIME,
+                                           dumb and 'd' or 'n', uniq)
+        secret = self._deriveSecret(self.current_key_id, handle, assoc_type)
+        return Association(handle, secret, issued, self.SECRET_LIFETIME, assoc_type)
+
+    def _parseHandle(self, assoc_handle):
+        """Parse the association handle.
+
+        @returns: Tuple of association type, key ID, expiration and dumb flag or C{None} if the handle is not valid.
+        @rtype: Optional[Tuple[six.text_type, six.text_type, int, bool]]
+        """
+        match = self._handle_re.match(assoc_handle)
+        if match is None:
+            return None
+        if match.group('key_id') not in self.master_keys:
+            return None
+        if match.group('assoc_type') not in all_association_types:
+            return None
+        return (match.group('assoc_type'), match.group('key_id'), int(match.group('expires'), 16),
+                match.group('mode') == 'd')
+
+    def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
+        """Rebuild the association with the specified handle.
+
+        @type assoc_handle: six.text_type, six.binary_type is deprecated
+
+        @param dumb: Is this association used with dumb mode?
+        @type dumb: bool
+
+        @returns: the association, or None if no valid association with that
+            handle was found.
+        @returntype: L{openid.association.Association}
+        """
+        if assoc_handle is None:
+            raise ValueError("assoc_handle must not be None")
+        assoc_handle = string_to_text(assoc_handle,
+                                      "Binary values for assoc_handle are deprecated. Use text input instead.")
+
+        parsed = self._parseHandle(assoc_handle)
+        if parsed is None:
+            return None
+        assoc_type, key_id, expires, handle_dumb = parsed
+        if handle_dumb != bool(dumb) or assoc_handle in self.revoked:
+            return None
+
+        secret = self._deriveSecret(key_id, assoc_handle, assoc_type)
+        assoc = Association(assoc_handle, secret, expires - self.SECRET_LIFETIME, self.SECRET_LIFETIME, assoc_type)
+        if assoc.expiresIn <= 0:
+            _LOGGER.info("requested %sdumb key %r is expired (by %s seconds)",
+                         (not dumb) and 'not-' or '', assoc_handle, assoc.expiresIn)
+            if checkExpiration:
+                assoc = None
+        return assoc
+
+    def invalidate(self, assoc_handle, dumb):
+        """Invalidates the association with the given handle.
+
+        @type assoc_handle: six.text_type, six.binary_type is deprecated
+
+        @param dumb: Is this association used with dumb mode?
+        @type dumb: bool
+        """
+        assoc_handle = string_to_text(assoc_handle,
+                                      "Binary values for assoc_handle are deprecated. Use text input instead.")
+        parsed = self._parseHandle(assoc_handle)
+        if parsed is None:
+            return
+        assoc_type, key_id, expires, handle_dumb = parsed
+        if handle_dumb == bool(dumb) and expires > time.time():
+            self.revoked.add(assoc_handle, expires)
+
+    def invalidateAll(self, assoc_handles, dumb):
+        """Invalidates the associations with the given handles.
+
+        @type assoc_handles: Sequence[six.text_type]
+
+        @param dumb: Are these associations used with dumb mode?
+        @type dumb: bool
+        """
+        for assoc_handle in assoc_handles:
+            self.invalidate(assoc_handle, dumb)
 
 
 class Encoder(object):
@@ -1332,9 +1871,13 @@ class Encoder(object):
     your own handling of L{OpenIDResponses<OpenIDResponse>} with
     L{OpenIDResponse.whichEncoding}, L{OpenIDResponse.encodeToURL}, and
     L{OpenIDResponse.encodeToKVForm}.
+
+    @ivar tracer: Tracer of the encoding, set by the L{Server}.
+    @type tracer: Optional[L{openid.tracing.Tracer}]
     """
 
     responseFactory = WebResponse
+    tracer = None
 
     def encode(self, response):
         """Encode a response to a L{WebResponse}.
@@ -1342,7 +1885,13 @@ class Encoder(object):
         @raises EncodingError: When I can't figure out how to encode this
             message.
         """
-        encode_as = response.whichEncoding()
+        with trace(self.tracer, 'encode') as phase:
+            encode_as = response.whichEncoding()
+            phase.set('encoding', encode_as and encode_as[0])
+            return self._encode(response, encode_as)
+
+    def _encode(self, response, encode_as):
+        """Encode a response to a L{WebResponse}, see L{encode}."""
         if encode_as == ENCODE_KVFORM:
             wr = self.responseFactory(body=response.encodeToKVForm())
             if isinstance(response, Exception):
@@ -1416,6 +1965,11 @@ class Decoder(object):
         """
         self.server = server
 
+    @property
+    def tracer(self):
+        """Return the tracer of my server."""
+        return getattr(self.server, 'tracer', None)
+
     def decode(self, query):
         """I transform query parameters into an L{OpenIDRequest}.
 
@@ -1434,6 +1988,17 @@ class Decoder(object):
         if not query:
             return None
 
+        tracer = self.tracer
+        with trace(tracer, 'decode') as phase:
+            request = self._decode(query)
+            if request is not None:
+                phase.set('mode', request.mode)
+                if tracer is not None:
+                    request.tracer = tracer
+        return request
+
+    def _decode(self, query):
+        """Transform query parameters into an L{OpenIDRequest}, see L{decode}."""
         try:
             message = Message.fromPostArgs(query)
         except InvalidOpenIDNamespace as err:
@@ -1518,13 +2083,22 @@ class Server(object):
     @ivar negotiator: I use this to determine which kinds of
         associations I can make and how.
     @type negotiator: L{openid.association.SessionNegotiator}
+
+    @ivar executor: I use this to run CPU intensive parts of the requests
+        in L{handleRequestAsync}.
+    @type executor: Optional[concurrent.futures.Executor]
+
+    @ivar tracer: I report the timing of request processing phases to this,
+        see L{openid.tracing}.
+    @type tracer: Optional[L{openid.tracing.Tracer}]
     """
 
     signatoryClass = Signatory
     encoderClass = SigningEncoder
     decoderClass = Decoder
 
-    def __init__(self, store, op_endpoint=None, signatoryClass=None, encoderClass=None, decoderClass=None):
+    def __init__(self, store, op_endpoint=None, signatoryClass=None, encoderClass=None, decoderClass=None,
+                 executor=None, tracer=None):
         """A new L{Server}.
 
         @param store: The back-end where my associations are stored.
@@ -1534,6 +2108,13 @@ class Server(object):
             server's endpoint, i.e. C{http://example.com/server}
         @type op_endpoint: six.text_type, six.binary_type is deprecated
 
+        @param executor: Executor for CPU intensive parts of the requests,
+            e.g. C{concurrent.futures.ProcessPoolExecutor}.
+        @type executor: Optional[concurrent.futures.Executor]
+
+        @param tracer: Tracer of request processing phases.
+        @type tracer: Optional[L{openid.tracing.Tracer}]
+
         @change: C{op_endpoint} is new in library version 2.0.  It
             currently defaults to C{None} for compatibility with
             earlier versions of the library, but you must provide it
@@ -1559,6 +2140,11 @@ class Server(object):
                               "Use decoderClass argument of __init__ instead.", DeprecationWarning)
         self.decoder = decoderClass(self)
         self.negotiator = default_negotiator.copy()
+        self.executor = executor
+        self.tracer = tracer
+        if tracer is not None:
+            self.signatory.tracer = tracer
+            self.encoder.tracer = tracer
 
         if not op_endpoint:
             warnings.warn("%s.%s constructor requires op_endpoint parameter "
@@ -1583,12 +2169,110 @@ class Server(object):
         """
         handler = getattr(self, 'openid_' + request.mode, None)
         if handler is not None:
-            return handler(request)
+            with trace(self.tracer, 'handle', mode=request.mode, assoc_type=getattr(request, 'assoc_type', None)):
+                return handler(request)
         else:
             raise NotImplementedError(
                 "%s has no handler for a request of mode %r." %
                 (self, request.mode))
 
+    def handleRequests(self, requests):
+        """Handle many requests, e.g. from a pipelined HTTP connection.
+
+        C{check_authentication} requests are answered together by
+        L{CheckAuthRequest.answerAll}, other requests are handled one by one
+        by L{handleRequest}.
+
+        @param requests: The requests to handle.
+        @type requests: Sequence[L{OpenIDRequest}]
+
+        @raises NotImplementedError: When I do not have a handler defined
+            for the type of any of the requests.
+
+        @returns: The responses in the order of the requests.
+        @rtype: List[L{OpenIDResponse}]
+        """
+        responses = [None] * len(requests)
+        check_auth = []
+        for index, request in enumerate(requests):
+            if request.mode == CheckAuthRequest.mode and isinstance(request, CheckAuthRequest):
+                check_auth.append(index)
+            else:
+                responses[index] = self.handleRequest(request)
+        if check_auth:
+            with trace(self.tracer, 'handle', mode=CheckAuthRequest.mode, batch=True):
+                answers = CheckAuthRequest.answerAll([requests[index] for index in check_auth], self.signatory)
+            for index, response in zip(check_auth, answers):
+                responses[index] = response
+        return responses
+
+    def handleRequestAsync(self, request):
+        """Handle a request asynchronously.
+
+        Diffie-Hellman key exchange for association requests is run in my
+        L{executor<Server.executor>}. Other requests are handled immediately.
+
+        In asyncio code, wrap the future with C{asyncio.wrap_future}.
+
+        @raises NotImplementedError: When I do not have a handler defined
+            for that type of request.
+
+        @returns: Future with the L{OpenIDResponse}.
+        @returntype: concurrent.futures.Future
+        """
+        if futures is None:
+            raise RuntimeError("Asynchronous request handling requires concurrent.futures.")
+        if self.executor is not None and request.mode == 'associate':
+            future = self._associateAsync(request)
+            if future is not None:
+                return future
+
+        future = futures.Future()
+        try:
+            response = self.handleRequest(request)
+        except NotImplementedError:
+            raise
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+        return future
+
+    def _associateAsync(self, request):
+        """Answer the association request with Diffie-Hellman session in the executor.
+
+        @returns: Future with the L{OpenIDResponse} or C{None} if the request can't be answered in the executor.
+        @returntype: Optional[concurrent.futures.Future]
+        """
+        session = request.session
+        if not isinstance(session, DiffieHellmanSHA1ServerSession) or session.hash_func is not None:
+            return None
+        if not self.negotiator.isAllowed(request.assoc_type, session.session_type):
+            return None
+
+        assoc = self.signatory.createAssociation(dumb=False, assoc_type=request.assoc_type)
+        modulus, generator = session.dh.parameters
+        job = self.executor.submit(_answerSession, type(session), modulus, generator, session.consumer_public_key,
+                                   assoc.secret)
+        future = futures.Future()
+        # The job can't be cancelled through the future, the association is already stored.
+        future.set_running_or_notify_cancel()
+
+        def _done(job):
+            try:
+                response = request._answer(assoc, job.result())
+            except Exception as error:
+                try:
+                    # Nobody receives the association, don't keep it in the store until it expires.
+                    self.signatory.invalidate(assoc.handle, dumb=False)
+                finally:
+                    future.set_exception(error)
+            else:
+                future.set_result(response)
+
+        job.add_done_callback(_done)
+        return future
+
     def openid_check_authentication(self, request):
         """Handle and respond to C{check_authentication} requests.
 
@@ -1651,6 +2335,185 @@ class Server(object):
         return self.encoder.encode(response)
 
 
+class MultiTenantServer(object):
+    """I host many OpenID providers, each with its own OP endpoint.
+
+    Each tenant is served by a lightweight L{Server}. All tenants share the
+    store, the association cache, the tracer, the executor and the
+    association negotiator. Associations of each tenant are kept in their own
+    namespace of the store, so an association made with one OP endpoint
+    can't be used with another one. Diffie-Hellman keys are shared through
+    the default L{DiffieHellmanKeyPool<openid.dh.DiffieHellmanKeyPool>} and
+    the return_to verification through the default
+    L{RealmVerificationCache<openid.server.trustroot.RealmVerificationCache>}.
+
+    Example::
+
+        oserver = MultiTenantServer(store, association_cache=LRUCache(10000))
+        for op_endpoint in op_endpoints:
+            oserver.addTenant(op_endpoint)
+        ...
+        op_endpoint = 'https://%s/openid' % host
+        request = oserver.decodeRequest(op_endpoint, query)
+        if request.mode in BROWSER_REQUEST_MODES:
+            ...
+        else:
+            response = oserver.handleRequest(op_endpoint, request)
+        webresponse = oserver.encodeResponse(op_endpoint, response)
+
+    The tenants are looked up by the exact OP endpoint URL.
+
+    @ivar negotiator: Association negotiator shared by all tenants.
+    @type negotiator: L{openid.association.SessionNegotiator}
+    """
+
+    def __init__(self, store, signatoryClass=Signatory, encoderClass=SigningEncoder, decoderClass=Decoder,
+                 executor=None, tracer=None, association_cache=None):
+        """Create a new L{MultiTenantServer} without any tenants.
+
+        @param store: The back-end where associations of all tenants are stored.
+        @type store: L{openid.store.interface.OpenIDStore}
+
+        @param signatoryClass: Signatory class, it is called with the store
+            and C{namespace} and C{cache} keyword arguments.
+
+        @param executor: Executor for CPU intensive parts of the requests.
+        @type executor: Optional[concurrent.futures.Executor]
+
+        @param tracer: Tracer of request processing phases.
+        @type tracer: Optional[L{openid.tracing.Tracer}]
+
+        @param association_cache: Cache of associations shared by all tenants.
+        @type association_cache: Optional[L{openid.cache.LRUCache}]
+        """
+        self.store = store
+        self.signatoryClass = signatoryClass
+        self.encoderClass = encoderClass
+        self.decoderClass = decoderClass
+        self.executor = executor
+        self.tracer = tracer
+        self.association_cache = association_cache
+        self.negotiator = default_negotiator.copy()
+        self._tenants = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def addTenant(self, op_endpoint):
+        """Add a tenant, if it doesn't exist yet.
+
+        @param op_endpoint: The OP endpoint URL of the tenant.
+        @type op_endpoint: six.text_type
+
+        @return: The server of the tenant.
+        @rtype: L{Server}
+        """
+        with self._lock:
+            server = self._tenants.get(op_endpoint)
+            if server is None:
+                server = self._tenants[op_endpoint] = self._createServer(op_endpoint)
+                self._metrics[op_endpoint] = Counter()
+        return server
+
+    def _createServer(self, op_endpoint):
+        """Return a new server for the tenant."""
+        signatory_kwargs = {'namespace': op_endpoint}
+        if self.association_cache is not None:
+            signatory_kwargs['cache'] = self.association_cache
+        signatoryClass = functools.partial(self.signatoryClass, **signatory_kwargs)
+        server = Server(self.store, op_endpoint, signatoryClass=signatoryClass, encoderClass=self.encoderClass,
+                        decoderClass=self.decoderClass, executor=self.executor, tracer=self.tracer)
+        server.negotiator = self.negotiator
+        return server
+
+    def removeTenant(self, op_endpoint):
+        """Remove the tenant and its metrics.
+
+        Associations of the tenant are left in the store until they expire.
+
+        @raises KeyError: If there is no such tenant.
+        """
+        with self._lock:
+            del self._tenants[op_endpoint]
+            del self._metrics[op_endpoint]
+
+    def getServer(self, op_endpoint):
+        """Return the server of the tenant.
+
+        @raises KeyError: If there is no such tenant.
+
+        @rtype: L{Server}
+        """
+        return self._tenants[op_endpoint]
+
+    def __contains__(self, op_endpoint):
+        return op_endpoint in self._tenants
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def _count(self, op_endpoint, name):
+        """Increment the tenant's counter."""
+        with self._lock:
+            metrics = self._metrics.get(op_endpoint)
+            if metrics is not None:
+                metrics[name] += 1
+
+    def getMetrics(self, op_endpoint):
+        """Return the metrics of the tenant.
+
+        The metrics contain the number of decoded requests by their mode,
+        the number of C{protocol_error}s raised while decoding requests and
+        the number of C{encoding_error}s raised while encoding responses.
+
+        @raises KeyError: If there is no such tenant.
+
+        @rtype: Dict[six.text_type, int]
+        """
+        with self._lock:
+            return dict(self._metrics[op_endpoint])
+
+    def decodeRequest(self, op_endpoint, query):
+        """Decode the request for the tenant, see L{Server.decodeRequest}.
+
+        @raises KeyError: If there is no such tenant.
+        """
+        server = self.getServer(op_endpoint)
+        try:
+            request = server.decodeRequest(query)
+        except ProtocolError:
+            self._count(op_endpoint, 'protocol_error')
+            raise
+        if request is not None:
+            self._count(op_endpoint, request.mode)
+        return request
+
+    def handleRequest(self, op_endpoint, request):
+        """Handle the request for the tenant, see L{Server.handleRequest}.
+
+        @raises KeyError: If there is no such tenant.
+        """
+        return self.getServer(op_endpoint).handleRequest(request)
+
+    def handleRequestAsync(self, op_endpoint, request):
+        """Handle the request for the tenant asynchronously, see L{Server.handleRequestAsync}.
+
+        @raises KeyError: If there is no such tenant.
+        """
+        return self.getServer(op_endpoint).handleRequestAsync(request)
+
+    def encodeResponse(self, op_endpoint, response):
+        """Encode the response for the tenant, see L{Server.encodeResponse}.
+
+        @raises KeyError: If there is no such tenant.
+        """
+        server = self.getServer(op_endpoint)
+        try:
+            return server.encodeResponse(response)
+        except EncodingError:
+            self._count(op_endpoint, 'encoding_error')
+            raise
+
+
 class ProtocolError(Exception):
     """A message did not conform to the OpenID protocol.
 
@@ -11,19 +11,27 @@ from __future__ import unicode_literals
 
 import logging
 import re
+import time
 
 import six
 from six.moves.urllib.parse import urlsplit, urlunsplit
 
 from openid import urinorm
+from openid.cache import LRUCache, SingleFlight, copyException
+from openid.fetchers import HTTPFetchingError
 from openid.oidutil import string_to_text
 from openid.yadis import services
+from openid.yadis.discover import DiscoveryFailure
 
 __all__ = [
     'TrustRoot',
     'RP_RETURN_TO_URL_TYPE',
+    'RealmIndex',
+    'RealmVerificationCache',
     'getAllowedReturnURLs',
+    'getDefaultVerificationCache',
     'returnToMatches',
+    'setDefaultVerificationCache',
     'verifyReturnTo',
 ]
 
@@ -99,6 +107,13 @@ def _parseURL(url):
     return split_url.scheme, split_url.hostname, split_url.port, path
 
 
+def _hostKey(host):
+    """Return the host labels in the reversed order, i.e. starting with top level domain."""
+    if not host:
+        return ()
+    return tuple(reversed(host.split('.')))
+
+
 class TrustRoot(object):
     """
     This class represents an OpenID trust root.  The C{L{parse}}
@@ -191,7 +206,14 @@ class TrustRoot(object):
         url_parts = _parseURL(url)
         if url_parts is None:
             return False
+        return self._validateParts(url_parts)
 
+    def _validateParts(self, url_parts):
+        """Validates a parsed URL against this trust root.
+
+        @param url_parts: The URL parsed by C{_parseURL}.
+        @rtype: C{bool}
+        """
         proto, host, port, path = url_parts
 
         if proto != self.proto:
@@ -279,6 +301,44 @@ class TrustRoot(object):
 
         return tr
 
+    @classmethod
+    def parseCached(cls, trust_root):
+        """
+        Same as C{L{parse}}, but the parsed trust roots are cached.
+
+        The returned C{L{TrustRoot}} instance is shared and must not be
+        modified.
+
+        @param trust_root: This is the trust root to parse into a
+        C{L{TrustRoot}} object.
+        @type trust_root: six.text_type
+
+        @return: A C{L{TrustRoot}} instance if trust_root parses as a
+        trust root, C{None} otherwise.
+
+        @rtype: C{NoneType} or C{L{TrustRoot}}
+        """
+        key = (cls, trust_root)
+        # Unparsable trust roots are cached as False, since None means a cache miss.
+        tr = _parsed_trust_roots.get(key)
+        if tr is None:
+            tr = cls.parse(trust_root) or False
+            _parsed_trust_roots.set(key, tr)
+        return tr or None
+
+    def hostKey(self):
+        """Return the host labels of this trust root in the reversed order.
+
+        For wildcard trust roots the labels of the domain under the wildcard
+        are returned.
+
+        @rtype: Tuple[six.text_type, ...]
+        """
+        if self.wildcard:
+            # Remove the leading dot
+            return _hostKey(self.host[1:])
+        return _hostKey(self.host)
+
     @classmethod
     def checkSanity(cls, trust_root_string):
         """six.text_type -> bool, six.binary_type is deprecated
@@ -332,6 +392,114 @@ class TrustRoot(object):
         return repr(self)
 
 
+# Cache of parsed trust roots used by TrustRoot.parseCached
+_parsed_trust_roots = LRUCache(10000)
+
+
+class _RealmIndexNode(object):
+    """Node of a host label trie in L{RealmIndex}."""
+
+    __slots__ = ('children', 'exact', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        # Realms with this exact host
+        self.exact = []
+        # Wildcard realms covering this host and its subdomains
+        self.wildcard = []
+
+
+class RealmIndex(object):
+    """Index of realms for finding the realm which matches a URL.
+
+    The realms are stored in a trie keyed by host labels starting with
+    the top level domain, so the lookup time depends on the number of labels
+    in the URL host, not on the number of realms in the index.
+
+    Example::
+
+        index = RealmIndex(['http://*.example.com/', 'https://example.org/openid/'])
+        realm = index.match('https://example.org/openid/return')
+    """
+
+    def __init__(self, realms=()):
+        """Create a new index.
+
+        @param realms: Realms to add to the index.
+        @type realms: Iterable[six.text_type]
+        """
+        self._root = _RealmIndexNode()
+        self._size = 0
+        for realm in realms:
+            self.add(realm)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, realm):
+        """Add a realm to the index.
+
+        @param realm: The realm to add.
+        @type realm: six.text_type, L{TrustRoot}
+
+        @return: The parsed realm.
+        @rtype: L{TrustRoot}
+
+        @raises ValueError: If the realm can't be parsed.
+        """
+        if not isinstance(realm, TrustRoot):
+            parsed = TrustRoot.parse(realm)
+            if parsed is None:
+                raise ValueError("Invalid realm: %r" % (realm, ))
+            realm = parsed
+
+        node = self._root
+        for label in realm.hostKey():
+            node = node.children.setdefault(label, _RealmIndexNode())
+        if realm.wildcard:
+            node.wildcard.append(realm)
+        else:
+            node.exact.append(realm)
+        self._size += 1
+        return realm
+
+    def match(self, url):
+        """Return the most specific realm which matches the URL.
+
+        Realms with an exact host take precedence over the wildcard realms,
+        the wildcard realms with longer domain take precedence over the shorter ones.
+        Realms with the same host are tried in the order they were added.
+
+        @param url: The URL to match, e.g. return_to URL.
+        @type url: six.text_type
+
+        @return: The matching realm or C{None} if no realm matches.
+        @rtype: Optional[L{TrustRoot}]
+        """
+        url_parts = _parseURL(url)
+        if url_parts is None or url_parts[1] is None:
+            return None
+
+        # Collect the nodes on the path, the deepest is the most specific.
+        node = self._root
+        nodes = [node]
+        for label in _hostKey(url_parts[1]):
+            node = node.children.get(label)
+            if node is None:
+                break
+            nodes.append(node)
+        else:
+            for realm in node.exact:
+                if realm._validateParts(url_parts):
+                    return realm
+
+        for node in reversed(nodes):
+            for realm in node.wildcard:
+                if realm._validateParts(url_parts):
+                    return realm
+        return None
+
+
 # The URI for relying party discovery, used in realm verification.
 #
 # XXX: This should probably live somewhere else (like in
@@ -368,6 +536,10 @@ def returnToMatches(allowed_return_to_urls, return_to):
 
     @since: 2.1.0
     """
+    return_to = string_to_text(return_to, "Binary values for returnToMatches are deprecated. Use text input instead.")
+    return_to_parts = _parseURL(return_to)
+    if return_to_parts is None:
+        return False
 
     for allowed_return_to in allowed_return_to_urls:
         # A return_to pattern works the same as a realm, except that
@@ -375,7 +547,7 @@ def returnToMatches(allowed_return_to_urls, return_to):
         # parsing it as a realm, and not trying to match it if it has
         # a wildcard.
 
-        return_realm = TrustRoot.parse(allowed_return_to)
+        return_realm = TrustRoot.parseCached(allowed_return_to)
         if (
             # Parses as a trust root
             return_realm is not None
@@ -384,7 +556,7 @@ def returnToMatches(allowed_return_to_urls, return_to):
             and not return_realm.wildcard
 
             # Matches the return_to that we passed in with it
-            and return_realm.validateURL(return_to)
+            and return_realm._validateParts(return_to_parts)
         ):
             return True
 
@@ -407,10 +579,170 @@ def getAllowedReturnURLs(relying_party_url):
 
     return return_to_urls
 
-# _vrfy parameter is there to make testing easier
 
+def _getAllowedReturnURLsExpiration(relying_party_url):
+    """Given a relying party discovery URL return a list of return_to URLs and their expiration.
+
+    @return: The list of return_to URLs and the expiration timestamp or C{None} if it isn't defined.
+    @rtype: Tuple[List[six.text_type], Optional[float]]
+    """
+    return _extractReturnURLsExpiration(
+        relying_party_url, services.getServiceEndpointsExpiration(relying_party_url, _extractReturnURL))
+
+
+def _extractReturnURLsExpiration(relying_party_url, endpoints_expiration):
+    """Check the relying party discovery result and return a list of return_to URLs and their expiration.
+
+    @param endpoints_expiration: The result of relying party discovery filtered by C{_extractReturnURL}.
+    @type endpoints_expiration: Tuple[six.text_type, List[six.text_type], Optional[float]]
+
+    @rtype: Tuple[List[six.text_type], Optional[float]]
+    """
+    (rp_url_after_redirects, return_to_urls, expires) = endpoints_expiration
+
+    if urinorm.urinorm(rp_url_after_redirects) != urinorm.urinorm(relying_party_url):
+        # Verification caused a redirect
+        raise RealmVerificationRedirected(
+            relying_party_url, rp_url_after_redirects)
+
+    return return_to_urls, expires
+
+
+class RealmVerificationCache(object):
+    """Cache of allowed return_to URLs of relying parties.
+
+    The allowed return_to URLs are cached by the relying party discovery URL
+    until the expiration defined by the XRD C{Expires} element or HTTP cache
+    headers, or for C{default_ttl} seconds if no expiration is defined.
+    Failed discoveries and redirects are cached for C{negative_ttl} seconds.
+
+    Concurrent requests for the same relying party share a single discovery.
+
+    Example::
+
+        setDefaultVerificationCache(RealmVerificationCache())
+
+    @ivar default_ttl: Number of seconds to cache the return_to URLs if the relying party doesn't define expiration.
+    @type default_ttl: int
+
+    @ivar min_ttl: Minimal number of seconds to cache the return_to URLs.
+    @type min_ttl: int
+
+    @ivar max_ttl: Maximal number of seconds to cache the return_to URLs.
+    @type max_ttl: int
+
+    @ivar negative_ttl: Number of seconds to cache failures.
+    @type negative_ttl: int
+
+    @cvar cached_errors: Exceptions which are cached as failures.
+    @type cached_errors: Tuple[Type[Exception], ...]
+    """
+
+    cached_errors = (DiscoveryFailure, HTTPFetchingError, RealmVerificationRedirected)
 
-def verifyReturnTo(realm_str, return_to, _vrfy=getAllowedReturnURLs):
+    def __init__(self, max_size=1000, default_ttl=3600, min_ttl=0, max_ttl=86400, negative_ttl=60):
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.cache = LRUCache(max_size)
+        self._single_flight = SingleFlight()
+
+    def getAllowedReturnURLs(self, relying_party_url):
+        """Given a relying party discovery URL return a list of return_to URLs.
+
+        @raises DiscoveryFailure: When Yadis discovery fails, possibly a cached failure.
+        @raises RealmVerificationRedirected: When the discovery redirects, possibly a cached redirect.
+        @rtype: List[six.text_type]
+        """
+        return_to_urls = self.get(relying_party_url)
+        if return_to_urls is None:
+            return_to_urls, error = self._single_flight.call(relying_party_url, self._discover, relying_party_url)
+            if error is not None:
+                raise copyException(error)
+        return return_to_urls
+
+    def _discover(self, relying_party_url):
+        """Run the discovery and cache its result.
+
+        @return: The return_to URLs and the error.
+        """
+        try:
+            return_to_urls, expires = _getAllowedReturnURLsExpiration(relying_party_url)
+        except self.cached_errors as error:
+            # Cache the error without its traceback, it would keep the frames of the discovery alive
+            error = copyException(error)
+            self.set(relying_party_url, None, error=error)
+            return None, error
+        self.set(relying_party_url, return_to_urls, expires)
+        return return_to_urls, None
+
+    def get(self, relying_party_url):
+        """Return the cached return_to URLs of the relying party.
+
+        @return: The return_to URLs or C{None} if they are not cached.
+        @rtype: Optional[List[six.text_type]]
+        @raises Exception: The cached failure of the discovery, see L{cached_errors}.
+        """
+        entry = self.cache.get(relying_party_url)
+        if entry is None:
+            return None
+        return_to_urls, error = entry
+        if error is not None:
+            raise copyException(error)
+        return return_to_urls
+
+    def set(self, relying_party_url, return_to_urls, expires=None, error=None):
+        """Cache the result of the discovery.
+
+        @param return_to_urls: The return_to URLs, C{None} if the discovery failed.
+        @type return_to_urls: Optional[List[six.text_type]]
+        @param expires: The expiration timestamp defined by the relying party.
+        @type expires: Optional[float]
+        @param error: The failure of the discovery, it's cached for C{negative_ttl} seconds.
+        @type error: Optional[Exception]
+        """
+        now = time.time()
+        if error is not None:
+            expires = now + self.negative_ttl
+        else:
+            if expires is None:
+                expires = now + self.default_ttl
+            expires = min(max(expires, now + self.min_ttl), now + self.max_ttl)
+        if expires > now:
+            self.cache.set(relying_party_url, (return_to_urls, error), expires=expires)
+
+    def invalidate(self, relying_party_url):
+        """Remove the relying party from the cache."""
+        self.cache.pop(relying_party_url)
+
+
+# Contains the currently set realm verification cache. If it is set to None,
+# return_to URLs are not cached. Do not access this variable outside of
+# this module.
+_default_verification_cache = None
+
+
+def getDefaultVerificationCache():
+    """Return the cache used by L{verifyReturnTo} or C{None} if it isn't set.
+
+    @rtype: Optional[RealmVerificationCache]
+    """
+    return _default_verification_cache
+
+
+def setDefaultVerificationCache(cache):
+    """Set the cache used by L{verifyReturnTo}.
+
+    @param cache: The cache or C{None} to disable caching.
+    @type cache: Optional[RealmVerificationCache]
+    """
+    global _default_verification_cache
+    _default_verification_cache = cache
+
+
+# _vrfy parameter is there to make testing easier
+def verifyReturnTo(realm_str, return_to, _vrfy=None):
     """Verify that a return_to URL is valid for the given realm.
 
     This function builds a discovery URL, performs Yadis discovery on
@@ -418,16 +750,25 @@ def verifyReturnTo(realm_str, return_to, _vrfy=getAllowedReturnURLs):
     return_to URLs, and finally checks to see if the current return_to
     URL matches the return_to.
 
+    If the default verification cache is set, the allowed return_to URLs
+    are taken from it.
+
     @raises DiscoveryFailure: When Yadis discovery fails
     @returns: True if the return_to URL is valid for the realm
 
     @since: 2.1.0
     """
-    realm = TrustRoot.parse(realm_str)
+    realm = TrustRoot.parseCached(realm_str)
     if realm is None:
         # The realm does not parse as a URL pattern
         return False
 
+    if _vrfy is None:
+        if _default_verification_cache is None:
+            _vrfy = getAllowedReturnURLs
+        else:
+            _vrfy = _default_verification_cache.getAllowedReturnURLs
+
     try:
         allowable_urls = _vrfy(realm.buildDiscoveryURL())
     except RealmVerificationRedirected as err:
@@ -108,6 +108,8 @@ class FileOpenIDStore(OpenIDStore):
 
         self.association_dir = os.path.join(directory, 'associations')
 
+        self.lease_dir = os.path.join(directory, 'leases')
+
         # Temp dir must be on the same filesystem as the assciations
         # directory
         self.temp_dir = os.path.join(directory, 'temp')
@@ -124,6 +126,7 @@ class FileOpenIDStore(OpenIDStore):
         """
         _ensureDir(self.nonce_dir)
         _ensureDir(self.association_dir)
+        _ensureDir(self.lease_dir)
         _ensureDir(self.temp_dir)
 
     def _mktemp(self):
@@ -344,6 +347,67 @@ class FileOpenIDStore(OpenIDStore):
             os.close(fd)
             return True
 
+    def _readLease(self, filename):
+        """Return the token and the expiration of the lease in the file
+        or C{None} if there is no lease.
+
+        six.text_type -> Optional[Tuple[six.text_type, int]]
+        """
+        try:
+            with open(filename, 'rb') as lease_file:
+                token, expires = lease_file.read().decode('utf-8').split()
+        except IOError as why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+        except ValueError:
+            # The lease is being created or it is corrupted, handle it as expired.
+            return ('', 0)
+        return token, int(expires)
+
+    def acquireLease(self, key, duration):
+        """Acquire the lease of the key.
+
+        The lease is created by linking a complete lease file, so it
+        never exists partially written. Expired lease is removed and
+        the lease is acquired again once.
+
+        (six.text_type, int) -> Optional[six.text_type]
+        """
+        filename = os.path.join(self.lease_dir, _safe64(key))
+        token = nonce.make_nonce_salt(16)
+        file_obj, tmp = self._mktemp()
+        try:
+            with file_obj:
+                file_obj.write(('%s %d' % (token, int(time.time() + duration))).encode('utf-8'))
+            for _ in range(2):
+                try:
+                    os.link(tmp, filename)
+                except OSError as why:
+                    if why.errno != EEXIST:
+                        raise
+                else:
+                    return token
+                lease = self._readLease(filename)
+                if lease is not None and lease[1] > time.time():
+                    return None
+                _removeIfPresent(filename)
+            return None
+        finally:
+            _removeIfPresent(tmp)
+
+    def releaseLease(self, key, token):
+        """Release the lease of the key, if it's still held with the token.
+
+        (six.text_type, six.text_type) -> bool
+        """
+        filename = os.path.join(self.lease_dir, _safe64(key))
+        lease = self._readLease(filename)
+        if lease is None or lease[0] != token:
+            return False
+        return bool(_removeIfPresent(filename))
+
     def _allAssocs(self):
         all_associations = []
 
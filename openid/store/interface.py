@@ -15,7 +15,7 @@ class OpenIDStore(object):
         C{L{cleanupAssociations}}, and C{L{cleanup}}.
 
     @sort: storeAssociation, getAssociation, removeAssociation,
-        useNonce
+        useNonce, acquireLease, releaseLease
     """
 
     def storeAssociation(self, server_url, association):
@@ -116,6 +116,31 @@ class OpenIDStore(object):
         """
         raise NotImplementedError
 
+    def removeAssociations(self, server_url, handles):
+        """
+        This method removes all the matching associations. Stores may
+        override it to remove the associations in one operation, this
+        implementation calls C{L{removeAssociation}} for each handle.
+
+
+        @param server_url: The URL of the identity server the
+            associations to remove belong to.
+        @type server_url: six.text_type
+
+        @param handles: The handles of the associations to remove.
+        @type handles: Sequence[six.text_type]
+
+
+        @return: Returns the number of removed associations.
+
+        @rtype: C{int}
+        """
+        removed = 0
+        for handle in handles:
+            if self.removeAssociation(server_url, handle):
+                removed += 1
+        return removed
+
     def useNonce(self, server_url, timestamp, salt):
         """Called when using a nonce.
 
@@ -151,6 +176,48 @@ class OpenIDStore(object):
         """
         raise NotImplementedError
 
+    def acquireLease(self, key, duration):
+        """Acquire the lease of the key.
+
+        Only one holder of the lease exists at a time, until the lease
+        is released by C{L{releaseLease}} or it expires. The consumer
+        uses the lease to negotiate only one association with an OP
+        endpoint among many processes.
+
+
+        @param key: The key of the lease, e.g. the URL of the identity
+            server.
+        @type key: six.text_type
+
+        @param duration: The number of seconds after which the lease
+            expires.
+        @type duration: C{int}
+
+
+        @return: The token of the lease, which releases it, or C{None}
+            if the lease is held by someone else.
+
+        @rtype: Optional[six.text_type]
+        """
+        raise NotImplementedError
+
+    def releaseLease(self, key, token):
+        """Release the lease of the key, if it's still held with the token.
+
+
+        @param key: The key of the lease.
+        @type key: six.text_type
+
+        @param token: The token returned by C{L{acquireLease}}.
+        @type token: six.text_type
+
+
+        @return: Whether the lease was released.
+
+        @rtype: C{bool}
+        """
+        raise NotImplementedError
+
     def cleanupNonces(self):
         """Remove expired nonces from the store.
 
@@ -61,6 +61,7 @@ class MemoryStore(object):
     def __init__(self):
         self.server_assocs = {}
         self.nonces = {}
+        self.leases = {}
 
     def _getServerAssocs(self, server_url):
         try:
@@ -84,6 +85,10 @@ class MemoryStore(object):
         assocs = self._getServerAssocs(server_url)
         return assocs.remove(handle)
 
+    def removeAssociations(self, server_url, handles):
+        assocs = self._getServerAssocs(server_url)
+        return len([handle for handle in handles if assocs.remove(handle)])
+
     def useNonce(self, server_url, timestamp, salt):
         if abs(timestamp - time.time()) > nonce.SKEW:
             return False
@@ -95,6 +100,22 @@ class MemoryStore(object):
             self.nonces[anonce] = None
             return True
 
+    def acquireLease(self, key, duration):
+        now = time.time()
+        lease = self.leases.get(key)
+        if lease is not None and lease[1] > now:
+            return None
+        token = nonce.make_nonce_salt(16)
+        self.leases[key] = (token, now + duration)
+        return token
+
+    def releaseLease(self, key, token):
+        lease = self.leases.get(key)
+        if lease is None or lease[0] != token:
+            return False
+        del self.leases[key]
+        return True
+
     def cleanupNonces(self):
         now = time.time()
         expired = []
@@ -42,8 +42,8 @@ class SQLStore(OpenIDStore):
     logic common to all of the SQL stores.
 
     The table names used are determined by the class variables
-    C{L{associations_table}} and
-    C{L{nonces_table}}.  To change the name of the tables used, pass
+    C{L{associations_table}}, C{L{nonces_table}} and
+    C{L{leases_table}}.  To change the name of the tables used, pass
     new table names into the constructor.
 
     To create the tables with the proper schema, see the
@@ -63,14 +63,18 @@ class SQLStore(OpenIDStore):
     @cvar nonces_table: This is the default name of the table to keep
         nonces in.
 
+    @cvar leases_table: This is the default name of the table to keep
+        leases in.
+
 
     @sort: __init__, createTables
     """
 
     associations_table = 'oid_associations'
     nonces_table = 'oid_nonces'
+    leases_table = 'oid_leases'
 
-    def __init__(self, conn, associations_table=None, nonces_table=None):
+    def __init__(self, conn, associations_table=None, nonces_table=None, leases_table=None):
         """
         This creates a new SQLStore instance.  It requires an
         established database connection be given to it, and it allows
@@ -95,6 +99,11 @@ class SQLStore(OpenIDStore):
             the name of the table used for storing nonces.  The
             default value is specified in C{L{SQLStore.nonces_table}}.
         @type nonces_table: six.text_type, six.binary_type is deprecated
+
+        @param leases_table: This is an optional parameter to specify
+            the name of the table used for storing leases.  The
+            default value is specified in C{L{SQLStore.leases_table}}.
+        @type leases_table: six.text_type
         """
         self.conn = conn
         self.cur = None
@@ -106,6 +115,7 @@ class SQLStore(OpenIDStore):
         self._table_names = {
             'associations': associations_table or self.associations_table,
             'nonces': nonces_table or self.nonces_table,
+            'leases': leases_table or self.leases_table,
         }
         self.max_nonce_age = 6 * 60 * 60  # Six hours, in seconds
 
@@ -198,6 +208,7 @@ class SQLStore(OpenIDStore):
         """
         self.db_create_nonce()
         self.db_create_assoc()
+        self.db_create_lease()
 
     createTables = _inTxn(txn_createTables)
 
@@ -268,6 +279,20 @@ class SQLStore(OpenIDStore):
 
     removeAssociation = _inTxn(txn_removeAssociation)
 
+    def txn_removeAssociations(self, server_url, handles):
+        """Remove the associations for the given server URL and handles
+        in one transaction, returning the number of removed associations.
+
+        (six.text_type, Sequence[six.text_type]) -> int, six.binary_type is deprecated
+        """
+        removed = 0
+        for handle in handles:
+            if self.txn_removeAssociation(server_url, handle):
+                removed += 1
+        return removed
+
+    removeAssociations = _inTxn(txn_removeAssociations)
+
     def txn_useNonce(self, server_url, timestamp, salt):
         """Return whether this nonce is present, and if it is, then
         remove it from the set.
@@ -291,6 +316,39 @@ class SQLStore(OpenIDStore):
 
     useNonce = _inTxn(txn_useNonce)
 
+    def txn_acquireLease(self, key, duration):
+        """Acquire the lease of the key, return its token or C{None} if
+        the lease is held by someone else.
+
+        @type key: six.text_type
+        @type duration: int
+        @rtype: Optional[six.text_type]
+        """
+        now = int(time.time())
+        self.db_expire_lease(key, now)
+        token = nonce.make_nonce_salt(16)
+        try:
+            self.db_add_lease(key, token, now + duration)
+        except self.exceptions.IntegrityError:
+            # The lease is held by someone else
+            return None
+        else:
+            return token
+
+    acquireLease = _inTxn(txn_acquireLease)
+
+    def txn_releaseLease(self, key, token):
+        """Release the lease of the key, if it's still held with the token.
+
+        @type key: six.text_type
+        @type token: six.text_type
+        @rtype: bool
+        """
+        self.db_remove_lease(key, token)
+        return self.cur.rowcount > 0  # -1 is undefined
+
+    releaseLease = _inTxn(txn_releaseLease)
+
     def txn_cleanupNonces(self):
         self.db_clean_nonce(int(time.time()) - nonce.SKEW)
         return self.cur.rowcount
@@ -327,6 +385,16 @@ class SQLiteStore(SQLStore):
     );
     """
 
+    create_lease_sql = """
+    CREATE TABLE %(leases)s
+    (
+        lease_key VARCHAR(2047),
+        token CHAR(40),
+        expires INTEGER,
+        PRIMARY KEY (lease_key)
+    );
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -362,6 +430,12 @@ class SQLiteStore(SQLStore):
 
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < ?;'
 
+    add_lease_sql = 'INSERT INTO %(leases)s VALUES (?, ?, ?);'
+
+    expire_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = ? AND expires <= ?;'
+
+    remove_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = ? AND token = ?;'
+
     def blobDecode(self, buf):
         return six.binary_type(buf)
 
@@ -380,6 +454,16 @@ class SQLiteStore(SQLStore):
             else:
                 raise
 
+    def acquireLease(self, *args, **kwargs):
+        # See useNonce
+        try:
+            return super(SQLiteStore, self).acquireLease(*args, **kwargs)
+        except self.exceptions.OperationalError as why:
+            if re.match('^column .* is not unique$', six.text_type(why)):
+                return None
+            else:
+                raise
+
 
 class MySQLStore(SQLStore):
     """
@@ -408,6 +492,17 @@ class MySQLStore(SQLStore):
     ENGINE=InnoDB;
     """
 
+    create_lease_sql = """
+    CREATE TABLE %(leases)s
+    (
+        lease_key BLOB NOT NULL,
+        token CHAR(40) NOT NULL,
+        expires INTEGER NOT NULL,
+        PRIMARY KEY (lease_key(255))
+    )
+    ENGINE=InnoDB;
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -441,6 +536,12 @@ class MySQLStore(SQLStore):
 
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    add_lease_sql = 'INSERT INTO %(leases)s VALUES (%%s, %%s, %%s);'
+
+    expire_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = %%s AND expires <= %%s;'
+
+    remove_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = %%s AND token = %%s;'
+
     def blobDecode(self, blob):
         if isinstance(blob, six.binary_type):
             # Versions of MySQLdb >= 1.2.2
@@ -479,6 +580,16 @@ class PostgreSQLStore(SQLStore):
     );
     """
 
+    create_lease_sql = """
+    CREATE TABLE %(leases)s
+    (
+        lease_key VARCHAR(2047) NOT NULL,
+        token CHAR(40) NOT NULL,
+        expires INTEGER NOT NULL,
+        PRIMARY KEY (lease_key)
+    );
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -534,6 +645,12 @@ class PostgreSQLStore(SQLStore):
 
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    add_lease_sql = 'INSERT INTO %(leases)s VALUES (%%s, %%s, %%s);'
+
+    expire_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = %%s AND expires <= %%s;'
+
+    remove_lease_sql = 'DELETE FROM %(leases)s WHERE lease_key = %%s AND token = %%s;'
+
     def blobEncode(self, blob):
         try:
             from psycopg2 import Binary
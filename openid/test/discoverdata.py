@@ -118,13 +118,11 @@ def generateResult(base_url, input_name, id_name, result_name, success):
     result = generateSample(result_name, base_url)
     headers, content = result.split('\n\n', 1)
     header_lines = headers.split('\n')
+    response_headers = {}
     for header_line in header_lines:
-        if header_line.startswith('Content-Type:'):
-            _, ctype = header_line.split(':', 1)
-            ctype = ctype.strip()
-            break
-    else:
-        ctype = None
+        name, value = header_line.split(':', 1)
+        response_headers[name.strip().lower()] = value.strip()
+    ctype = response_headers.get('content-type')
 
     id_url = urljoin(base_url, id_name)
 
@@ -134,4 +132,5 @@ def generateResult(base_url, input_name, id_name, result_name, success):
         result.xrds_uri = urljoin(base_url, result_name)
     result.content_type = ctype
     result.response_text = content.encode('utf-8')
+    result.headers = response_headers
     return input_url, result
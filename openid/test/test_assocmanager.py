@@ -0,0 +1,134 @@
+"""Test `openid.consumer.assocmanager` module."""
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from testfixtures import LogCapture, StringComparison
+
+from openid.association import Association
+from openid.consumer.assocmanager import AssociationManager
+from openid.consumer.consumer import Consumer, GenericConsumer
+from openid.consumer.discover import OPENID_2_0_TYPE, OpenIDServiceEndpoint
+from openid.store.memstore import MemoryStore
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+
+class NegotiatingConsumer(GenericConsumer):
+    """Consumer which negotiates associations without requests."""
+    lifetime = 7200
+    # Event which needs to be set before the negotiation finishes
+    event = None
+    error = None
+
+    def _negotiateAssociation(self, endpoint):
+        if self.event is not None:
+            self.event.wait()
+        if self.error is not None:
+            raise self.error
+        if self.lifetime is None:
+            return None
+        return Association.fromExpiresIn(self.lifetime, 'handle', b'secret', 'HMAC-SHA1')
+
+
+@unittest.skipIf(futures is None, "concurrent.futures is not available")
+class TestAssociationManager(unittest.TestCase):
+    server_url = 'http://op.example.com/openid'
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.executor = futures.ThreadPoolExecutor(2)
+        self.consumer_class = type(str('TestConsumer'), (NegotiatingConsumer, ), {})
+        self.manager = AssociationManager(self.store, self.executor, consumer_class=self.consumer_class)
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.server_url = self.server_url
+        self.endpoint.claimed_id = 'http://user.example.com/'
+        self.endpoint.type_uris = [OPENID_2_0_TYPE]
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_getAssociation(self):
+        with LogCapture() as logbook:
+            self.assertIsNone(self.manager.getAssociation(self.endpoint))
+            self.executor.shutdown()
+        assoc = self.store.getAssociation(self.server_url)
+        self.assertEqual(assoc.handle, 'handle')
+        self.assertFalse(self.manager.isPending(self.server_url))
+        self.assertEqual(self.manager.getAssociation(self.endpoint), assoc)
+        logbook.check(('openid.consumer.assocmanager', 'INFO',
+                       StringComparison('Associated with http://op.example.com/openid in .* seconds')))
+
+    def test_schedule_pending(self):
+        self.consumer_class.event = threading.Event()
+        future = self.manager.schedule(self.endpoint)
+        self.assertTrue(self.manager.isPending(self.server_url))
+        self.assertIsNone(self.manager.schedule(self.endpoint))
+        self.assertIsNone(self.manager.getAssociation(self.endpoint))
+        self.consumer_class.event.set()
+        with LogCapture():
+            assoc = future.result()
+            self.executor.shutdown()
+        self.assertFalse(self.manager.isPending(self.server_url))
+        self.assertEqual(self.store.getAssociation(self.server_url), assoc)
+
+    def test_renew(self):
+        old_assoc = Association('old', b'secret', int(time.time()) - 3540, 3600, 'HMAC-SHA1')
+        self.store.storeAssociation(self.server_url, old_assoc)
+        with LogCapture():
+            # Expiring association is still used, while a new one is negotiated
+            self.assertEqual(self.manager.getAssociation(self.endpoint), old_assoc)
+            self.executor.shutdown()
+        self.assertEqual(self.store.getAssociation(self.server_url).handle, 'handle')
+
+    def test_valid(self):
+        assoc = Association.fromExpiresIn(7200, 'valid', b'secret', 'HMAC-SHA1')
+        self.store.storeAssociation(self.server_url, assoc)
+        self.assertEqual(self.manager.getAssociation(self.endpoint), assoc)
+        self.assertFalse(self.manager.isPending(self.server_url))
+
+    def test_failure(self):
+        self.consumer_class.lifetime = None
+        with LogCapture() as logbook:
+            self.assertIsNotNone(self.manager.schedule(self.endpoint))
+            self.executor.shutdown()
+        # Failed negotiation is not retried until the retry delay passes
+        self.assertIsNone(self.manager.schedule(self.endpoint))
+        self.assertIsNone(self.store.getAssociation(self.server_url))
+        logbook.check(('openid.consumer.assocmanager', 'WARNING',
+                       'Failed to make an association with http://op.example.com/openid, retry in 600 seconds'))
+
+    def test_failure_retry(self):
+        self.consumer_class.lifetime = None
+        self.manager.retry_delay = 0
+        with LogCapture():
+            self.manager.schedule(self.endpoint).result()
+        self.assertIsNotNone(self.manager.schedule(self.endpoint))
+
+    def test_error(self):
+        self.consumer_class.error = ValueError('Oops')
+        with LogCapture() as logbook:
+            self.assertIsNone(self.manager.schedule(self.endpoint).result())
+        logbook.check(
+            ('openid.consumer.assocmanager', 'ERROR',
+             'Negotiation of association with http://op.example.com/openid failed'),
+            ('openid.consumer.assocmanager', 'WARNING',
+             'Failed to make an association with http://op.example.com/openid, retry in 600 seconds'))
+
+    def test_consumer(self):
+        consumer = Consumer({}, self.store, consumer_class=self.consumer_class, association_manager=self.manager)
+        self.consumer_class.event = threading.Event()
+        # The consumer doesn't wait for the association
+        request = consumer.consumer.begin(self.endpoint)
+        self.assertIsNone(request.assoc)
+        self.assertTrue(self.manager.isPending(self.server_url))
+        self.consumer_class.event.set()
+        with LogCapture():
+            self.executor.shutdown()
+        request = consumer.consumer.begin(self.endpoint)
+        self.assertEqual(request.assoc.handle, 'handle')
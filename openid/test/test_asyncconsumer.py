@@ -0,0 +1,257 @@
+"""Tests for `openid.consumer.asyncconsumer` module."""
+from __future__ import unicode_literals
+
+import unittest
+
+import six
+from six.moves.urllib.parse import parse_qsl, urlparse
+from testfixtures import LogCapture
+
+from openid.consumer.consumer import (CANCEL, FAILURE, SUCCESS, NonceReplayFilter, OPCircuitBreaker,
+                                      setDefaultCircuitBreaker, setDefaultReplayFilter)
+from openid.consumer.discover import DiscoveryCache, DiscoveryFailure, setDefaultDiscoveryCache
+from openid.fetchers import HTTPResponse
+from openid.server.server import Server
+from openid.store.memstore import MemoryStore
+from openid.yadis.constants import YADIS_CONTENT_TYPE
+
+if six.PY3:
+    import asyncio
+
+    from openid.consumer import asyncconsumer
+    from openid.executor import ExecutorStore
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+IDENTITY = 'http://user.example.com/'
+RETURN_TO = 'http://rp.example.com/complete'
+XRDS = '''<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+<XRD><Service><Type>http://specs.openid.net/auth/2.0/signon</Type><URI>%s</URI></Service>
+</XRD></xrds:XRDS>''' % OP_ENDPOINT
+HTML = '''<html><head><link rel="openid2.provider" href="%s"></head></html>''' % OP_ENDPOINT
+
+
+class FakeOPFetcher(object):
+    """Asynchronous fetcher with static responses and an OpenID provider."""
+
+    def __init__(self, server, responses):
+        self.server = server
+        self.responses = responses
+        self.calls = []
+
+    def fetch(self, url, body=None, headers=None):
+        self.calls.append((url, body))
+        if url not in self.responses:
+            query = dict(parse_qsl(body.decode('utf-8')))
+            web_response = self.server.encodeResponse(self.server.handleRequest(self.server.decodeRequest(query)))
+            response = HTTPResponse(url, web_response.code, web_response.headers, web_response.body.encode('utf-8'))
+        else:
+            response = self.responses[url]
+        future = asyncio.Future()
+        future.set_result(response)
+        return future
+
+    def countCalls(self, url):
+        return len([u for u, _ in self.calls if u == url])
+
+
+@unittest.skipUnless(six.PY3, "Asynchronous consumer requires python 3")
+class AsyncTestCase(unittest.TestCase):
+    """Base class for asynchronous tests."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.server = Server(MemoryStore(), OP_ENDPOINT)
+        xrds = HTTPResponse(IDENTITY, 200, {'content-type': YADIS_CONTENT_TYPE}, XRDS.encode('utf-8'))
+        self.fetcher = FakeOPFetcher(self.server, {IDENTITY: xrds})
+        self.store = MemoryStore()
+        self.session = {}
+        self.consumer = asyncconsumer.AsyncConsumer(self.session, ExecutorStore(self.store), fetcher=self.fetcher)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def answer(self, auth_request):
+        """Return the query of the positive assertion of the OpenID provider."""
+        query = auth_request.getMessage('http://rp.example.com/', RETURN_TO).toPostArgs()
+        request = self.server.decodeRequest(query)
+        web_response = self.server.encodeResponse(request.answer(True))
+        return dict(parse_qsl(urlparse(web_response.headers['location']).query))
+
+
+class TestDiscover(AsyncTestCase):
+    """Test asynchronous `discover` function."""
+
+    def tearDown(self):
+        setDefaultDiscoveryCache(None)
+
+    def test_yadis(self):
+        claimed_id, services = self.run_async(asyncconsumer.discover('user.example.com', self.fetcher))
+        self.assertEqual(claimed_id, IDENTITY)
+        self.assertEqual([s.server_url for s in services], [OP_ENDPOINT])
+        self.assertEqual(services[0].claimed_id, IDENTITY)
+
+    def test_html(self):
+        self.fetcher.responses[IDENTITY] = HTTPResponse(IDENTITY, 200, {'content-type': 'text/html'},
+                                                        HTML.encode('utf-8'))
+        claimed_id, services = self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+        self.assertEqual(claimed_id, IDENTITY)
+        self.assertEqual([s.server_url for s in services], [OP_ENDPOINT])
+
+    def test_failure(self):
+        self.fetcher.responses[IDENTITY] = HTTPResponse(IDENTITY, 404, {}, b'')
+        with self.assertRaises(DiscoveryFailure):
+            self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+
+    def test_single_discovery(self):
+        results = self.run_async(asyncio.gather(asyncconsumer.discover(IDENTITY, self.fetcher),
+                                                asyncconsumer.discover(IDENTITY, self.fetcher)))
+        self.assertEqual(results[0][0], results[1][0])
+        self.assertEqual(self.fetcher.countCalls(IDENTITY), 1)
+
+    def test_cache(self):
+        setDefaultDiscoveryCache(DiscoveryCache())
+        self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+        claimed_id, services = self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+        self.assertEqual(claimed_id, IDENTITY)
+        self.assertEqual(len(services), 1)
+        self.assertEqual(self.fetcher.countCalls(IDENTITY), 1)
+
+    def test_cache_failure(self):
+        setDefaultDiscoveryCache(DiscoveryCache())
+        self.fetcher.responses[IDENTITY] = HTTPResponse(IDENTITY, 404, {}, b'')
+        with self.assertRaises(DiscoveryFailure) as first:
+            self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+        with self.assertRaises(DiscoveryFailure) as second:
+            self.run_async(asyncconsumer.discover(IDENTITY, self.fetcher))
+        self.assertEqual(self.fetcher.countCalls(IDENTITY), 1)
+        # Each request raises its own copy of the cached failure
+        self.assertIsNot(first.exception, second.exception)
+        self.assertEqual(str(first.exception), str(second.exception))
+
+    def test_single_discovery_failure(self):
+        self.fetcher.responses[IDENTITY] = HTTPResponse(IDENTITY, 404, {}, b'')
+        results = self.run_async(asyncio.gather(asyncconsumer.discover(IDENTITY, self.fetcher),
+                                                asyncconsumer.discover(IDENTITY, self.fetcher),
+                                                return_exceptions=True))
+        self.assertIsInstance(results[0], DiscoveryFailure)
+        self.assertIsInstance(results[1], DiscoveryFailure)
+        self.assertIsNot(results[0], results[1])
+        self.assertEqual(self.fetcher.countCalls(IDENTITY), 1)
+
+
+class TestAsyncConsumer(AsyncTestCase):
+    """Test `AsyncConsumer` class."""
+
+    def test_success(self):
+        auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        self.assertIsNotNone(auth_request.assoc)
+        self.assertEqual(self.store.getAssociation(OP_ENDPOINT), auth_request.assoc)
+
+        query = self.answer(auth_request)
+        response = self.run_async(self.consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(response.identity_url, IDENTITY)
+        self.assertEqual(self.session, {})
+        # The response is verified by the association, there is only the associate request
+        self.assertEqual(self.fetcher.countCalls(OP_ENDPOINT), 1)
+
+    def test_replay(self):
+        auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        query = self.answer(auth_request)
+        self.assertEqual(self.run_async(self.consumer.complete(query, RETURN_TO)).status, SUCCESS)
+
+        response = self.run_async(self.consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, FAILURE)
+        self.assertEqual(response.message, 'Nonce already used or out of range')
+
+    def test_replay_filter(self):
+        replay_filter = NonceReplayFilter()
+        setDefaultReplayFilter(replay_filter)
+        self.addCleanup(setDefaultReplayFilter, None)
+        auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        query = self.answer(auth_request)
+        self.assertEqual(self.run_async(self.consumer.complete(query, RETURN_TO)).status, SUCCESS)
+
+        response = self.run_async(self.consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, FAILURE)
+        self.assertEqual(response.message, 'Nonce already used or out of range')
+        self.assertEqual(replay_filter.replays, 1)
+
+    def test_stateless(self):
+        consumer = asyncconsumer.AsyncConsumer(self.session, None, fetcher=self.fetcher)
+        auth_request = self.run_async(consumer.begin(IDENTITY))
+        self.assertIsNone(auth_request.assoc)
+
+        query = self.answer(auth_request)
+        response = self.run_async(consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, SUCCESS)
+        # The response is verified by check_authentication request
+        self.assertEqual(self.fetcher.countCalls(OP_ENDPOINT), 1)
+
+    def test_discovery_without_session(self):
+        auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        query = self.answer(auth_request)
+        self.session.clear()
+        response = self.run_async(self.consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(self.fetcher.countCalls(IDENTITY), 2)
+
+    def test_check_auth_error(self):
+        consumer = asyncconsumer.AsyncConsumer(self.session, None, fetcher=self.fetcher)
+        auth_request = self.run_async(consumer.begin(IDENTITY))
+        query = self.answer(auth_request)
+        self.fetcher.responses[OP_ENDPOINT] = HTTPResponse(OP_ENDPOINT, 500, {}, b'')
+        with LogCapture():
+            response = self.run_async(consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, FAILURE)
+        self.assertEqual(response.message, 'Server denied check_authentication')
+
+    def test_bad_signature(self):
+        auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        query = self.answer(auth_request)
+        query['openid.sig'] = 'AAAA'
+        response = self.run_async(self.consumer.complete(query, RETURN_TO))
+        self.assertEqual(response.status, FAILURE)
+        self.assertEqual(response.message, 'Bad signature')
+
+    def test_cancel(self):
+        self.run_async(self.consumer.begin(IDENTITY))
+        response = self.run_async(self.consumer.complete({'openid.mode': 'cancel'}, RETURN_TO))
+        self.assertEqual(response.status, CANCEL)
+
+    def test_discovery_failure(self):
+        self.fetcher.responses[IDENTITY] = HTTPResponse(IDENTITY, 200, {'content-type': 'text/html'}, b'<html/>')
+        with self.assertRaises(DiscoveryFailure):
+            self.run_async(self.consumer.begin(IDENTITY))
+
+    def test_single_negotiation(self):
+        requests = self.run_async(asyncio.gather(self.consumer.begin(IDENTITY), self.consumer.begin(IDENTITY)))
+        self.assertEqual(requests[0].assoc, requests[1].assoc)
+        self.assertEqual(self.fetcher.countCalls(OP_ENDPOINT), 1)
+
+    def test_association_wait(self):
+        self.consumer.consumer.association_wait = False
+        requests = self.run_async(asyncio.gather(self.consumer.begin(IDENTITY), self.consumer.begin(IDENTITY)))
+        self.assertIsNotNone(requests[0].assoc)
+        self.assertIsNone(requests[1].assoc)
+
+    def test_association_error(self):
+        self.fetcher.responses[OP_ENDPOINT] = HTTPResponse(OP_ENDPOINT, 400, {}, b'mode:error\nerror:Oops\n')
+        with LogCapture():
+            auth_request = self.run_async(self.consumer.begin(IDENTITY))
+        self.assertIsNone(auth_request.assoc)
+
+    def test_circuit_breaker(self):
+        breaker = OPCircuitBreaker(failure_threshold=1)
+        setDefaultCircuitBreaker(breaker)
+        self.addCleanup(setDefaultCircuitBreaker, None)
+        self.fetcher.responses[OP_ENDPOINT] = HTTPResponse(OP_ENDPOINT, 500, {}, b'')
+        with LogCapture():
+            self.assertIsNone(self.run_async(self.consumer.begin(IDENTITY)).assoc)
+            self.assertIsNone(self.run_async(self.consumer.begin(IDENTITY)).assoc)
+        self.assertEqual(breaker.getState(OP_ENDPOINT), OPCircuitBreaker.OPEN)
+        self.assertEqual(self.fetcher.countCalls(OP_ENDPOINT), 1)
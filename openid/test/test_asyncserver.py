@@ -0,0 +1,301 @@
+"""Tests for `openid.server.asyncserver` module."""
+from __future__ import unicode_literals
+
+import unittest
+from functools import partial
+
+import six
+from cryptography.hazmat.primitives import hashes
+from mock import patch
+from six.moves.urllib.parse import urlencode
+
+from openid import oidutil
+from openid.cache import LRUCache
+from openid.dh import DiffieHellman
+from openid.fetchers import HTTPResponse
+from openid.message import OPENID2_NS, OPENID_NS, Message
+from openid.server import server
+from openid.server.trustroot import RealmVerificationCache
+from openid.store import memstore
+from openid.yadis.constants import YADIS_CONTENT_TYPE
+from openid.yadis.discover import DiscoveryFailure
+
+if six.PY3:
+    import asyncio
+
+    from openid.server import asyncserver
+
+XRDS = '''<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+<XRD><Service><Type>http://specs.openid.net/auth/2.0/return_to</Type><URI>http://www.example.com/return</URI></Service>
+</XRD></xrds:XRDS>'''
+
+
+class FakeFetcher(object):
+    """Asynchronous fetcher with static responses."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def fetch(self, url, body=None, headers=None):
+        self.calls.append(url)
+        future = asyncio.Future()
+        future.set_result(self.responses[url])
+        return future
+
+
+@unittest.skipUnless(six.PY3, "Asynchronous server requires python 3")
+class AsyncTestCase(unittest.TestCase):
+    """Base class for asynchronous tests."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.store = memstore.MemoryStore()
+        response = HTTPResponse('http://www.example.com/', 200, {'content-type': YADIS_CONTENT_TYPE},
+                                XRDS.encode('utf-8'))
+        self.fetcher = FakeFetcher({'http://www.example.com/': response})
+        self.server = asyncserver.AsyncServer(asyncserver.ExecutorStore(self.store), 'http://server.unittest/endpt',
+                                              fetcher=self.fetcher)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class TestAsyncServer(AsyncTestCase):
+    """Test `AsyncServer` class."""
+
+    def test_associate_dh(self):
+        consumer_dh = DiffieHellman.fromDefaults()
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.session_type': 'DH-SHA256',
+            'openid.assoc_type': 'HMAC-SHA256',
+            'openid.dh_consumer_public': consumer_dh.public_key,
+        })
+        request = server.AssociateRequest.fromMessage(message)
+
+        response = self.run_async(self.server.handleRequest(request))
+
+        rfg = partial(response.fields.getArg, OPENID_NS)
+        self.assertEqual(rfg("session_type"), "DH-SHA256")
+        assoc = self.store.getAssociation(self.server.signatory._normal_key, rfg("assoc_handle"))
+        secret = consumer_dh.xor_secret(rfg("dh_server_public"), rfg("enc_mac_key"), hashes.SHA256())
+        self.assertEqual(secret, oidutil.toBase64(assoc.secret))
+
+    def test_associate_dh_error(self):
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.session_type': 'DH-SHA256',
+            'openid.assoc_type': 'HMAC-SHA256',
+            'openid.dh_consumer_public': DiffieHellman.fromDefaults().public_key,
+        })
+        request = server.AssociateRequest.fromMessage(message)
+        with patch('openid.server.asyncserver._answerSession', side_effect=ValueError('Oops')):
+            self.assertRaises(ValueError, self.run_async, self.server.handleRequest(request))
+        # The association which was never sent is removed from the store
+        self.assertIsNone(self.store.getAssociation(self.server.signatory._normal_key))
+
+    def test_associate_plaintext(self):
+        request = server.AssociateRequest.fromMessage(Message.fromPostArgs({}))
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertTrue(response.fields.getArg(OPENID_NS, "mac_key"))
+
+    def test_associate_unsupported(self):
+        self.server.negotiator.setAllowedTypes([('HMAC-SHA1', 'DH-SHA1')])
+        message = Message.fromPostArgs({'openid.ns': OPENID2_NS, 'openid.mode': 'associate',
+                                        'openid.assoc_type': 'HMAC-SHA1', 'openid.session_type': 'no-encryption'})
+        request = server.AssociateRequest.fromMessage(message)
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertEqual(response.fields.getArg(OPENID_NS, "error_code"), 'unsupported-type')
+
+    def test_check_authentication(self):
+        # Sign a positive assertion in dumb mode and verify it
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'openid.identity': 'http://example.com/',
+            'openid.claimed_id': 'http://example.com/', 'openid.return_to': 'http://www.example.com/return'})
+        request = server.CheckIDRequest.fromMessage(message, self.server.op_endpoint)
+        response = request.answer(True)
+        signed = self.run_async(self.server.signatory.sign(response))
+        self.assertIsNot(signed, response)
+        self.assertFalse(response.fields.hasKey(OPENID_NS, 'sig'))
+
+        check_message = signed.fields.copy()
+        check_message.setArg(OPENID_NS, 'mode', 'check_authentication')
+        request = server.CheckAuthRequest.fromMessage(check_message)
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertEqual(response.fields.getArg(OPENID_NS, "is_valid"), 'true')
+
+        # The association is invalidated after check
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertEqual(response.fields.getArg(OPENID_NS, "is_valid"), 'false')
+
+    def test_check_authentication_replay(self):
+        # Replayed check_authentication is rejected by a signatory of another process which shares the store
+        self.server.signatory.cache = LRUCache(10)
+        other = asyncserver.AsyncSignatory(self.server.signatory.store, cache=LRUCache(10))
+        response = server.OpenIDResponse(server.OpenIDRequest())
+        response.request.assoc_handle = None
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'ns': OPENID2_NS,
+                                                  'return_to': 'http://www.example.com/return'})
+        check_message = self.run_async(self.server.signatory.sign(response)).fields.copy()
+        check_message.setArg(OPENID_NS, 'mode', 'check_authentication')
+        request = server.CheckAuthRequest.fromMessage(check_message)
+        self.assertIsNotNone(self.run_async(other.getAssociation(request.assoc_handle, dumb=True)))
+
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertEqual(response.fields.getArg(OPENID_NS, "is_valid"), 'true')
+        self.server.signatory = other
+        response = self.run_async(self.server.handleRequest(request))
+        self.assertEqual(response.fields.getArg(OPENID_NS, "is_valid"), 'false')
+
+    def test_unknown_mode(self):
+        request = server.OpenIDRequest()
+        request.mode = 'monkeymode'
+        self.assertRaises(NotImplementedError, self.run_async, self.server.handleRequest(request))
+
+    def test_encode_response(self):
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'openid.identity': 'http://example.com/',
+            'openid.claimed_id': 'http://example.com/', 'openid.return_to': 'http://www.example.com/return'})
+        request = server.CheckIDRequest.fromMessage(message, self.server.op_endpoint)
+
+        web_response = self.run_async(self.server.encodeResponse(request.answer(True)))
+
+        self.assertEqual(web_response.code, server.HTTP_REDIRECT)
+        self.assertIn('openid.sig=', web_response.headers['location'])
+
+    def test_return_to_verified(self):
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'openid.identity': 'http://example.com/',
+            'openid.claimed_id': 'http://example.com/', 'openid.return_to': 'http://www.example.com/return',
+            'openid.realm': 'http://*.example.com/'})
+        request = server.CheckIDRequest.fromMessage(message, self.server.op_endpoint)
+        self.assertTrue(self.run_async(self.server.returnToVerified(request)))
+        self.assertFalse(self.run_async(self.server.verifyReturnTo('http://*.example.com/',
+                                                                   'http://www.example.com/other')))
+        self.assertFalse(self.run_async(self.server.verifyReturnTo('http://*.example.*/', 'http://www.example.com/')))
+
+    def test_verify_concurrent(self):
+        verify = partial(self.server.verifyReturnTo, 'http://*.example.com/', 'http://www.example.com/return')
+        results = self.run_async(asyncio.gather(*[verify() for i in range(10)]))
+        self.assertEqual(results, [True] * 10)
+        self.assertEqual(self.fetcher.calls, ['http://www.example.com/'])
+        # Without a cache, discovery is made again
+        self.assertTrue(self.run_async(verify()))
+        self.assertEqual(len(self.fetcher.calls), 2)
+
+    def test_verify_cached(self):
+        self.server.verification_cache = RealmVerificationCache()
+        verify = partial(self.server.verifyReturnTo, 'http://*.example.com/', 'http://www.example.com/return')
+        self.assertTrue(self.run_async(verify()))
+        self.assertTrue(self.run_async(verify()))
+        self.assertEqual(self.fetcher.calls, ['http://www.example.com/'])
+
+    def test_verify_redirect(self):
+        self.fetcher.responses['http://www.example.com/'].final_url = 'http://www.example.com/redirected'
+        self.assertFalse(self.run_async(self.server.verifyReturnTo('http://*.example.com/',
+                                                                   'http://www.example.com/return')))
+
+    def test_verify_failure(self):
+        self.server.verification_cache = RealmVerificationCache()
+        self.fetcher.responses['http://www.example.com/'].status = 404
+        verify = partial(self.server.verifyReturnTo, 'http://*.example.com/', 'http://www.example.com/return')
+        with self.assertRaises(DiscoveryFailure) as first:
+            self.run_async(verify())
+        with self.assertRaises(DiscoveryFailure) as cached:
+            self.run_async(verify())
+        self.assertEqual(len(self.fetcher.calls), 1)
+        # Each request gets its own instance of the error
+        self.assertIsNot(cached.exception, first.exception)
+
+    def test_verify_failure_concurrent(self):
+        self.fetcher.responses['http://www.example.com/'].status = 404
+        verify = partial(self.server.getAllowedReturnURLs, 'http://www.example.com/')
+        results = self.run_async(asyncio.gather(*[verify() for i in range(3)], return_exceptions=True))
+        self.assertEqual([type(r) for r in results], [DiscoveryFailure] * 3)
+        self.assertEqual(len(set(id(r) for r in results)), 3)
+        self.assertEqual(self.fetcher.calls, ['http://www.example.com/'])
+
+
+class TestASGIApplication(AsyncTestCase):
+    """Test `ASGIApplication` class."""
+
+    def setUp(self):
+        super(TestASGIApplication, self).setUp()
+        self.app = asyncserver.ASGIApplication(self.server, self.checkid_handler)
+
+    def checkid_handler(self, request, scope):
+        future = asyncio.Future()
+        future.set_result(request.answer(True))
+        return future
+
+    def call(self, scope, body=b''):
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        def receive():
+            future = asyncio.Future()
+            future.set_result(messages.pop(0))
+            return future
+
+        def send(message):
+            sent.append(message)
+            future = asyncio.Future()
+            future.set_result(None)
+            return future
+
+        self.run_async(self.app(scope, receive, send))
+        return sent
+
+    def test_associate(self):
+        body = urlencode({'openid.ns': OPENID2_NS, 'openid.mode': 'associate', 'openid.assoc_type': 'HMAC-SHA1',
+                          'openid.session_type': 'no-encryption'}).encode('utf-8')
+        start, body = self.call({'type': 'http', 'method': 'POST', 'query_string': b''}, body)
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/plain; charset=UTF-8'), start['headers'])
+        self.assertIn(b'mac_key:', body['body'])
+
+    def test_checkid(self):
+        query = urlencode({'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup',
+                           'openid.identity': 'http://example.com/', 'openid.claimed_id': 'http://example.com/',
+                           'openid.return_to': 'http://www.example.com/return'})
+        start, body = self.call({'type': 'http', 'method': 'GET', 'query_string': query.encode('utf-8')})
+
+        self.assertEqual(start['status'], 302)
+        headers = dict(start['headers'])
+        self.assertTrue(headers[b'location'].startswith(b'http://www.example.com/return?'))
+
+    def test_not_openid(self):
+        start, body = self.call({'type': 'http', 'method': 'GET', 'query_string': b''})
+        self.assertEqual(start['status'], 400)
+
+    def test_protocol_error(self):
+        query = urlencode({'openid.ns': OPENID2_NS, 'openid.mode': 'check_authentication'})
+        start, body = self.call({'type': 'http', 'method': 'GET', 'query_string': query.encode('utf-8')})
+        self.assertEqual(start['status'], 400)
+        self.assertIn(b'error:', body['body'])
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        def receive():
+            future = asyncio.Future()
+            future.set_result(messages.pop(0))
+            return future
+
+        def send(message):
+            sent.append(message)
+            future = asyncio.Future()
+            future.set_result(None)
+            return future
+
+        self.run_async(self.app({'type': 'lifespan'}, receive, send))
+        self.assertEqual([m['type'] for m in sent], ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
@@ -0,0 +1,224 @@
+"""Tests for `openid.cache` module."""
+from __future__ import unicode_literals
+
+import sys
+import threading
+import time
+import unittest
+
+from openid.cache import LRUCache, SingleFlight, copyException, getHTTPExpiration
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test `LRUCache` class."""
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, LRUCache, 0)
+
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.get('key', 'default'), 'default')
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIn('key', cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_expires(self):
+        cache = LRUCache()
+        cache.set('old', 'value', expires=time.time() - 1)
+        cache.set('new', 'value', expires=time.time() + 60)
+        self.assertIsNone(cache.get('old'))
+        self.assertNotIn('old', cache)
+        self.assertEqual(cache.get('new'), 'value')
+        self.assertIn('new', cache)
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Mark 'a' as recently used
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_pop(self):
+        cache = LRUCache()
+        cache.set('key', 'value')
+        cache.set('old', 'value', expires=time.time() - 1)
+        self.assertEqual(cache.pop('key'), 'value')
+        self.assertIsNone(cache.pop('key'))
+        self.assertIsNone(cache.pop('old'))
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache.set('key', 'value')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test `SingleFlight` class."""
+
+    def test_call(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.call('key', max, 1, 2), 2)
+        self.assertRaises(ValueError, single_flight.call, 'key', int, 'invalid')
+
+    def test_concurrent(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def function():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.call('key', function)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(single_flight.call('key', function)))
+                     for i in range(3)]
+        for thread in followers:
+            thread.start()
+        # Give the followers time to join the call in progress.
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [1, 1, 1, 1])
+
+    def test_concurrent_error(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def function():
+            started.set()
+            release.wait()
+            raise ValueError('Oops')
+
+        errors = []
+
+        def call():
+            try:
+                single_flight.call('key', function)
+            except ValueError as error:
+                errors.append(error)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=call) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        # Each thread gets its own instance of the error
+        self.assertEqual(len(set(id(e) for e in errors)), 4)
+        self.assertEqual([e.args for e in errors], [('Oops', )] * 4)
+
+    def test_isRunning(self):
+        single_flight = SingleFlight()
+        self.assertFalse(single_flight.isRunning('key'))
+        self.assertTrue(single_flight.call('key', single_flight.isRunning, 'key'))
+        self.assertFalse(single_flight.call('key', single_flight.isRunning, 'other'))
+        self.assertFalse(single_flight.isRunning('key'))
+
+
+class CustomError(Exception):
+    """Exception whose arguments don't match its constructor."""
+
+    def __init__(self, text, code):
+        Exception.__init__(self, text)
+        self.code = code
+
+
+class UncopyableError(Exception):
+    """Exception which can't be created from its arguments."""
+
+    def __new__(cls, text, **kwargs):
+        if 'code' not in kwargs:
+            raise TypeError("Missing code.")
+        return Exception.__new__(cls, text)
+
+    def __init__(self, text, code):
+        Exception.__init__(self, text)
+        self.code = code
+
+
+class TestCopyException(unittest.TestCase):
+    """Test `copyException` function."""
+
+    def _raise(self, error):
+        try:
+            raise error
+        except Exception as caught:
+            return caught
+
+    def test_copy(self):
+        error = self._raise(ValueError('Oops'))
+        error.extra = 'extra'
+        copied = copyException(error)
+        self.assertIsNot(copied, error)
+        self.assertIsInstance(copied, ValueError)
+        self.assertEqual(copied.args, ('Oops', ))
+        self.assertEqual(copied.extra, 'extra')
+
+    def test_copy_constructor(self):
+        error = self._raise(CustomError('Oops', 42))
+        copied = copyException(error)
+        self.assertIsNot(copied, error)
+        self.assertIsInstance(copied, CustomError)
+        self.assertEqual(copied.args, ('Oops', ))
+        self.assertEqual(copied.code, 42)
+
+    @unittest.skipUnless(sys.version_info[0] >= 3, "Tracebacks of exceptions require python 3")
+    def test_traceback(self):
+        error = self._raise(ValueError('Oops'))
+        self.assertIsNone(copyException(error).__traceback__)
+        # Raising the copies repeatedly doesn't extend the traceback
+        tracebacks = [self._raise(copyException(error)).__traceback__ for i in range(5)]
+        self.assertEqual([tb.tb_next for tb in tracebacks], [None] * 5)
+
+    @unittest.skipUnless(sys.version_info[0] >= 3, "Tracebacks of exceptions require python 3")
+    def test_not_copyable(self):
+        error = self._raise(UncopyableError('Oops', code=42))
+        self.assertIs(copyException(error), error)
+        self.assertIsNone(error.__traceback__)
+
+
+class TestGetHTTPExpiration(unittest.TestCase):
+    """Test `getHTTPExpiration` function."""
+
+    def test_no_headers(self):
+        self.assertIsNone(getHTTPExpiration(None, now=100))
+        self.assertIsNone(getHTTPExpiration({}, now=100))
+        self.assertIsNone(getHTTPExpiration({'content-type': 'text/html'}, now=100))
+
+    def test_cache_control(self):
+        self.assertEqual(getHTTPExpiration({'cache-control': 'public, max-age=60'}, now=100), 160)
+        self.assertEqual(getHTTPExpiration({'cache-control': 'max-age=60, s-maxage=30'}, now=100), 130)
+        self.assertEqual(getHTTPExpiration({'cache-control': 'no-cache'}, now=100), 100)
+        self.assertEqual(getHTTPExpiration({'cache-control': 'no-store, max-age=60'}, now=100), 100)
+        self.assertEqual(getHTTPExpiration({'cache-control': 'max-age=invalid'}, now=100), 100)
+        self.assertEqual(getHTTPExpiration({'cache-control': 'max-age=-5'}, now=100), 100)
+
+    def test_expires(self):
+        self.assertEqual(getHTTPExpiration({'expires': 'Thu, 01 Jan 1970 00:10:00 GMT'}, now=100), 600)
+        self.assertEqual(getHTTPExpiration({'expires': '0'}, now=100), 100)
+        # Cache-Control takes precedence
+        headers = {'expires': 'Thu, 01 Jan 1970 00:10:00 GMT', 'cache-control': 'max-age=60'}
+        self.assertEqual(getHTTPExpiration(headers, now=100), 160)
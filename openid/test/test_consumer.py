@@ -2,12 +2,14 @@ from __future__ import unicode_literals
 
 import base64
 import os
+import threading
 import time
 import unittest
 import warnings
 from functools import partial
 
 import six
+from mock import patch
 from six.moves.urllib.parse import parse_qsl, urlparse
 from testfixtures import LogCapture, ShouldWarn, StringComparison
 
@@ -15,9 +17,10 @@ from openid import association, fetchers, kvform, oidutil
 from openid.constants import DEFAULT_DH_GENERATOR
 from openid.consumer.consumer import (CANCEL, FAILURE, SETUP_NEEDED, SUCCESS, AuthRequest, CancelResponse, Consumer,
                                       DiffieHellmanSHA1ConsumerSession, DiffieHellmanSHA256ConsumerSession,
-                                      FailureResponse, GenericConsumer, PlainTextConsumerSession, ProtocolError,
-                                      ServerError, SetupNeededError, SetupNeededResponse, SuccessResponse,
-                                      _httpResponseToMessage)
+                                      FailureResponse, GenericConsumer, NonceReplayFilter, PlainTextConsumerSession,
+                                      ProtocolError, ServerError, SetupNeededError, SetupNeededResponse,
+                                      SuccessResponse, _Call, _httpResponseToMessage, _runSteps, getDefaultReplayFilter,
+                                      setDefaultReplayFilter)
 from openid.consumer.discover import OPENID_1_1_TYPE, OPENID_2_0_TYPE, OpenIDServiceEndpoint
 from openid.dh import DiffieHellman
 from openid.extension import Extension
@@ -25,7 +28,7 @@ from openid.fetchers import HTTPFetchingError, HTTPResponse
 from openid.message import BARE_NS, IDENTIFIER_SELECT, OPENID1_NS, OPENID2_NS, OPENID_NS, Message
 from openid.server.server import DiffieHellmanSHA256ServerSession
 from openid.store import memstore
-from openid.store.nonce import mkNonce, split as splitNonce
+from openid.store.nonce import SKEW, mkNonce, split as splitNonce
 from openid.yadis.discover import DiscoveryFailure
 from openid.yadis.manager import Discovery
 
@@ -219,6 +222,39 @@ consumer_url = 'http://consumer.example.com/'
 https_server_url = 'https://server.example.com/'
 
 
+class TestRunSteps(unittest.TestCase):
+    """Test `_runSteps` function."""
+
+    def test_result(self):
+        def steps():
+            value = yield _Call(lambda a, b: a + b, 1, 2)
+            yield value * 2
+
+        self.assertEqual(_runSteps(steps()), 6)
+
+    def test_error(self):
+        def fail():
+            raise HTTPFetchingError('Oops')
+
+        def steps():
+            try:
+                yield _Call(fail)
+            except HTTPFetchingError as error:
+                yield six.text_type(error)
+
+        self.assertEqual(_runSteps(steps()), 'Oops')
+
+    def test_unhandled_error(self):
+        def fail():
+            raise HTTPFetchingError('Oops')
+
+        def steps():
+            yield _Call(fail)
+            yield None
+
+        self.assertRaises(HTTPFetchingError, _runSteps, steps())
+
+
 class TestSuccess(unittest.TestCase):
     server_url = http_server_url
     user_url = 'http://www.example.com/user.html'
@@ -885,6 +921,67 @@ class CheckNonceVerifyTest(TestIdRes):
         self.assertRaises(ProtocolError, self.consumer._idResCheckNonce, self.response, self.endpoint)
 
 
+class TestNonceReplayFilter(TestIdRes):
+    """Test nonce check with `NonceReplayFilter`."""
+
+    def setUp(self):
+        TestIdRes.setUp(self)
+        self.replay_filter = NonceReplayFilter()
+        setDefaultReplayFilter(self.replay_filter)
+        self.addCleanup(setDefaultReplayFilter, None)
+        self.nonce = mkNonce()
+        self.response = Message.fromOpenIDArgs({'ns': OPENID2_NS, 'response_nonce': self.nonce})
+
+    def test_default(self):
+        self.assertEqual(getDefaultReplayFilter(), self.replay_filter)
+
+    def test_replay(self):
+        self.consumer._idResCheckNonce(self.response, self.endpoint)
+        self.assertEqual(len(self.replay_filter), 1)
+        # Replay is rejected without the store
+        self.store = self.consumer.store = memstore.MemoryStore()
+        self.assertRaises(ProtocolError, self.consumer._idResCheckNonce, self.response, self.endpoint)
+        self.assertEqual(self.replay_filter.replays, 1)
+        self.assertEqual(self.store.nonces, {})
+
+    def test_store_authoritative(self):
+        # Nonce used by another process is rejected by the store
+        stamp, salt = splitNonce(self.nonce)
+        self.store.useNonce(self.server_url, stamp, salt)
+        self.assertRaises(ProtocolError, self.consumer._idResCheckNonce, self.response, self.endpoint)
+        self.assertEqual(self.replay_filter.replays, 0)
+        self.assertEqual(len(self.replay_filter), 0)
+
+    def test_other_server(self):
+        stamp, salt = splitNonce(self.nonce)
+        self.replay_filter.add('http://other.example.com/', stamp, salt)
+        self.consumer._idResCheckNonce(self.response, self.endpoint)
+
+    def test_empty_salt(self):
+        # Nonces are identified by their timestamps as well, salt may be empty
+        now = int(time.time())
+        # Both nonces are in the same bucket
+        stamp = now - now % self.replay_filter.bucket_size
+        self.replay_filter.add(self.server_url, stamp, '')
+        self.assertFalse(self.replay_filter.isReplayed(self.server_url, stamp + 1, ''))
+        self.assertTrue(self.replay_filter.isReplayed(self.server_url, stamp, ''))
+
+    def test_eviction(self):
+        now = int(time.time())
+        self.replay_filter.add(self.server_url, now - SKEW + 30, 'old')
+        self.replay_filter.add(self.server_url, now, 'new')
+        self.assertEqual(len(self.replay_filter), 2)
+        # Nonces outside of the skew are not added
+        self.replay_filter.add(self.server_url, now - SKEW - 1, 'expired')
+        self.assertEqual(len(self.replay_filter), 2)
+
+        with patch('time.time', return_value=now + 120):
+            self.replay_filter.add(self.server_url, now, 'newer')
+        self.assertEqual(len(self.replay_filter), 2)
+        self.assertFalse(self.replay_filter.isReplayed(self.server_url, now - SKEW + 30, 'old'))
+        self.assertTrue(self.replay_filter.isReplayed(self.server_url, now, 'new'))
+
+
 class CheckAuthDetectingConsumer(GenericConsumer):
     def _checkAuth(self, *args):
         raise CheckAuthHappened(args)
@@ -1272,6 +1369,154 @@ class TestFetchAssoc(unittest.TestCase):
         msg = Message.fromPostArgs({'openid.signed': ''})
         self.assertFalse(self.consumer._checkAuth(msg, 'some://url'))
 
+    def test_consumer_fetcher(self):
+        # The fetcher of the consumer is used instead of the default one
+        fetcher = MockFetcher(HTTPResponse("http://server_url", 200, {}, 'mode:id_res\n'))
+        consumer = Consumer({}, self.store, consumer_class=self.consumer_class, fetcher=fetcher)
+        response = consumer.consumer._makeKVPost(Message.fromOpenIDArgs({'mode': 'associate'}), "http://server_url")
+        self.assertEqual(response.getArg(OPENID_NS, 'mode'), 'id_res')
+        self.assertEqual(fetcher.fetches, [("http://server_url", b'openid.mode=associate', None)])
+        self.assertEqual(self.fetcher.fetches, [])
+
+    def test_consumer_fetcher_exception(self):
+        # Exceptions of the consumer's fetcher are wrapped
+        consumer = Consumer({}, self.store, consumer_class=self.consumer_class,
+                            fetcher=ExceptionRaisingMockFetcher())
+        e = OpenIDServiceEndpoint()
+        e.server_url = 'some://url'
+        self.assertIsNone(consumer.consumer._getAssociation(e))
+
+
+class NegotiationCountingConsumer(GenericConsumer):
+    """Consumer which counts negotiations of associations and waits for an event before each."""
+
+    def __init__(self, store):
+        super(NegotiationCountingConsumer, self).__init__(store)
+        self.negotiations = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _negotiateAssociation(self, endpoint):
+        self.negotiations.append(endpoint.server_url)
+        self.started.set()
+        self.release.wait()
+        return association.Association.fromExpiresIn(3600, 'handle', b'secret', 'HMAC-SHA1')
+
+
+class UnhashableStore(memstore.MemoryStore):
+    __hash__ = None
+
+
+class TestGetAssociationSingleFlight(unittest.TestCase):
+    """Test coalescing of association negotiations in `GenericConsumer._getAssociation`."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.consumer = NegotiationCountingConsumer(self.store)
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.server_url = 'http://op.example.com/openid'
+
+    def _start(self):
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.consumer._getAssociation(self.endpoint)))
+        leader.start()
+        self.consumer.started.wait()
+        return leader, results
+
+    def test_wait(self):
+        leader, results = self._start()
+        followers = [threading.Thread(target=lambda: results.append(self.consumer._getAssociation(self.endpoint)))
+                     for i in range(3)]
+        for thread in followers:
+            thread.start()
+        # Give the followers time to join the negotiation in progress.
+        time.sleep(0.05)
+        self.consumer.release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(self.consumer.negotiations, ['http://op.example.com/openid'])
+        self.assertEqual([a.handle for a in results], ['handle'] * 4)
+        self.assertEqual(self.store.getAssociation('http://op.example.com/openid').handle, 'handle')
+
+    def test_no_wait(self):
+        leader, results = self._start()
+        self.consumer.association_wait = False
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._getAssociation(self.endpoint))
+        self.consumer.release.set()
+        leader.join()
+        self.assertEqual(results[0].handle, 'handle')
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Association with http://op.example.com/openid is being negotiated, using stateless mode.'))
+
+    def test_other_server(self):
+        leader, results = self._start()
+        self.consumer.release.set()
+        other = OpenIDServiceEndpoint()
+        other.server_url = 'http://other.example.com/openid'
+        self.assertEqual(self.consumer._getAssociation(other).handle, 'handle')
+        leader.join()
+        self.assertEqual(sorted(self.consumer.negotiations),
+                         ['http://op.example.com/openid', 'http://other.example.com/openid'])
+
+    def test_lease(self):
+        self.consumer.association_lease = 60
+        self.consumer.release.set()
+        self.assertEqual(self.consumer._getAssociation(self.endpoint).handle, 'handle')
+        # Other process with expired association can't get the lease in the same period
+        self.store.removeAssociation(self.endpoint.server_url, 'handle')
+        other = NegotiationCountingConsumer(self.store)
+        other.association_lease = 60
+        with LogCapture() as logbook:
+            self.assertIsNone(other._getAssociation(self.endpoint))
+        self.assertEqual(other.negotiations, [])
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Association with http://op.example.com/openid is being negotiated by another process, '
+                       'using stateless mode.'))
+
+    def test_lease_longer_than_skew(self):
+        self.consumer.association_lease = 2 * SKEW
+        self.consumer.release.set()
+        self.assertEqual(self.consumer._getAssociation(self.endpoint).handle, 'handle')
+        self.store.removeAssociation(self.endpoint.server_url, 'handle')
+        other = NegotiationCountingConsumer(self.store)
+        other.association_lease = 2 * SKEW
+        with LogCapture():
+            self.assertIsNone(other._getAssociation(self.endpoint))
+        self.assertEqual(other.negotiations, [])
+
+    def test_lease_released_on_failure(self):
+        self.consumer.association_lease = 60
+        self.consumer.release.set()
+        with patch.object(self.consumer, '_negotiateAssociation', return_value=None):
+            self.assertIsNone(self.consumer._getAssociation(self.endpoint))
+        # Other process tries the negotiation right away
+        other = NegotiationCountingConsumer(self.store)
+        other.association_lease = 60
+        other.release.set()
+        self.assertEqual(other._getAssociation(self.endpoint).handle, 'handle')
+        self.assertEqual(other.negotiations, [self.endpoint.server_url])
+
+    def test_lease_released_on_error(self):
+        self.consumer.association_lease = 60
+        with patch.object(self.consumer, '_negotiateAssociation', side_effect=ValueError('Oops')):
+            self.assertRaises(ValueError, self.consumer._getAssociation, self.endpoint)
+        self.assertEqual(self.store.leases, {})
+
+    def test_unhashable_store(self):
+        # Negotiations are coalesced by the identity of the store, which doesn't need to be hashable.
+        self.consumer.store = UnhashableStore()
+        self.consumer.release.set()
+        self.assertEqual(self.consumer._getAssociation(self.endpoint).handle, 'handle')
+        self.assertEqual(self.consumer._negotiations._calls, {})
+
+    def test_stored_meanwhile(self):
+        # Association stored by the previous negotiation is used
+        assoc = association.Association.fromExpiresIn(3600, 'stored', b'secret', 'HMAC-SHA1')
+        self.store.storeAssociation(self.endpoint.server_url, assoc)
+        self.assertEqual(self.consumer._createAssociation(self.endpoint), assoc)
+        self.assertEqual(self.consumer.negotiations, [])
+
 
 class TestSuccessResponse(unittest.TestCase):
     def setUp(self):
@@ -1352,7 +1597,8 @@ class StubConsumer(object):
         return auth_req
 
     def complete(self, message, endpoint, return_to):
-        assert endpoint is self.endpoint
+        # The endpoint is restored from the session
+        assert endpoint.toSessionData() == self.endpoint.toSessionData()
         return self.response
 
 
@@ -1430,8 +1676,8 @@ class ConsumerTest(unittest.TestCase):
         self.assertIsInstance(result, AuthRequest)
 
         # Side-effect of calling beginWithoutDiscovery is setting the
-        # session value to the endpoint attribute of the result
-        self.assertEqual(self.session[self.consumer._token_key], result.endpoint)
+        # session value to the compact form of the endpoint attribute of the result
+        self.assertEqual(self.session[self.consumer._token_key], result.endpoint.toSessionData())
 
         # The endpoint that we passed in is the endpoint on the auth_request
         self.assertEqual(result.endpoint, self.endpoint)
@@ -1450,6 +1696,27 @@ class ConsumerTest(unittest.TestCase):
         self.assertEqual(response.message, text)
         self.assertIsNone(response.identity_url)
 
+    def test_completeLegacySession(self):
+        # Endpoint objects stored in the session by the previous versions are used
+        self.consumer.consumer.endpoint = self.endpoint
+        self.consumer.consumer.response = CancelResponse(self.endpoint)
+        self.session[self.consumer._token_key] = self.endpoint
+
+        self.assertEqual(self.consumer.complete({}, None).status, CANCEL)
+
+    def test_completeInvalidSession(self):
+        def checkEndpoint(message, endpoint, return_to):
+            self.assertIsNone(endpoint)
+            return FailureResponse(endpoint, 'failed')
+
+        self.consumer.consumer.complete = checkEndpoint
+        self.session[self.consumer._token_key] = [42]
+
+        with LogCapture() as logbook:
+            self.assertEqual(self.consumer.complete({}, None).status, FAILURE)
+        logbook.check(('openid.consumer.consumer', 'WARNING',
+                       'Discarding endpoint from the session: Unsupported session data of endpoint: [42]'))
+
     def _doResp(self, auth_req, exp_resp):
         """complete a transaction, using the expected response from
         the generic consumer."""
@@ -1883,7 +2150,7 @@ class TestNoStore(unittest.TestCase):
 
 
 class NonAnonymousAuthRequest(object):
-    endpoint = 'unused'
+    endpoint = OpenIDServiceEndpoint()
 
     def setAnonymous(self, unused):
         raise ValueError('Should trigger ProtocolError')
@@ -3,18 +3,20 @@ from __future__ import unicode_literals
 
 import base64
 import os
+import time
 import unittest
 import warnings
 
 import six
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric.dh import DHPrivateNumbers, DHPublicNumbers
-from testfixtures import ShouldWarn
+from cryptography.hazmat.primitives.asymmetric.dh import DHParameterNumbers, DHPrivateNumbers, DHPublicNumbers
+from mock import Mock
+from testfixtures import LogCapture, ShouldWarn
 
 from openid.constants import DEFAULT_DH_GENERATOR, DEFAULT_DH_MODULUS
 from openid.cryptutil import base64ToLong
-from openid.dh import DiffieHellman, strxor
+from openid.dh import DiffieHellman, DiffieHellmanKeyPool, getDefaultKeyPool, setDefaultKeyPool, strxor
 from openid.oidutil import toBase64
 
 
@@ -191,3 +193,87 @@ class TestDiffieHellman(unittest.TestCase):
         shared_secret = consumer_dh.xor_secret(server_public_key, mac_key, hashes.SHA256())
         # Check secret was negotiated correctly
         self.assertEqual(secret, shared_secret)
+
+
+class TestDiffieHellmanKeyPool(unittest.TestCase):
+    """Test `DiffieHellmanKeyPool` class."""
+
+    def tearDown(self):
+        setDefaultKeyPool(None)
+
+    def test_get(self):
+        pool = DiffieHellmanKeyPool(size=2)
+        self.assertEqual(pool.depth(), 0)
+        self.assertEqual(pool.fill(), 2)
+        self.assertEqual(pool.depth(), 2)
+        parameter_numbers = DHParameterNumbers(base64ToLong(DEFAULT_DH_MODULUS), base64ToLong(DEFAULT_DH_GENERATOR))
+
+        key_1 = pool.get(parameter_numbers)
+        key_2 = pool.get(parameter_numbers)
+        self.assertEqual((pool.hits, pool.misses), (2, 0))
+        self.assertEqual(pool.depth(), 0)
+        # Empty pool generates keys synchronously
+        key_3 = pool.get(parameter_numbers)
+        self.assertEqual((pool.hits, pool.misses), (2, 1))
+        self.assertEqual(len(set(k.private_numbers().x for k in (key_1, key_2, key_3))), 3)
+
+    def test_get_unknown_parameters(self):
+        pool = DiffieHellmanKeyPool(size=2)
+        parameter_numbers = DHParameterNumbers(base64ToLong(DEFAULT_DH_MODULUS), 5)
+        self.assertEqual(pool.get(parameter_numbers).parameters().parameter_numbers().g, 5)
+        self.assertEqual((pool.hits, pool.misses), (0, 0))
+        self.assertEqual(pool.depth(DEFAULT_DH_MODULUS, 'BQ=='), 0)
+
+    def test_background(self):
+        pool = DiffieHellmanKeyPool(size=3)
+        pool.start()
+        try:
+            for _ in range(100):
+                if pool.depth() == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pool.depth(), 3)
+        finally:
+            pool.stop()
+
+    def test_background_error(self):
+        pool = DiffieHellmanKeyPool(size=3)
+        key = list(pool._pools)[0]
+        parameters, keys = pool._pools[key]
+        pool._pools[key] = (Mock(generate_private_key=Mock(side_effect=ValueError('Oops'))), keys)
+        with LogCapture() as logbook:
+            pool.start()
+            for _ in range(100):
+                if pool._thread is None:
+                    break
+                time.sleep(0.01)
+        logbook.check(('openid.dh', 'ERROR', 'Failed to generate Diffie-Hellman private key.'))
+        # The failed thread is cleaned up, so the pool can be started again
+        self.assertFalse(pool._running)
+        self.assertIsNone(pool._thread)
+        pool._pools[key] = (parameters, keys)
+        pool.start()
+        try:
+            for _ in range(100):
+                if pool.depth() == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pool.depth(), 3)
+        finally:
+            pool.stop()
+
+    def test_default_key_pool(self):
+        self.assertIsNone(getDefaultKeyPool())
+        pool = DiffieHellmanKeyPool(size=1)
+        pool.fill()
+        setDefaultKeyPool(pool)
+        self.assertEqual(getDefaultKeyPool(), pool)
+
+        consumer_dh = DiffieHellman.fromDefaults()
+        server_dh = DiffieHellman.fromDefaults()
+        # Keys are taken from the pool when they're needed
+        self.assertEqual((pool.hits, pool.misses), (0, 0))
+        secret = toBase64(os.urandom(20))
+        mac_key = server_dh.xor_secret(consumer_dh.public_key, secret, hashes.SHA1())
+        self.assertEqual(consumer_dh.xor_secret(server_dh.public_key, mac_key, hashes.SHA1()), secret)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
@@ -2,11 +2,16 @@
 from __future__ import unicode_literals
 
 import os.path
+import time
 import unittest
 
+import six
+from mock import ANY
 from six.moves.urllib.parse import urlsplit
+from testfixtures import LogCapture
 
 from openid import fetchers, message
+from openid.cache import LRUCache
 from openid.consumer import discover
 from openid.fetchers import HTTPResponse
 from openid.yadis import xrires
@@ -711,6 +716,170 @@ class TestDiscoverFunction(unittest.TestCase):
         self.assertEqual(discover.discover('=something'), 'XRI')
 
 
+class CacheHeadersMockFetcher(DiscoveryMockFetcher):
+    """Mock fetcher which adds cache headers to responses."""
+    cache_headers = {}
+
+    def fetch(self, url, body=None, headers=None):
+        response = super(CacheHeadersMockFetcher, self).fetch(url, body, headers)
+        response.headers.update(self.cache_headers)
+        return response
+
+
+class DictMemcachedClient(object):
+    """Memcached client which keeps the values in a dictionary."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, expire=0):
+        assert isinstance(value, six.binary_type) and expire > 0
+        assert len(key) <= 250 and ' ' not in key
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class TestDiscoveryCache(BaseTestDiscovery):
+    fetcherClass = CacheHeadersMockFetcher
+    documents = {
+        BaseTestDiscovery.id_url: ('application/xrds+xml', readDataFile('yadis_2entries_delegate.xml')),
+    }
+
+    def setUp(self):
+        super(TestDiscoveryCache, self).setUp()
+        self.cache = discover.DiscoveryCache()
+
+    def tearDown(self):
+        discover.setDefaultDiscoveryCache(None)
+        super(TestDiscoveryCache, self).tearDown()
+
+    def test_discover(self):
+        claimed_id, services = self.cache.discover(self.id_url)
+        self.assertEqual(claimed_id, self.id_url)
+        self.assertEqual(len(services), 2)
+        # Returned list may be consumed by the caller
+        services.pop()
+        self.assertEqual(self.cache.discover(self.id_url), (claimed_id, [services[0], ANY]))
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+    def test_discover_normalized(self):
+        self.cache.discover(self.id_url)
+        self.assertEqual(self.cache.discover('someuser.unittest')[0], self.id_url)
+        self.assertEqual(self.cache.discover('HTTP://SomeUser.unittest:80/')[0], self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+    def test_discover_expiration(self):
+        self.fetcher.cache_headers = {'cache-control': 'max-age=60'}
+        self.cache.discover(self.id_url)
+        key = self.id_url
+        expires = self.cache.cache._entries[key][1]
+        self.assertAlmostEqual(expires, time.time() + 60, delta=5)
+
+    def test_discover_no_cache(self):
+        self.fetcher.cache_headers = {'cache-control': 'no-cache'}
+        self.cache.discover(self.id_url)
+        self.cache.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+
+    def test_discover_failure(self):
+        url = self.id_url + 'missing'
+        with self.assertRaises(DiscoveryFailure) as cached:
+            self.cache.discover(url)
+        with self.assertRaises(DiscoveryFailure) as error:
+            self.cache.discover(url)
+        # Cached failure is raised as a new instance
+        self.assertIsNot(error.exception, cached.exception)
+        self.assertIsInstance(error.exception, DiscoveryFailure)
+        self.assertEqual(error.exception.args, cached.exception.args)
+        self.assertEqual(error.exception.http_response, cached.exception.http_response)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+    def test_discover_no_services(self):
+        self.documents[self.id_url] = ('text/html', b'<html><head></head></html>')
+        self.cache.negative_ttl = 0
+        self.assertEqual(self.cache.discover(self.id_url), (self.id_url, []))
+        self.assertEqual(self.cache.discover(self.id_url), (self.id_url, []))
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+
+    def test_backend(self):
+        backend = LRUCache()
+        self.cache = discover.DiscoveryCache(backend=backend)
+        services = self.cache.discover(self.id_url)[1]
+        other_cache = discover.DiscoveryCache(backend=backend)
+        self.assertEqual(other_cache.discover(self.id_url)[1], services)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+        # Failures are not stored in the backend
+        self.assertRaises(DiscoveryFailure, self.cache.discover, self.id_url + 'missing')
+        self.assertEqual(len(backend), 1)
+
+    def test_memcached_backend(self):
+        client = DictMemcachedClient()
+        backend = discover.MemcachedDiscoveryBackend(client)
+        self.cache = discover.DiscoveryCache(backend=backend)
+        claimed_id, services = self.cache.discover(self.id_url)
+        other_cache = discover.DiscoveryCache(backend=backend)
+        other_claimed_id, other_services = other_cache.discover(self.id_url)
+        self.assertEqual(other_claimed_id, claimed_id)
+        self.assertEqual([s.toSessionData() for s in other_services], [s.toSessionData() for s in services])
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+        self.assertEqual(len(client.values), 1)
+        # Invalidation removes the entry from the backend as well
+        self.assertTrue(other_cache.invalidate(self.id_url))
+        self.assertEqual(client.values, {})
+        self.assertIsNone(backend.get(self.id_url))
+
+    def test_memcached_backend_invalid(self):
+        client = DictMemcachedClient()
+        backend = discover.MemcachedDiscoveryBackend(client)
+        self.cache = discover.DiscoveryCache(backend=backend)
+        self.cache.discover(self.id_url)
+        key = list(client.values)[0]
+        for data in (b'invalid', b'[2, "claimed_id", [], 0]', b'{}', b'[1, "claimed_id", [["invalid"]], 0]'):
+            client.values[key] = data
+            with LogCapture() as logbook:
+                self.assertIsNone(backend.get(self.id_url))
+            self.assertEqual(len(logbook.records), 1)
+            self.assertEqual(logbook.records[0].levelname, 'WARNING')
+
+    def test_get_set(self):
+        key = self.cache.getKey('someuser.unittest')
+        self.assertEqual(key, self.id_url)
+        self.assertIsNone(self.cache.get(key))
+        service = discover.OpenIDServiceEndpoint()
+        self.cache.set(key, (self.id_url, [service]))
+        self.assertEqual(self.cache.get(key), (self.id_url, [service]))
+        self.assertEqual(self.cache.discover(self.id_url), (self.id_url, [service]))
+        self.assertEqual(self.fetcher.fetchlog, [])
+
+    def test_get_set_failure(self):
+        error = DiscoveryFailure('Oops', None)
+        self.cache.set(self.id_url, None, error=error)
+        with self.assertRaises(DiscoveryFailure) as cached:
+            self.cache.get(self.id_url)
+        self.assertIsNot(cached.exception, error)
+        self.assertEqual(cached.exception.args, error.args)
+
+    def test_invalidate(self):
+        self.assertFalse(self.cache.invalidate(self.id_url))
+        self.cache.discover(self.id_url)
+        self.assertTrue(self.cache.invalidate('someuser.unittest'))
+        self.cache.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+        self.assertFalse(self.cache.invalidate('ftp://someuser.unittest/'))
+
+    def test_default_cache(self):
+        discover.setDefaultDiscoveryCache(self.cache)
+        self.assertEqual(discover.getDefaultDiscoveryCache(), self.cache)
+        discover.discover(self.id_url)
+        discover.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+
 class TestEndpointSupportsType(unittest.TestCase):
     def setUp(self):
         self.endpoint = discover.OpenIDServiceEndpoint()
@@ -764,3 +933,44 @@ class TestEndpointDisplayIdentifier(unittest.TestCase):
         endpoint = discover.OpenIDServiceEndpoint()
         endpoint.claimed_id = 'http://recycled.invalid/#123'
         self.assertEqual(endpoint.getDisplayIdentifier(), 'http://recycled.invalid/')
+
+
+class TestEndpointSessionData(unittest.TestCase):
+    """Test `OpenIDServiceEndpoint.toSessionData` and `OpenIDServiceEndpoint.fromSessionData`."""
+
+    def assertEndpointsEqual(self, endpoint, other):
+        self.assertEqual(endpoint.__dict__, other.__dict__)
+
+    def test_full(self):
+        endpoint = discover.OpenIDServiceEndpoint()
+        endpoint.server_url = 'http://op.example.com/openid'
+        endpoint.claimed_id = 'http://user.example.com/'
+        endpoint.type_uris = [discover.OPENID_2_0_TYPE, 'http://openid.net/srv/ax/1.0']
+        endpoint.local_id = 'http://user.example.com/local'
+        endpoint.canonicalID = '=!1000'
+        endpoint.used_yadis = True
+        endpoint.display_identifier = '=example'
+
+        data = endpoint.toSessionData()
+        self.assertEqual(data, [1, 'http://op.example.com/openid', 'http://user.example.com/',
+                                [1, 'http://openid.net/srv/ax/1.0'], 'http://user.example.com/local', '=!1000', True,
+                                '=example'])
+        self.assertEndpointsEqual(discover.OpenIDServiceEndpoint.fromSessionData(data), endpoint)
+
+    def test_minimal(self):
+        endpoint = discover.OpenIDServiceEndpoint.fromOPEndpointURL('http://op.example.com/openid')
+        data = endpoint.toSessionData()
+        # Empty values are left out
+        self.assertEqual(data, [1, 'http://op.example.com/openid', None, [0]])
+        self.assertEndpointsEqual(discover.OpenIDServiceEndpoint.fromSessionData(data), endpoint)
+
+    def test_tuple(self):
+        data = (1, 'http://op.example.com/openid', 'http://user.example.com/', (3, ))
+        endpoint = discover.OpenIDServiceEndpoint.fromSessionData(data)
+        self.assertEqual(endpoint.type_uris, [discover.OPENID_1_0_TYPE])
+
+    def test_invalid(self):
+        for data in (None, [], [2, 'http://op.example.com/openid', None, []], [1, 'http://op.example.com/openid'],
+                     [1, 'http://op.example.com/openid', None, [42]], [1, 'http://op.example.com/openid', None, None]):
+            with self.assertRaises(ValueError):
+                discover.OpenIDServiceEndpoint.fromSessionData(data)
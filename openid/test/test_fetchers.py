@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
+import errno
 import socket
+import threading
+import time
 import unittest
 import warnings
 
@@ -8,6 +11,7 @@ import responses
 import six
 from mock import Mock, patch, sentinel
 from six import StringIO
+from six.moves import http_client, socketserver
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from six.moves.urllib.error import HTTPError, URLError
 from six.moves.urllib.request import BaseHandler, OpenerDirector, install_opener
@@ -147,6 +151,8 @@ def run_fetcher_tests(server):
             else:
                 raise
 
+    exc_fetchers.append(fetchers.PooledHTTPFetcher())
+
     non_exc_fetchers = []
     for f in exc_fetchers:
         non_exc_fetchers.append(fetchers.ExceptionWrappingFetcher(f))
@@ -450,3 +456,121 @@ class TestRequestsFetcher(unittest.TestCase):
             rsps.add(responses.GET, 'http://example.cz/', body=ConnectionError('Name or service not known'))
             with six.assertRaisesRegex(self, ConnectionError, 'Name or service not known'):
                 self.fetcher.fetch('http://example.cz/')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server which handles each connection in a thread."""
+
+
+class KeepAliveTestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 handler which keeps the connections open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args):
+        pass
+
+    def do_GET(self):
+        self._respond(self.path.encode('utf-8'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-length')))
+        self.server.posts.append(self.path)
+        if self.path == '/slow':
+            time.sleep(0.5)
+        self._respond(body)
+
+    def _respond(self, body):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/success')
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            # Close the connection without telling the client
+            self.close_connection = True
+
+
+class TestPooledHTTPFetcher(unittest.TestCase):
+    """Test `PooledHTTPFetcher` class."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), KeepAliveTestHandler)
+        self.server.daemon_threads = True
+        self.server.posts = []
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.fetcher = fetchers.PooledHTTPFetcher()
+        self.addCleanup(self.fetcher.close)
+
+    def geturl(self, path):
+        return 'http://localhost:%s%s' % (self.server.server_address[1], path)
+
+    def test_reuse(self):
+        response = self.fetcher.fetch(self.geturl('/success'))
+        expected = fetchers.HTTPResponse(self.geturl('/success'), 200, {'content-type': 'text/plain'}, b'/success')
+        assertResponse(expected, response)
+        response = self.fetcher.fetch(self.geturl('/other'), body=b'key=value')
+        expected = fetchers.HTTPResponse(self.geturl('/other'), 200, {'content-type': 'text/plain'}, b'key=value')
+        assertResponse(expected, response)
+        self.assertEqual(self.fetcher.connections_created, 1)
+        self.assertEqual(self.fetcher.connections_reused, 1)
+
+    def test_redirect(self):
+        response = self.fetcher.fetch(self.geturl('/redirect'))
+        expected = fetchers.HTTPResponse(self.geturl('/success'), 200, {'content-type': 'text/plain'}, b'/success')
+        assertResponse(expected, response)
+        self.assertEqual(self.fetcher.connections_created, 1)
+        self.assertEqual(self.fetcher.connections_reused, 1)
+
+    def test_too_many_redirects(self):
+        self.fetcher.max_redirects = 0
+        with six.assertRaisesRegex(self, fetchers.HTTPError, 'Too many redirects'):
+            self.fetcher.fetch(self.geturl('/redirect'))
+
+    def test_idle_timeout(self):
+        self.fetcher.idle_timeout = 0
+        self.fetcher.fetch(self.geturl('/success'))
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.connections_created, 2)
+        self.assertEqual(self.fetcher.connections_reused, 0)
+
+    def test_max_connections(self):
+        self.fetcher.max_connections = 0
+        self.fetcher.fetch(self.geturl('/success'))
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.connections_created, 2)
+
+    def test_closed_by_server(self):
+        # The connection closed by the server is replaced by a new one
+        self.fetcher.fetch(self.geturl('/close'))
+        response = self.fetcher.fetch(self.geturl('/success'), body=b'key=value')
+        self.assertEqual(response.body, b'key=value')
+        self.assertEqual(self.fetcher.connections_created, 2)
+        self.assertEqual(self.fetcher.connections_reused, 1)
+
+    def test_timeout_not_resent(self):
+        # Timed out request may have been processed by the server, it is not sent again
+        self.fetcher.timeout = 0.1
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertRaises(socket.timeout, self.fetcher.fetch, self.geturl('/slow'), body=b'key=value')
+        self.assertEqual(self.server.posts, ['/slow'])
+        self.assertEqual(self.fetcher.connections_created, 1)
+
+    def test_error_not_resent(self):
+        self.fetcher.fetch(self.geturl('/success'))
+        error = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        with patch.object(http_client.HTTPConnection, 'getresponse', side_effect=error):
+            self.assertRaises(socket.error, self.fetcher.fetch, self.geturl('/success'), body=b'key=value')
+        self.assertEqual(self.fetcher.connections_created, 1)
+
+    def test_invalid_url(self):
+        with six.assertRaisesRegex(self, ValueError, 'Bad URL scheme:'):
+            self.fetcher.fetch('invalid://example.cz/')
@@ -5,13 +5,15 @@ import unittest
 import warnings
 
 from lxml import etree as ElementTree
+from mock import patch
 from six.moves.urllib.parse import parse_qs, quote
 from testfixtures import ShouldWarn
 
+from openid import oidutil
 from openid.extensions import sreg
 from openid.message import (BARE_NS, NULL_NAMESPACE, OPENID1_NS, OPENID2_NS, OPENID_NS, OPENID_PROTOCOL_FIELDS,
                             THE_OTHER_OPENID1_NS, InvalidNamespace, InvalidOpenIDNamespace, Message, NamespaceMap,
-                            UndefinedOpenIDNamespace, no_default)
+                            UndefinedOpenIDNamespace, _quoted_args, no_default)
 
 
 def mkGetArgTest(ns, key, expected=None):
@@ -746,6 +748,62 @@ class MessageTest(unittest.TestCase):
             'method': 'post',
         }
 
+    def test_copy(self):
+        msg = Message.fromPostArgs(self.postargs)
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(msg_copy.toPostArgs(), self.postargs)
+
+        msg_copy.setArg(OPENID2_NS, 'mode', 'id_res')
+        msg_copy.setArg('http://example.com/ext', 'key', 'value')
+        self.assertEqual(msg.getArg(OPENID2_NS, 'mode'), 'checkid_setup')
+        self.assertFalse(msg.namespaces.isDefined('http://example.com/ext'))
+        self.assertEqual(msg.toPostArgs(), self.postargs)
+
+    def test_lazy_args(self):
+        postargs = dict(self.postargs, **{
+            'openid.ns.ext': 'http://example.com/ext', 'openid.ext.key': 'value', 'openid.unknown.key': 'other',
+            'bare': 'arg'})
+        msg = Message.fromPostArgs(postargs)
+        # Plain OpenID arguments are available without indexing
+        self.assertEqual(msg.getArg(OPENID_NS, 'mode'), 'checkid_setup')
+        self.assertTrue(msg.hasKey(OPENID_NS, 'return_to'))
+        self.assertIsNone(msg.getArg(OPENID_NS, 'missing'))
+        self.assertRaises(KeyError, msg.getArg, OPENID_NS, 'missing', no_default)
+        self.assertIsNotNone(msg._pending_args)
+
+        self.assertEqual(msg.getArg('http://example.com/ext', 'key'), 'value')
+        self.assertIsNone(msg._pending_args)
+        self.assertFalse(msg.hasKey(OPENID_NS, 'ns'))
+        self.assertEqual(msg.args, {
+            (OPENID2_NS, 'mode'): 'checkid_setup',
+            (OPENID2_NS, 'identity'): 'http://bogus.example.invalid:port/',
+            (OPENID2_NS, 'assoc_handle'): 'FLUB',
+            (OPENID2_NS, 'return_to'): 'Neverland',
+            (OPENID2_NS, 'unknown.key'): 'other',
+            ('http://example.com/ext', 'key'): 'value',
+            (BARE_NS, 'bare'): 'arg',
+        })
+        self.assertEqual(msg.toPostArgs(), postargs)
+
+    def test_lazy_args_set(self):
+        msg = Message.fromPostArgs(self.postargs)
+        msg.setArg(OPENID_NS, 'mode', 'id_res')
+        self.assertEqual(msg.getArg(OPENID_NS, 'mode'), 'id_res')
+        self.assertEqual(msg.getArg(OPENID_NS, 'assoc_handle'), 'FLUB')
+
+    def test_lazy_args_errors(self):
+        # Errors are raised when the message is created
+        self.assertRaises(InvalidOpenIDNamespace, Message.fromPostArgs, {'openid.ns': 'http://invalid.example/'})
+        postargs = dict(self.postargs, **{'openid.ns.a': 'http://example.com/', 'openid.ns.b': 'http://example.com/'})
+        self.assertRaises(InvalidNamespace, Message.fromPostArgs, postargs)
+
+    def test_unpickle_old(self):
+        # Message pickled before arguments were indexed lazily
+        msg = Message.__new__(Message)
+        msg.__setstate__({'args': {(OPENID2_NS, 'mode'): 'id_res'}, 'namespaces': NamespaceMap()})
+        self.assertEqual(msg.args, {(OPENID2_NS, 'mode'): 'id_res'})
+
     def _checkForm(self, html, message_, action_url,
                    form_tag_attrs, submit_text):
         # Build element tree from HTML source
@@ -940,6 +998,86 @@ class MessageTest(unittest.TestCase):
         self.assertTrue(m.isOpenID1())
 
 
+def referenceFormMarkup(message, action_url, form_tag_attrs=None, submit_text="Continue"):
+    """Generate form markup by lxml, as Message.toFormMarkup did before it rendered the markup directly."""
+    form = ElementTree.Element('form')
+    if form_tag_attrs:
+        for name, attr in form_tag_attrs.items():
+            form.attrib[name] = attr
+    form.attrib['action'] = action_url
+    form.attrib['method'] = 'post'
+    form.attrib['accept-charset'] = 'UTF-8'
+    form.attrib['enctype'] = 'application/x-www-form-urlencoded'
+    for name, value in message.toPostArgs().items():
+        attrs = {'type': 'hidden', 'name': name, 'value': value}
+        form.append(ElementTree.Element('input', attrs))
+    submit = ElementTree.Element('input', {'type': 'submit', 'value': submit_text})
+    form.append(submit)
+    return ElementTree.tostring(form, encoding='unicode')
+
+
+class EncodingDifferentialTest(unittest.TestCase):
+    """Test that form and URL encoding produce the same output as lxml and `oidutil.appendArgs`."""
+
+    post_args = [
+        {},
+        {'openid.mode': 'error', 'openid.error': 'unit test'},
+        {'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup',
+         'openid.identity': 'http://bogus.example.invalid:port/', 'openid.assoc_handle': 'FLUB',
+         'openid.return_to': 'Neverland'},
+        {'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'ünicöde_key': 'ünicöde_välüe',
+         'emoji': '\U0001F600'},
+        {'openid.ns': OPENID2_NS, 'openid.mode': 'id_res', 'openid.ns.ax': 'http://openid.net/srv/ax/1.0',
+         'openid.ax.mode': 'fetch_response', 'openid.ax.type.email': 'http://axschema.org/contact/email',
+         'openid.ax.value.email': 'a@example.com', 'openid.ax.count.nick': '2', 'openid.ax.value.nick.1': 'x y',
+         'openid.ax.value.nick.2': '', 'openid.return_to': 'http://example.com/?a=1&b=2#frag'},
+        {'openid.ns': OPENID2_NS, 'openid.mode': 'id_res', 'openid.sig': 'a+b/c==',
+         'quote"s': '<tag attr="value">&amp;</tag>', "apos'": "it's ~fine~ 100%",
+         'white space': 'line\nbreak\rreturn\ttab', 'controls': '\x7f\x85\u2028'},
+    ]
+    form_tag_attrs = [
+        None,
+        {'company': 'janrain', 'class': 'fancyCSS'},
+        {'method': 'GET', 'id': 'openid_message', 'action': 'overridden', 'accept-charset': 'UCS4'},
+        {'data-text': 'a "quoted" <value> & more'},
+        {'{http://www.w3.org/XML/1998/namespace}lang': 'en'},
+        {'class': b'binary'},
+    ]
+    urls = ['http://example.com/return', 'http://example.com/return?x=1', 'scheme://host:port/path?query',
+            'http://example.com/ünicöde']
+
+    def test_toFormMarkup(self):
+        for post_args in self.post_args:
+            message = Message.fromPostArgs(post_args)
+            for form_tag_attrs in self.form_tag_attrs:
+                for action_url in self.urls:
+                    for submit_text in ('Continue', 'Go & "submit"'):
+                        expected = referenceFormMarkup(message, action_url, form_tag_attrs, submit_text)
+                        self.assertEqual(message.toFormMarkup(action_url, form_tag_attrs, submit_text), expected)
+
+    def test_toFormMarkup_incompatible(self):
+        message = Message.fromPostArgs({'openid.mode': 'error', 'openid.error': 'null\x00byte'})
+        self.assertRaises(ValueError, referenceFormMarkup, message, 'http://example.com/')
+        self.assertRaises(ValueError, message.toFormMarkup, 'http://example.com/')
+        message = Message.fromPostArgs({'openid.mode': 'error'})
+        self.assertRaises(ValueError, message.toFormMarkup, 'http://example.com/', submit_text='\x0b')
+        self.assertRaises(ValueError, message.toFormMarkup, 'http://example.com/', {'a b': 'c'})
+
+    def test_toURL(self):
+        for post_args in self.post_args:
+            message = Message.fromPostArgs(post_args)
+            for base_url in self.urls:
+                self.assertEqual(message.toURL(base_url), oidutil.appendArgs(base_url, message.toPostArgs()))
+
+    def test_toURL_cache(self):
+        # Only keys and namespace URIs are cached
+        message = Message.fromPostArgs({'openid.ns': OPENID2_NS, 'openid.mode': 'id_res',
+                                        'openid.sig': 'c2VjcmV0', 'other': 'value'})
+        with patch.dict(_quoted_args, clear=True):
+            message.toURL('http://example.com/')
+            self.assertEqual(set(_quoted_args), {'openid.ns', OPENID2_NS, 'openid.mode', 'openid.sig'})
+
+
 class NamespaceMapTest(unittest.TestCase):
     def test_onealias(self):
         nsm = NamespaceMap()
@@ -949,6 +1087,16 @@ class NamespaceMapTest(unittest.TestCase):
         self.assertEqual(nsm.getNamespaceURI(alias), uri)
         self.assertEqual(nsm.getAlias(uri), alias)
 
+    def test_copy(self):
+        nsm = NamespaceMap()
+        nsm.addAlias('http://example.com/foo', 'foo', implicit=True)
+        nsm_copy = nsm.copy()
+        nsm_copy.addAlias('http://example.com/bar', 'bar', implicit=True)
+        self.assertTrue(nsm_copy.isImplicit('http://example.com/foo'))
+        self.assertEqual(nsm_copy.getAlias('http://example.com/bar'), 'bar')
+        self.assertIsNone(nsm.getAlias('http://example.com/bar'))
+        self.assertFalse(nsm.isImplicit('http://example.com/bar'))
+
     def test_iteration(self):
         nsm = NamespaceMap()
         uripat = 'http://example.com/foo%r'
@@ -1,11 +1,14 @@
 from __future__ import unicode_literals
 
+import time
 import unittest
 
 from testfixtures import LogCapture, StringComparison
 
 from openid import association
-from openid.consumer.consumer import GenericConsumer, ServerError
+from openid.consumer.consumer import (GenericConsumer, OPCapabilityCache, OPCircuitBreaker, ServerError,
+                                      getDefaultCapabilityCache, getDefaultCircuitBreaker, setDefaultCapabilityCache,
+                                      setDefaultCircuitBreaker)
 from openid.consumer.discover import OPENID_2_0_TYPE, OpenIDServiceEndpoint
 from openid.message import OPENID1_NS, OPENID_NS, Message
 
@@ -31,6 +34,18 @@ class ErrorRaisingConsumer(GenericConsumer):
             return m
 
 
+class TypeRecordingConsumer(ErrorRaisingConsumer):
+    """Consumer which records the requested association and session types."""
+
+    def __init__(self, store):
+        super(TypeRecordingConsumer, self).__init__(store)
+        self.requested_types = []
+
+    def _requestAssociation(self, endpoint, assoc_type, session_type):
+        self.requested_types.append((assoc_type, session_type))
+        return super(TypeRecordingConsumer, self)._requestAssociation(endpoint, assoc_type, session_type)
+
+
 class TestOpenID2SessionNegotiation(unittest.TestCase):
     """
     Test the session type negotiation behavior of an OpenID 2
@@ -281,5 +296,246 @@ class TestNegotiatorBehaviors(unittest.TestCase):
             self.assertIn((assoc_type, typ), self.n.allowed_types)
 
 
+class TestOPCapabilityCache(unittest.TestCase):
+    """Test negotiation with `OPCapabilityCache`."""
+
+    def setUp(self):
+        self.cache = OPCapabilityCache()
+        setDefaultCapabilityCache(self.cache)
+        self.consumer = TypeRecordingConsumer(store=None)
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.type_uris = [OPENID_2_0_TYPE]
+        self.endpoint.server_url = 'http://op.example.com/openid'
+        self.assoc = association.Association.fromExpiresIn(3600, 'handle', b'secret', 'HMAC-SHA1')
+
+    def tearDown(self):
+        setDefaultCapabilityCache(None)
+
+    def _unsupported(self, assoc_type=None, session_type=None):
+        msg = Message(self.endpoint.preferredNamespace())
+        msg.setArg(OPENID_NS, 'error', 'Unsupported type')
+        msg.setArg(OPENID_NS, 'error_code', 'unsupported-type')
+        if assoc_type is not None:
+            msg.setArg(OPENID_NS, 'assoc_type', assoc_type)
+            msg.setArg(OPENID_NS, 'session_type', session_type)
+        return msg
+
+    def test_default(self):
+        self.assertEqual(getDefaultCapabilityCache(), self.cache)
+
+    def test_supported(self):
+        self.consumer.return_messages = [self._unsupported('HMAC-SHA1', 'DH-SHA1'), self.assoc]
+        with LogCapture():
+            self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        # Next negotiation starts with the supported type
+        self.consumer.return_messages = [self.assoc]
+        self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        self.assertEqual(self.consumer.requested_types,
+                         [('HMAC-SHA256', 'DH-SHA256'), ('HMAC-SHA1', 'DH-SHA1'), ('HMAC-SHA1', 'DH-SHA1')])
+
+    def test_supported_not_allowed(self):
+        self.cache.addSupported(self.endpoint.server_url, 'HMAC-SHA1', 'no-encryption')
+        self.consumer.negotiator = association.SessionNegotiator([('HMAC-SHA1', 'DH-SHA1')])
+        self.assertEqual(self.cache.getPreferredType(self.endpoint.server_url, self.consumer.negotiator),
+                         ('HMAC-SHA1', 'DH-SHA1'))
+
+    def test_refused(self):
+        self.consumer.return_messages = [self._unsupported()]
+        with LogCapture():
+            self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        # Refused type is skipped
+        next_type = self.consumer.negotiator.allowed_types[1]
+        self.assertEqual(self.cache.getPreferredType(self.endpoint.server_url, self.consumer.negotiator), next_type)
+        # Supported type which is refused later is forgotten
+        self.cache.addSupported(self.endpoint.server_url, 'HMAC-SHA1', 'DH-SHA1')
+        self.cache.addRefused(self.endpoint.server_url, 'HMAC-SHA1', 'DH-SHA1')
+        self.assertEqual(self.cache.getPreferredType(self.endpoint.server_url, self.consumer.negotiator), next_type)
+
+    def test_backoff(self):
+        self.consumer.return_messages = [None]
+        self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        self.assertTrue(self.cache.isBackingOff(self.endpoint.server_url))
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Association with http://op.example.com/openid failed recently, using stateless mode.'))
+        self.assertEqual(len(self.consumer.requested_types), 1)
+
+        # Backoff grows with consecutive failures
+        entry = self.cache.cache.get(self.endpoint.server_url)
+        entry.last_failure = time.time() - 31
+        self.assertFalse(self.cache.isBackingOff(self.endpoint.server_url))
+        self.consumer.return_messages = [None]
+        self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        entry.last_failure = time.time() - 31
+        self.assertTrue(self.cache.isBackingOff(self.endpoint.server_url))
+        entry.last_failure = time.time() - 61
+        self.assertFalse(self.cache.isBackingOff(self.endpoint.server_url))
+
+        # Success resets the backoff
+        self.consumer.return_messages = [self.assoc]
+        self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        self.assertFalse(self.cache.isBackingOff(self.endpoint.server_url))
+        self.assertEqual(entry.failures, 0)
+
+    def test_max_backoff(self):
+        self.cache.max_backoff = 100
+        for i in range(20):
+            self.cache.addFailure(self.endpoint.server_url)
+        self.cache.cache.get(self.endpoint.server_url).last_failure = time.time() - 101
+        self.assertFalse(self.cache.isBackingOff(self.endpoint.server_url))
+
+
+class TestOPCircuitBreaker(unittest.TestCase):
+    """Test negotiation with `OPCircuitBreaker`."""
+
+    def setUp(self):
+        self.breaker = OPCircuitBreaker(failure_threshold=2, reset_timeout=60)
+        setDefaultCircuitBreaker(self.breaker)
+        self.consumer = TypeRecordingConsumer(store=None)
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.type_uris = [OPENID_2_0_TYPE]
+        self.endpoint.server_url = 'http://op.example.com/openid'
+        self.assoc = association.Association.fromExpiresIn(3600, 'handle', b'secret', 'HMAC-SHA1')
+
+    def tearDown(self):
+        setDefaultCircuitBreaker(None)
+
+    def _fail(self, count):
+        for _ in range(count):
+            self.consumer.return_messages = [None]
+            self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+
+    def test_default(self):
+        self.assertEqual(getDefaultCircuitBreaker(), self.breaker)
+
+    def test_closed(self):
+        self.consumer.return_messages = [self.assoc]
+        self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.getCounters(self.endpoint.server_url),
+                         {'successes': 1, 'failures': 0, 'rejections': 0, 'openings': 0})
+        self.assertEqual(self.breaker.getCounters('http://unknown.example.com/'),
+                         {'successes': 0, 'failures': 0, 'rejections': 0, 'openings': 0})
+
+    def test_threshold(self):
+        self._fail(1)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.CLOSED)
+        with LogCapture() as logbook:
+            self._fail(1)
+        logbook.check(('openid.consumer.consumer', 'WARNING',
+                       'Circuit of http://op.example.com/openid is open after 2 failed associations.'))
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.OPEN)
+
+        # Open circuit makes no requests
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Circuit of http://op.example.com/openid is open, using stateless mode.'))
+        self.assertEqual(len(self.consumer.requested_types), 2)
+        self.assertEqual(self.breaker.getCounters(self.endpoint.server_url),
+                         {'successes': 0, 'failures': 2, 'rejections': 1, 'openings': 1})
+
+    def test_success_resets_failures(self):
+        self._fail(1)
+        self.consumer.return_messages = [self.assoc]
+        self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        self._fail(1)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.CLOSED)
+
+    def test_half_open(self):
+        with LogCapture():
+            self._fail(2)
+        entry = self.breaker.cache.get(self.endpoint.server_url)
+        entry.changed = time.time() - 61
+
+        # Only a single probe is made
+        self.assertTrue(self.breaker.allowRequest(self.endpoint.server_url))
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allowRequest(self.endpoint.server_url))
+
+        # Failed probe opens the circuit again
+        with LogCapture():
+            self.breaker.addResult(self.endpoint.server_url, False)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allowRequest(self.endpoint.server_url))
+
+        # Successful probe closes the circuit
+        entry.changed = time.time() - 61
+        self.consumer.return_messages = [self.assoc]
+        self.assertEqual(self.consumer._negotiateAssociation(self.endpoint), self.assoc)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.getCounters(self.endpoint.server_url),
+                         {'successes': 1, 'failures': 3, 'rejections': 2, 'openings': 2})
+
+    def test_error_reported(self):
+        with LogCapture():
+            self._fail(1)
+
+        def requestAssociation(endpoint, assoc_type, session_type):
+            raise ValueError('Oops')
+
+        self.consumer._requestAssociation = requestAssociation
+        # Unexpected error is reported as a failed negotiation
+        with LogCapture():
+            self.assertRaises(ValueError, self.consumer._negotiateAssociation, self.endpoint)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.getCounters(self.endpoint.server_url),
+                         {'successes': 0, 'failures': 2, 'rejections': 0, 'openings': 1})
+
+    def test_half_open_error(self):
+        with LogCapture():
+            self._fail(2)
+        entry = self.breaker.cache.get(self.endpoint.server_url)
+        entry.changed = time.time() - 61
+
+        def requestAssociation(endpoint, assoc_type, session_type):
+            raise ValueError('Oops')
+
+        self.consumer._requestAssociation = requestAssociation
+        # The probe which raises an error opens the circuit again
+        with LogCapture():
+            self.assertRaises(ValueError, self.consumer._negotiateAssociation, self.endpoint)
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.OPEN)
+
+    def test_backoff(self):
+        with LogCapture():
+            self._fail(2)
+        cache = OPCapabilityCache()
+        cache.addFailure(self.endpoint.server_url)
+        setDefaultCapabilityCache(cache)
+        self.addCleanup(setDefaultCapabilityCache, None)
+        entry = self.breaker.cache.get(self.endpoint.server_url)
+        entry.changed = time.time() - 61
+
+        # Backoff is checked before the circuit, so the circuit doesn't wait for a probe
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._negotiateAssociation(self.endpoint))
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Association with http://op.example.com/openid failed recently, using stateless mode.'))
+        self.assertEqual(self.breaker.getState(self.endpoint.server_url), OPCircuitBreaker.OPEN)
+        self.assertEqual(len(self.consumer.requested_types), 2)
+
+    def test_lost_probe(self):
+        with LogCapture():
+            self._fail(2)
+        entry = self.breaker.cache.get(self.endpoint.server_url)
+        entry.changed = time.time() - 61
+        self.assertTrue(self.breaker.allowRequest(self.endpoint.server_url))
+        # Probe which doesn't report its result is replaced after the timeout
+        entry.changed = time.time() - 61
+        self.assertTrue(self.breaker.allowRequest(self.endpoint.server_url))
+
+    def test_slow(self):
+        self.breaker.slow_threshold = 5
+        with LogCapture() as logbook:
+            self.breaker.addResult(self.endpoint.server_url, True, 10)
+            self.breaker.addResult(self.endpoint.server_url, True, 1)
+        logbook.check(('openid.consumer.consumer', 'INFO',
+                       'Association with http://op.example.com/openid took 10.000 seconds, counted as failure.'))
+        self.assertEqual(self.breaker.getCounters(self.endpoint.server_url),
+                         {'successes': 1, 'failures': 1, 'rejections': 0, 'openings': 0})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,13 +1,15 @@
 """Unit tests for verification of return_to URLs for a realm."""
 from __future__ import unicode_literals
 
+import time
 import unittest
 
 from mock import patch, sentinel
 from testfixtures import LogCapture, StringComparison
 
+from openid.fetchers import HTTPFetchingError
 from openid.server import trustroot
-from openid.server.trustroot import getAllowedReturnURLs
+from openid.server.trustroot import RealmVerificationCache, getAllowedReturnURLs
 from openid.yadis import services
 from openid.yadis.discover import DiscoveryFailure, DiscoveryResult
 
@@ -244,6 +246,148 @@ class TestVerifyReturnTo(unittest.TestCase):
             self.assertFalse(trustroot.verifyReturnTo(realm, return_to, _vrfy=vrfy))
         logbook.check(('openid.server.trustroot', 'INFO', StringComparison('Attempting to verify .*')))
 
+    def test_verifyWithDefaultCache(self):
+        realm = 'http://*.example.com/'
+        return_to = 'http://www.example.com/foo'
+        cache = RealmVerificationCache()
+        trustroot.setDefaultVerificationCache(cache)
+        self.addCleanup(trustroot.setDefaultVerificationCache, None)
+        self.assertEqual(trustroot.getDefaultVerificationCache(), cache)
+
+        with patch('openid.yadis.services.getServiceEndpointsExpiration', autospec=True,
+                   return_value=('http://www.example.com/', [return_to], None)) as discover_mock:
+            self.assertTrue(trustroot.verifyReturnTo(realm, return_to))
+            self.assertTrue(trustroot.verifyReturnTo(realm, return_to))
+
+        self.assertEqual(discover_mock.call_count, 1)
+
+
+class TestRealmVerificationCache(unittest.TestCase):
+    """Test `RealmVerificationCache` class."""
+
+    url = 'http://example.com/'
+    return_to = 'http://example.com/return'
+
+    def setUp(self):
+        patcher = patch('openid.yadis.services.getServiceEndpointsExpiration', autospec=True)
+        self.discover_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        self.discover_mock.return_value = (self.url, [self.return_to], None)
+        cache = RealmVerificationCache()
+
+        self.assertEqual(cache.getAllowedReturnURLs(self.url), [self.return_to])
+        self.assertEqual(cache.getAllowedReturnURLs(self.url), [self.return_to])
+
+        self.assertEqual(self.discover_mock.call_count, 1)
+        self.assertEqual(cache.cache.hits, 1)
+
+    def test_invalidate(self):
+        self.discover_mock.return_value = (self.url, [self.return_to], None)
+        cache = RealmVerificationCache()
+
+        cache.getAllowedReturnURLs(self.url)
+        cache.invalidate(self.url)
+        cache.getAllowedReturnURLs(self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 2)
+
+    def test_expired(self):
+        # Expiration in the past isn't cached
+        self.discover_mock.return_value = (self.url, [self.return_to], time.time() - 10)
+        cache = RealmVerificationCache()
+
+        cache.getAllowedReturnURLs(self.url)
+        cache.getAllowedReturnURLs(self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 2)
+
+    def test_min_ttl(self):
+        self.discover_mock.return_value = (self.url, [self.return_to], time.time() - 10)
+        cache = RealmVerificationCache(min_ttl=60)
+
+        cache.getAllowedReturnURLs(self.url)
+        cache.getAllowedReturnURLs(self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 1)
+
+    def test_max_ttl(self):
+        now = time.time()
+        self.discover_mock.return_value = (self.url, [self.return_to], now + 1000000)
+        cache = RealmVerificationCache(max_ttl=60)
+
+        cache.getAllowedReturnURLs(self.url)
+
+        self.assertLessEqual(cache.cache._entries[self.url][1], time.time() + 60)
+
+    def test_default_ttl(self):
+        self.discover_mock.return_value = (self.url, [self.return_to], None)
+        cache = RealmVerificationCache(default_ttl=0)
+
+        cache.getAllowedReturnURLs(self.url)
+        cache.getAllowedReturnURLs(self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 2)
+
+    def test_negative(self):
+        for error in (DiscoveryFailure('Failed', None), HTTPFetchingError('Failed')):
+            self.discover_mock.reset_mock()
+            self.discover_mock.side_effect = error
+            cache = RealmVerificationCache()
+
+            self.assertRaises(type(error), cache.getAllowedReturnURLs, self.url)
+            self.assertRaises(type(error), cache.getAllowedReturnURLs, self.url)
+
+            self.assertEqual(self.discover_mock.call_count, 1)
+
+    def test_negative_fresh_error(self):
+        self.discover_mock.side_effect = DiscoveryFailure('Failed', sentinel.response)
+        cache = RealmVerificationCache()
+
+        errors = []
+        for i in range(3):
+            with self.assertRaises(DiscoveryFailure) as context:
+                cache.getAllowedReturnURLs(self.url)
+            errors.append(context.exception)
+
+        # Each hit raises a new instance of the cached error
+        self.assertEqual(len(set(id(e) for e in errors)), 3)
+        self.assertEqual([e.http_response for e in errors], [sentinel.response] * 3)
+        self.assertEqual(str(errors[-1]), 'Failed')
+
+    def test_negative_ttl(self):
+        self.discover_mock.side_effect = DiscoveryFailure('Failed', None)
+        cache = RealmVerificationCache(negative_ttl=0)
+
+        self.assertRaises(DiscoveryFailure, cache.getAllowedReturnURLs, self.url)
+        self.assertRaises(DiscoveryFailure, cache.getAllowedReturnURLs, self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 2)
+
+    def test_get_set(self):
+        cache = RealmVerificationCache()
+        self.assertIsNone(cache.get(self.url))
+        cache.set(self.url, [self.return_to])
+        self.assertEqual(cache.get(self.url), [self.return_to])
+        self.assertEqual(cache.getAllowedReturnURLs(self.url), [self.return_to])
+        self.assertEqual(self.discover_mock.call_count, 0)
+
+        cache.set(self.url, None, error=DiscoveryFailure('Failed', None))
+        self.assertRaises(DiscoveryFailure, cache.get, self.url)
+        # Past expiration isn't cached
+        cache.set('http://other.example.com/', [self.return_to], time.time() - 10)
+        self.assertIsNone(cache.get('http://other.example.com/'))
+
+    def test_redirect(self):
+        self.discover_mock.return_value = ('http://example.com/redirected', [self.return_to], None)
+        cache = RealmVerificationCache()
+
+        self.assertRaises(trustroot.RealmVerificationRedirected, cache.getAllowedReturnURLs, self.url)
+        self.assertRaises(trustroot.RealmVerificationRedirected, cache.getAllowedReturnURLs, self.url)
+
+        self.assertEqual(self.discover_mock.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
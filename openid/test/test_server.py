@@ -2,23 +2,27 @@
 """
 from __future__ import unicode_literals
 
+import threading
+import time
 import unittest
 import warnings
 from functools import partial
 
 import six
 from cryptography.hazmat.primitives import hashes
-from mock import sentinel
+from mock import Mock, patch, sentinel
 from six.moves.urllib.parse import parse_qs, parse_qsl, urlparse
 from testfixtures import LogCapture, ShouldWarn, StringComparison
 
 from openid import association, cryptutil, oidutil
+from openid.cache import LRUCache
 from openid.consumer.consumer import DiffieHellmanSHA256ConsumerSession
 from openid.dh import DiffieHellman
 from openid.message import IDENTIFIER_SELECT, OPENID1_NS, OPENID1_URL_LIMIT, OPENID2_NS, OPENID_NS, Message, no_default
 from openid.server import server
 from openid.server.server import DiffieHellmanSHA1ServerSession
 from openid.store import memstore
+from openid.test.test_tracing import RecordingTracer
 
 # In general, if you edit or add tests here, try to move in the direction
 # of testing smaller units.  For testing the external interfaces, we'll be
@@ -1287,6 +1291,137 @@ class TestCheckAuth(unittest.TestCase):
         self.assertEqual(r.fields.getArgs(OPENID_NS), {'is_valid': 'true'})
 
 
+class CountingStore(memstore.MemoryStore):
+    """Memory store which records the calls which modify associations."""
+
+    def __init__(self):
+        super(CountingStore, self).__init__()
+        self.calls = []
+
+    def removeAssociation(self, server_url, handle):
+        self.calls.append('removeAssociation')
+        return super(CountingStore, self).removeAssociation(server_url, handle)
+
+    def removeAssociations(self, server_url, handles):
+        self.calls.append('removeAssociations')
+        return super(CountingStore, self).removeAssociations(server_url, handles)
+
+
+class TestCheckAuthBatch(unittest.TestCase):
+    """Test `CheckAuthRequest.answerAll` and `Server.handleRequests`."""
+
+    def setUp(self):
+        self.store = CountingStore()
+        self.server = server.Server(self.store, "http://server.unittest/endpt")
+        self.signatory = self.server.signatory
+
+    def _signed_request(self, **extra):
+        # Sign a positive assertion in dumb mode and make check_authentication request from it
+        response = server.OpenIDResponse(server.OpenIDRequest())
+        response.request.assoc_handle = None
+        args = {'mode': 'id_res', 'ns': OPENID2_NS, 'return_to': 'http://example.com/return'}
+        args.update(extra)
+        response.fields = Message.fromOpenIDArgs(args)
+        message = self.signatory.sign(response).fields.copy()
+        message.setArg(OPENID_NS, 'mode', 'check_authentication')
+        return server.CheckAuthRequest.fromMessage(message)
+
+    def _answers(self, responses):
+        return [r.fields.getArgs(OPENID_NS) for r in responses]
+
+    def test_answerAll(self):
+        requests = [self._signed_request() for i in range(3)]
+        # Break the signature of the second request
+        requests[1].signed.setArg(OPENID_NS, 'return_to', 'http://example.com/other')
+        # Request with unknown association
+        requests.append(server.CheckAuthRequest('{unknown}', requests[0].signed))
+
+        with LogCapture():
+            responses = server.CheckAuthRequest.answerAll(requests, self.signatory)
+
+        self.assertEqual(self._answers(responses), [{'is_valid': 'true'}, {'is_valid': 'false'},
+                                                    {'is_valid': 'true'}, {'is_valid': 'false'}])
+        self.assertEqual([r.request for r in responses], requests)
+        # All associations are invalidated in one call
+        self.assertEqual(self.store.calls, ['removeAssociations'])
+        for request in requests:
+            self.assertIsNone(self.signatory.getAssociation(request.assoc_handle, dumb=True))
+
+    def test_answerAll_replay(self):
+        request = self._signed_request()
+        with LogCapture():
+            responses = server.CheckAuthRequest.answerAll([request, request], self.signatory)
+        self.assertEqual(self._answers(responses), [{'is_valid': 'true'}, {'is_valid': 'false'}])
+
+    def test_answerAll_invalidate_handle(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        requests = [self._signed_request(), self._signed_request(), self._signed_request()]
+        requests[0].invalidate_handle = assoc.handle
+        requests[1].invalidate_handle = '{bogus}'
+        requests[2].invalidate_handle = '{bogus}'
+
+        responses = server.CheckAuthRequest.answerAll(requests, self.signatory)
+
+        self.assertEqual(self._answers(responses), [{'is_valid': 'true'},
+                                                    {'is_valid': 'true', 'invalidate_handle': '{bogus}'},
+                                                    {'is_valid': 'true', 'invalidate_handle': '{bogus}'}])
+
+    def test_answerAll_same_as_answer(self):
+        requests = [self._signed_request() for i in range(2)]
+        requests.append(requests[0])
+        requests[1].invalidate_handle = '{bogus}'
+        with LogCapture():
+            expected = self._answers([r.answer(self.signatory) for r in requests])
+        requests = [self._signed_request() for i in range(2)]
+        requests.append(requests[0])
+        requests[1].invalidate_handle = '{bogus}'
+        with LogCapture():
+            self.assertEqual(self._answers(server.CheckAuthRequest.answerAll(requests, self.signatory)), expected)
+
+    def test_answerAll_store_without_bulk_remove(self):
+        store = memstore.MemoryStore()
+        # Store with just the methods required by the interface
+        self.signatory = server.Signatory(Mock(spec=['storeAssociation', 'getAssociation', 'removeAssociation'],
+                                               storeAssociation=store.storeAssociation,
+                                               getAssociation=store.getAssociation,
+                                               removeAssociation=Mock(side_effect=store.removeAssociation)))
+        requests = [self._signed_request() for i in range(2)]
+        responses = server.CheckAuthRequest.answerAll(requests, self.signatory)
+        self.assertEqual(self._answers(responses), [{'is_valid': 'true'}, {'is_valid': 'true'}])
+        self.assertEqual(self.signatory.store.removeAssociation.call_count, 2)
+        self.assertIsNone(store.getAssociation(self.signatory._dumb_key, requests[0].assoc_handle))
+
+    def test_derived_key_signatory(self):
+        self.signatory = server.DerivedKeySignatory()
+        requests = [self._signed_request() for i in range(2)]
+        requests.append(requests[0])
+        with LogCapture():
+            responses = server.CheckAuthRequest.answerAll(requests, self.signatory)
+        self.assertEqual(self._answers(responses), [{'is_valid': 'true'}, {'is_valid': 'true'},
+                                                    {'is_valid': 'false'}])
+
+    def test_handleRequests(self):
+        tracer = RecordingTracer()
+        self.server = server.Server(self.store, "http://server.unittest/endpt", tracer=tracer)
+        self.signatory = self.server.signatory
+        associate = server.AssociateRequest.fromMessage(Message.fromPostArgs({}))
+        requests = [self._signed_request(), associate, self._signed_request()]
+
+        responses = self.server.handleRequests(requests)
+
+        self.assertEqual([r.request for r in responses], requests)
+        self.assertEqual(responses[0].fields.getArgs(OPENID_NS), {'is_valid': 'true'})
+        self.assertTrue(responses[1].fields.hasKey(OPENID_NS, 'assoc_handle'))
+        self.assertEqual(responses[2].fields.getArgs(OPENID_NS), {'is_valid': 'true'})
+        self.assertIn(('stop', 'store', {'operation': 'removeAssociations'}), tracer.events)
+        self.assertIn(('stop', 'handle', {'mode': 'check_authentication', 'batch': True}), tracer.events)
+
+    def test_handleRequests_unknown_mode(self):
+        request = server.OpenIDRequest()
+        request.mode = 'monkeymode'
+        self.assertRaises(NotImplementedError, self.server.handleRequests, [request])
+
+
 class TestDiffieHellmanSHA1ServerSession(unittest.TestCase):
     """Unittests of `DiffieHellmanSHA1ServerSession` class."""
 
@@ -1672,6 +1807,222 @@ class TestServer(unittest.TestCase):
         self.assertTrue(response.fields.hasKey(OPENID_NS, "is_valid"))
 
 
+@unittest.skipIf(server.futures is None, "concurrent.futures is not available")
+class TestServerTracing(unittest.TestCase):
+    """Test tracing of request processing phases."""
+
+    def setUp(self):
+        self.tracer = RecordingTracer()
+        self.server = server.Server(memstore.MemoryStore(), "http://server.unittest/endpt", tracer=self.tracer)
+
+    def test_checkid(self):
+        request = self.server.decodeRequest({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'openid.identity': 'http://example.com/',
+            'openid.claimed_id': 'http://example.com/', 'openid.return_to': 'http://example.com/return'})
+        response = request.answer(True)
+        self.server.encodeResponse(response)
+
+        phases = [(event, phase) for event, phase, attributes in self.tracer.events]
+        self.assertEqual(phases, [
+            ('start', 'decode'), ('stop', 'decode'),
+            ('start', 'answer'), ('stop', 'answer'),
+            ('start', 'sign'),
+            ('start', 'store'), ('stop', 'store'),
+            ('stop', 'sign'),
+            ('start', 'encode'), ('stop', 'encode'),
+        ])
+        self.assertEqual(self.tracer.events[1][2], {'mode': 'checkid_setup'})
+        self.assertEqual(self.tracer.events[5][2], {'operation': 'storeAssociation'})
+        self.assertEqual(self.tracer.events[7][2], {'assoc_type': 'HMAC-SHA1'})
+        self.assertEqual(self.tracer.events[9][2], {'encoding': 'URL/redirect'})
+
+    def test_associate(self):
+        request = self.server.decodeRequest({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'associate', 'openid.assoc_type': 'HMAC-SHA256',
+            'openid.session_type': 'no-encryption'})
+        self.server.handleRequest(request)
+
+        self.assertIn(('stop', 'handle', {'mode': 'associate', 'assoc_type': 'HMAC-SHA256'}), self.tracer.events)
+
+    def test_disabled(self):
+        oserver = server.Server(memstore.MemoryStore(), "http://server.unittest/endpt")
+        request = oserver.decodeRequest({'openid.ns': OPENID2_NS, 'openid.mode': 'check_authentication',
+                                         'openid.assoc_handle': '{handle}', 'openid.sig': 'sig'})
+        oserver.handleRequest(request)
+        self.assertIsNone(request.tracer)
+        self.assertIsNone(oserver.signatory.tracer)
+        self.assertIsNone(oserver.encoder.tracer)
+
+
+class TestMultiTenantServer(unittest.TestCase):
+    """Test `MultiTenantServer` class."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.server = server.MultiTenantServer(self.store, association_cache=LRUCache(100))
+        self.server_a = self.server.addTenant('http://a.example.com/op')
+        self.server_b = self.server.addTenant('http://b.example.com/op')
+
+    def _associate(self, op_endpoint):
+        request = self.server.decodeRequest(op_endpoint, {
+            'openid.ns': OPENID2_NS, 'openid.mode': 'associate', 'openid.assoc_type': 'HMAC-SHA256',
+            'openid.session_type': 'no-encryption'})
+        response = self.server.handleRequest(op_endpoint, request)
+        return response.fields.getArg(OPENID_NS, 'assoc_handle')
+
+    def _checkid(self, op_endpoint, assoc_handle):
+        query = {'openid.ns': OPENID2_NS, 'openid.mode': 'checkid_setup', 'openid.identity': 'http://example.com/',
+                 'openid.claimed_id': 'http://example.com/', 'openid.return_to': 'http://example.com/return'}
+        if assoc_handle is not None:
+            query['openid.assoc_handle'] = assoc_handle
+        return self.server.decodeRequest(op_endpoint, query).answer(True)
+
+    def test_tenants(self):
+        self.assertIs(self.server.addTenant('http://a.example.com/op'), self.server_a)
+        self.assertIs(self.server.getServer('http://a.example.com/op'), self.server_a)
+        self.assertEqual(self.server_a.op_endpoint, 'http://a.example.com/op')
+        self.assertEqual(len(self.server), 2)
+        self.assertIn('http://b.example.com/op', self.server)
+        self.assertIs(self.server_a.negotiator, self.server_b.negotiator)
+        self.assertIs(self.server_a.signatory.cache, self.server_b.signatory.cache)
+
+        self.server.removeTenant('http://b.example.com/op')
+        self.assertNotIn('http://b.example.com/op', self.server)
+        self.assertRaises(KeyError, self.server.getServer, 'http://b.example.com/op')
+        self.assertRaises(KeyError, self.server.decodeRequest, 'http://b.example.com/op', {})
+        self.assertRaises(KeyError, self.server.getMetrics, 'http://b.example.com/op')
+        self.assertRaises(KeyError, self.server.removeTenant, 'http://b.example.com/op')
+
+    def test_associations_separated(self):
+        handle = self._associate('http://a.example.com/op')
+        self.assertIsNotNone(self.server_a.signatory.getAssociation(handle, dumb=False))
+        self.assertIsNone(self.server_b.signatory.getAssociation(handle, dumb=False))
+        self.assertIsNotNone(self.store.getAssociation('http://a.example.com/op|normal', handle))
+
+        # The association of the tenant A can't be used to sign responses of the tenant B
+        response = self._checkid('http://b.example.com/op', handle)
+        with LogCapture():
+            webresponse = self.server.encodeResponse('http://b.example.com/op', response)
+        query = dict(parse_qsl(urlparse(webresponse.headers['location']).query))
+        self.assertEqual(query['openid.invalidate_handle'], handle)
+        self.assertEqual(query['openid.op_endpoint'], 'http://b.example.com/op')
+
+        response = self._checkid('http://a.example.com/op', handle)
+        webresponse = self.server.encodeResponse('http://a.example.com/op', response)
+        query = dict(parse_qsl(urlparse(webresponse.headers['location']).query))
+        self.assertEqual(query['openid.assoc_handle'], handle)
+
+    def test_derived_key_signatory(self):
+        oserver = server.MultiTenantServer(None, signatoryClass=server.DerivedKeySignatory)
+        server_a = oserver.addTenant('http://a.example.com/op')
+        server_b = oserver.addTenant('http://b.example.com/op')
+        server_b.signatory.master_keys = server_a.signatory.master_keys
+        assoc = server_a.signatory.createAssociation(dumb=False)
+        self.assertNotEqual(server_b.signatory.getAssociation(assoc.handle, dumb=False).secret, assoc.secret)
+
+    def test_metrics(self):
+        self._associate('http://a.example.com/op')
+        self._associate('http://a.example.com/op')
+        self._checkid('http://b.example.com/op', None)
+        self.assertIsNone(self.server.decodeRequest('http://a.example.com/op', {}))
+        self.assertRaises(server.ProtocolError, self.server.decodeRequest, 'http://a.example.com/op',
+                          {'openid.ns': OPENID2_NS, 'openid.mode': 'monkeymode'})
+
+        self.assertEqual(self.server.getMetrics('http://a.example.com/op'), {'associate': 2, 'protocol_error': 1})
+        self.assertEqual(self.server.getMetrics('http://b.example.com/op'), {'checkid_setup': 1})
+
+    def test_encoding_error(self):
+        error = server.ProtocolError(Message.fromPostArgs({'openid.identity': 'http://limu.unittest/'}), "wet paint")
+        self.assertRaises(server.EncodingError, self.server.encodeResponse, 'http://a.example.com/op', error)
+        self.assertEqual(self.server.getMetrics('http://a.example.com/op'), {'encoding_error': 1})
+
+
+class TestServerAsync(unittest.TestCase):
+    """Test asynchronous request handling."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.executor = server.futures.ThreadPoolExecutor(1)
+        self.server = server.Server(self.store, "http://server.unittest/endpt", executor=self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _make_request(self, session_type, assoc_type):
+        consumer_dh = DiffieHellman.fromDefaults()
+        msg = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'associate',
+            'openid.session_type': session_type,
+            'openid.assoc_type': assoc_type,
+            'openid.dh_consumer_public': consumer_dh.public_key,
+        })
+        return consumer_dh, server.AssociateRequest.fromMessage(msg)
+
+    def _test_associate_dh(self):
+        consumer_dh, request = self._make_request('DH-SHA256', 'HMAC-SHA256')
+        response = self.server.handleRequestAsync(request).result(timeout=10)
+
+        rfg = partial(response.fields.getArg, OPENID_NS)
+        self.assertEqual(rfg("assoc_type"), "HMAC-SHA256")
+        self.assertEqual(rfg("session_type"), "DH-SHA256")
+        assoc = self.server.signatory.getAssociation(rfg("assoc_handle"), dumb=False)
+        secret = consumer_dh.xor_secret(rfg("dh_server_public"), rfg("enc_mac_key"), hashes.SHA256())
+        self.assertEqual(secret, oidutil.toBase64(assoc.secret))
+
+    def test_associate_dh(self):
+        self._test_associate_dh()
+
+    def test_associate_dh_process(self):
+        self.executor.shutdown()
+        self.executor = server.futures.ProcessPoolExecutor(1)
+        self.server.executor = self.executor
+        self._test_associate_dh()
+
+    def test_associate_dh_error(self):
+        consumer_dh, request = self._make_request('DH-SHA256', 'HMAC-SHA256')
+        with patch('openid.server.server._answerSession', side_effect=ValueError('Oops')):
+            future = self.server.handleRequestAsync(request)
+            self.assertRaises(ValueError, future.result, timeout=10)
+        # The association which was never sent is removed from the store
+        self.assertIsNone(self.store.getAssociation(self.server.signatory._normal_key))
+
+    def test_associate_dh_not_cancelled(self):
+        consumer_dh, request = self._make_request('DH-SHA256', 'HMAC-SHA256')
+        future = self.server.handleRequestAsync(request)
+        self.assertFalse(future.cancel())
+        self.assertTrue(future.result(timeout=10).fields.getArg(OPENID_NS, 'enc_mac_key'))
+
+    def test_associate_unsupported(self):
+        self.server.negotiator.setAllowedTypes([('HMAC-SHA1', 'DH-SHA1')])
+        consumer_dh, request = self._make_request('DH-SHA256', 'HMAC-SHA256')
+        response = self.server.handleRequestAsync(request).result(timeout=10)
+        self.assertEqual(response.fields.getArg(OPENID_NS, "error_code"), 'unsupported-type')
+
+    def test_associate_plaintext(self):
+        request = server.AssociateRequest.fromMessage(Message.fromPostArgs({}))
+        response = self.server.handleRequestAsync(request).result(timeout=10)
+        self.assertTrue(response.fields.getArg(OPENID_NS, "mac_key"))
+
+    def test_check_authentication(self):
+        request = server.CheckAuthRequest('{handle}', Message.fromPostArgs({}))
+        response = self.server.handleRequestAsync(request).result(timeout=10)
+        self.assertEqual(response.fields.getArg(OPENID_NS, "is_valid"), 'false')
+
+    def test_error(self):
+        def broken_handler(request):
+            raise ValueError('Oops')
+        self.server.openid_check_authentication = broken_handler
+        request = server.CheckAuthRequest('{handle}', Message.fromPostArgs({}))
+        future = self.server.handleRequestAsync(request)
+        self.assertRaises(ValueError, future.result, timeout=10)
+
+    def test_unknown_mode(self):
+        request = server.OpenIDRequest()
+        request.mode = 'monkeymode'
+        self.assertRaises(NotImplementedError, self.server.handleRequestAsync, request)
+
+
 class TestSignatory(unittest.TestCase):
     def setUp(self):
         self.store = memstore.MemoryStore()
@@ -1698,6 +2049,8 @@ class TestSignatory(unittest.TestCase):
         self.assertEqual(sresponse.fields.getArg(OPENID_NS, 'signed'), 'assoc_handle,azu,bar,foo,signed')
         self.assertTrue(sresponse.fields.getArg(OPENID_NS, 'sig'))
         self.assertEqual(logbook.records, [])
+        self.assertIs(sresponse.request, request)
+        self.assertFalse(response.fields.hasKey(OPENID_NS, 'sig'))
 
     def test_signDumb(self):
         request = server.OpenIDRequest()
@@ -1759,6 +2112,9 @@ class TestSignatory(unittest.TestCase):
         self.assertEqual(sresponse.fields.getArg(OPENID_NS, 'signed'),
                          'assoc_handle,azu,bar,foo,invalidate_handle,signed')
         self.assertTrue(sresponse.fields.getArg(OPENID_NS, 'sig'))
+        # The original response is not modified
+        self.assertFalse(response.fields.hasKey(OPENID_NS, 'invalidate_handle'))
+        self.assertFalse(response.fields.hasKey(OPENID_NS, 'sig'))
 
         # make sure the expired association is gone
         self.assertFalse(self.store.getAssociation(self._normal_key, assoc_handle),
@@ -1937,5 +2293,291 @@ class TestSignatory(unittest.TestCase):
         self.assertEqual(logbook.records, [])
 
 
+class TestSignatoryCache(unittest.TestCase):
+    """Test Signatory with an association cache."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.signatory = server.Signatory(self.store, cache=LRUCache(10))
+        self._dumb_key = self.signatory._dumb_key
+        self._normal_key = self.signatory._normal_key
+
+    def test_getAssociation(self):
+        assoc = association.Association.fromExpiresIn(60, '{handle}', b'sekrit', 'HMAC-SHA1')
+        self.store.storeAssociation(self._normal_key, assoc)
+        self.assertEqual(self.signatory.getAssociation('{handle}', dumb=False), assoc)
+        # Association is now loaded from the cache
+        self.store.removeAssociation(self._normal_key, '{handle}')
+        self.assertEqual(self.signatory.getAssociation('{handle}', dumb=False), assoc)
+        # But only for the same mode
+        self.assertIsNone(self.signatory.getAssociation('{handle}', dumb=True))
+
+    def test_createAssociation(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.assertEqual(self.signatory.cache.get((self._normal_key, assoc.handle)), assoc)
+
+    def test_getAssociation_expired(self):
+        assoc = association.Association.fromExpiresIn(-10, '{handle}', b'sekrit', 'HMAC-SHA1')
+        self.store.storeAssociation(self._normal_key, assoc)
+        with LogCapture():
+            self.assertIsNone(self.signatory.getAssociation('{handle}', dumb=False))
+        self.assertEqual(len(self.signatory.cache), 0)
+
+    def test_invalidate(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.signatory.invalidate(assoc.handle, dumb=False)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+        self.assertEqual(len(self.signatory.cache), 0)
+
+    def test_dumb_not_cached(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        self.assertEqual(len(self.signatory.cache), 0)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=True), assoc)
+        self.assertEqual(len(self.signatory.cache), 0)
+
+    def test_check_authentication_replay(self):
+        # Replayed check_authentication is rejected by a signatory of another process which shares the store
+        other = server.Signatory(self.store, cache=LRUCache(10))
+        response = server.OpenIDResponse(server.OpenIDRequest())
+        response.request.assoc_handle = None
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'ns': OPENID2_NS,
+                                                  'return_to': 'http://example.com/return'})
+        message = self.signatory.sign(response).fields.copy()
+        message.setArg(OPENID_NS, 'mode', 'check_authentication')
+        check_auth = server.CheckAuthRequest.fromMessage(message)
+        # Both signatories have seen the association
+        self.assertIsNotNone(other.getAssociation(check_auth.assoc_handle, dumb=True))
+
+        self.assertEqual(check_auth.answer(self.signatory).fields.getArg(OPENID_NS, 'is_valid'), 'true')
+        with LogCapture():
+            replayed = check_auth.answer(other)
+        self.assertEqual(replayed.fields.getArg(OPENID_NS, 'is_valid'), 'false')
+
+    def test_namespace(self):
+        other = server.Signatory(self.store, cache=self.signatory.cache, namespace='http://other.example.com/op')
+        self.assertEqual(other._normal_key, 'http://other.example.com/op|normal')
+        self.assertEqual(other._dumb_key, 'http://other.example.com/op|dumb')
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.assertIsNone(other.getAssociation(assoc.handle, dumb=False))
+
+    def test_sign_expired(self):
+        # Expired association is evicted from the cache during signing
+        assoc = association.Association('{handle}', b'sekrit', int(time.time()) - 20, 10, 'HMAC-SHA1')
+        self.store.storeAssociation(self._normal_key, assoc)
+        self.signatory.cache.set((self._normal_key, '{handle}'), assoc)
+        request = server.OpenIDRequest()
+        request.assoc_handle = '{handle}'
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'ns': OPENID2_NS})
+        with LogCapture():
+            sresponse = self.signatory.sign(response)
+        self.assertEqual(sresponse.fields.getArg(OPENID_NS, 'invalidate_handle'), '{handle}')
+        self.assertNotIn((self._normal_key, '{handle}'), self.signatory.cache)
+
+
+class TestSignatoryHandleKey(unittest.TestCase):
+    """Test Signatory with MACs of association handles."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.store_mock = Mock(wraps=self.store)
+        self.signatory = server.Signatory(self.store_mock, handle_key=b'k' * 16)
+
+    def test_init(self):
+        self.assertRaises(ValueError, server.Signatory, self.store, handle_key=b'short')
+
+    def test_createAssociation(self):
+        assoc = self.signatory.createAssociation(dumb=False, assoc_type='HMAC-SHA256')
+        match = server.Signatory._mac_handle_re.match(assoc.handle)
+        self.assertEqual(match.group('assoc_type'), 'HMAC-SHA256')
+        self.assertEqual(int(match.group('expires'), 16), assoc.issued + assoc.lifetime)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        self.assertEqual(self.store_mock.getAssociation.call_count, 1)
+
+    def test_getAssociation_forged(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        forged = assoc.handle.replace('{HMAC-SHA1}', '{HMAC-SHA256}')
+        with LogCapture() as logbook:
+            self.assertIsNone(self.signatory.getAssociation(forged, dumb=False))
+            self.assertIsNone(self.signatory.getAssociation(assoc.handle[:-3] + 'AA}', dumb=False))
+            self.assertIsNone(self.signatory.getAssociation('{HMAC-SHA1}{5e8f4c00}{uniq}{not base64!}', dumb=False))
+            self.assertIsNone(self.signatory.getAssociation('{HMAC-SHA1}{5e8f4c00}{uniq}', dumb=False))
+        logbook.check(
+            ('openid.server.server', 'INFO', StringComparison('rejected association handle .* with invalid MAC')),
+            ('openid.server.server', 'INFO', StringComparison('rejected association handle .* with invalid MAC')),
+            ('openid.server.server', 'INFO', StringComparison('rejected association handle .* with invalid MAC')),
+            ('openid.server.server', 'INFO', StringComparison('rejected association handle .* without MAC')))
+        self.assertEqual(self.store_mock.getAssociation.call_count, 0)
+
+    def test_getAssociation_other_key(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        # Handles are bound to the mode, the namespace and the handle key
+        other_namespace = server.Signatory(self.store, namespace='http://other.example.com/', handle_key=b'k' * 16)
+        other_key = server.Signatory(self.store, handle_key=b'x' * 16)
+        with LogCapture():
+            self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+            self.assertIsNone(other_namespace.getAssociation(assoc.handle, dumb=False))
+            self.assertIsNone(other_key.getAssociation(assoc.handle, dumb=False))
+        self.assertEqual(self.store_mock.getAssociation.call_count, 0)
+
+    def test_getAssociation_expired(self):
+        self.signatory.SECRET_LIFETIME = -10
+        assoc = self.signatory.createAssociation(dumb=False)
+        with LogCapture() as logbook:
+            self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+        logbook.check(('openid.server.server', 'INFO', StringComparison('rejected expired association handle .*')))
+        self.assertEqual(self.store_mock.getAssociation.call_count, 0)
+        # Expired association can be still loaded without expiration check
+        with LogCapture():
+            self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False, checkExpiration=False), assoc)
+
+    def test_invalidate(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        with LogCapture():
+            self.signatory.invalidate('{forged}', dumb=True)
+            self.signatory.invalidateAll(['{forged}', '{forged2}'], dumb=True)
+        self.assertEqual(self.store_mock.removeAssociation.call_count, 0)
+        self.assertEqual(self.store_mock.removeAssociations.call_count, 0)
+        self.signatory.invalidate(assoc.handle, dumb=True)
+        self.assertIsNone(self.store.getAssociation(self.signatory._dumb_key, assoc.handle))
+
+    def test_sign_verify(self):
+        request = server.OpenIDRequest()
+        request.assoc_handle = None
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'foo': 'amsigned', 'ns': OPENID2_NS})
+        sresponse = self.signatory.sign(response)
+        assoc_handle = sresponse.fields.getArg(OPENID_NS, 'assoc_handle')
+        self.assertTrue(self.signatory.verify(assoc_handle, sresponse.fields))
+
+
+class TestDerivedKeySignatory(unittest.TestCase):
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.signatory = server.DerivedKeySignatory(self.store, master_keys={'k1': b'x' * 32})
+
+    def test_init_errors(self):
+        self.assertRaises(ValueError, server.DerivedKeySignatory, master_keys={})
+        self.assertRaises(ValueError, server.DerivedKeySignatory, master_keys={'k{1}': b'x' * 32})
+        self.assertRaises(ValueError, server.DerivedKeySignatory, master_keys={'k1': b'x', 'k2': b'y'})
+        self.assertRaises(ValueError, server.DerivedKeySignatory, master_keys={'k1': b'x'}, current_key_id='k2')
+
+    def test_createAssociation(self):
+        assoc = self.signatory.createAssociation(dumb=False, assoc_type='HMAC-SHA256')
+        self.assertEqual(assoc.assoc_type, 'HMAC-SHA256')
+        self.assertEqual(len(assoc.secret), 32)
+        self.assertEqual(assoc.expiresIn, self.signatory.SECRET_LIFETIME)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        # Nothing is stored
+        self.assertEqual(self.store.server_assocs, {})
+
+    def test_getAssociation_other_instance(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        other = server.DerivedKeySignatory(master_keys={'k0': b'y' * 32, 'k1': b'x' * 32}, current_key_id='k0')
+        self.assertEqual(other.getAssociation(assoc.handle, dumb=True), assoc)
+
+    def test_getAssociation_namespace(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        other = server.DerivedKeySignatory(master_keys={'k1': b'x' * 32}, namespace='http://other.example.com/op')
+        self.assertNotEqual(other.getAssociation(assoc.handle, dumb=True).secret, assoc.secret)
+
+    def test_getAssociation_mode_mismatch(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+
+    def test_getAssociation_invalid(self):
+        self.assertIsNone(self.signatory.getAssociation('no-such-handle', dumb=False))
+        self.assertIsNone(self.signatory.getAssociation('{HMAC-SHA1}{k9}{ffffffff}{n}{abc}', dumb=False))
+        self.assertIsNone(self.signatory.getAssociation('{HMAC-MD5}{k1}{ffffffff}{n}{abc}', dumb=False))
+
+    def test_getAssociation_forged(self):
+        # Changing the handle changes the secret.
+        assoc = self.signatory.createAssociation(dumb=False)
+        forged_handle = assoc.handle.replace('{n}', '{d}')
+        forged = self.signatory.getAssociation(forged_handle, dumb=True)
+        self.assertNotEqual(forged.secret, assoc.secret)
+
+    def test_getAssociation_expired(self):
+        handle = '{HMAC-SHA1}{k1}{%x}{d}{abc}' % (int(time.time()) - 10)
+        with LogCapture() as logbook:
+            self.assertIsNone(self.signatory.getAssociation(handle, dumb=True))
+            assoc = self.signatory.getAssociation(handle, dumb=True, checkExpiration=False)
+        self.assertEqual(assoc.handle, handle)
+        self.assertEqual(assoc.expiresIn, 0)
+        logbook.check(('openid.server.server', 'INFO', StringComparison('requested .* key .* is expired .*')),
+                      ('openid.server.server', 'INFO', StringComparison('requested .* key .* is expired .*')))
+
+    def test_invalidate(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        self.signatory.invalidate(assoc.handle, dumb=False)
+        self.assertTrue(self.signatory.getAssociation(assoc.handle, dumb=True))
+        self.signatory.invalidate(assoc.handle, dumb=True)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+        self.assertIn(assoc.handle, self.signatory.revoked)
+        # Invalid handles are ignored
+        self.signatory.invalidate('no-such-handle', dumb=True)
+        self.assertEqual(len(self.signatory.revoked), 1)
+
+    def test_sign_verify(self):
+        request = server.OpenIDRequest()
+        request.assoc_handle = None
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'foo': 'amsigned', 'ns': OPENID2_NS})
+        sresponse = self.signatory.sign(response)
+        assoc_handle = sresponse.fields.getArg(OPENID_NS, 'assoc_handle')
+        self.assertTrue(self.signatory.verify(assoc_handle, sresponse.fields))
+        self.assertEqual(self.store.server_assocs, {})
+
+    def test_sign_expired(self):
+        request = server.OpenIDRequest()
+        request.assoc_handle = '{HMAC-SHA256}{k1}{%x}{n}{abc}' % (int(time.time()) - 10)
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'mode': 'id_res', 'foo': 'amsigned', 'ns': OPENID2_NS})
+        with LogCapture():
+            sresponse = self.signatory.sign(response)
+        self.assertEqual(sresponse.fields.getArg(OPENID_NS, 'invalidate_handle'), request.assoc_handle)
+        new_handle = sresponse.fields.getArg(OPENID_NS, 'assoc_handle')
+        self.assertTrue(new_handle.startswith('{HMAC-SHA256}{k1}'))
+        self.assertTrue(self.signatory.verify(new_handle, sresponse.fields))
+
+
+class TestRevocationSet(unittest.TestCase):
+    def test_cleanup(self):
+        now = int(time.time())
+        revoked = server.RevocationSet()
+        revoked.add('old', now + 10)
+        revoked.add('new', now + 1000)
+        revoked.add('expired', now - 10)
+        self.assertIn('old', revoked)
+        self.assertNotIn('expired', revoked)
+        self.assertEqual(revoked.cleanup(now=now + 100), 2)
+        self.assertNotIn('old', revoked)
+        self.assertIn('new', revoked)
+
+    def test_add_during_cleanup(self):
+        now = int(time.time())
+        revoked = server.RevocationSet()
+        threads = []
+
+        class Expiration(int):
+            def __le__(self, other):
+                # Other thread adds a handle while the expired handles are searched
+                thread = threading.Thread(target=revoked.add, args=('other', now + 1000))
+                thread.start()
+                thread.join(0.1)
+                threads.append(thread)
+                return int(self) <= other
+
+        revoked.add('first', now + 1000)
+        revoked.add('handle', Expiration(now + 1000))
+        self.assertEqual(revoked.cleanup(now=now), 0)
+        for thread in threads:
+            thread.join()
+        self.assertIn('other', revoked)
+        self.assertEqual(len(revoked), 3)
+
+
 if __name__ == '__main__':
     unittest.main()
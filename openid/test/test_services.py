@@ -21,3 +21,52 @@ class TestGetServiceEndpoints(unittest.TestCase):
 
     def test_catchXRDSError(self):
         self.assertRaises(DiscoveryFailure, services.getServiceEndpoints, "http://example.invalid/sometest")
+
+
+class TestGetServiceEndpointsExpiration(unittest.TestCase):
+    def setUp(self):
+        self.orig_discover = services.discover
+        services.discover = self.discover
+        self.headers = {}
+        self.response_text = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">'
+            '<XRD>{expires}<Service><Type>http://example.com/type</Type><URI>http://example.com/</URI></Service>'
+            '</XRD></xrds:XRDS>')
+        self.expires = ''
+
+    def tearDown(self):
+        services.discover = self.orig_discover
+
+    def discover(self, input_url):
+        result = DiscoveryResult(input_url)
+        result.normalized_uri = input_url
+        result.response_text = self.response_text.format(expires=self.expires).encode('utf-8')
+        result.headers = self.headers
+        return result
+
+    def test_no_expiration(self):
+        url, endpoints, expires = services.getServiceEndpointsExpiration('http://example.com/')
+        self.assertEqual(url, 'http://example.com/')
+        self.assertEqual(len(endpoints), 1)
+        self.assertIsNone(expires)
+
+    def test_xrd_expires(self):
+        self.expires = '<Expires>2010-01-01T00:00:00Z</Expires>'
+        url, endpoints, expires = services.getServiceEndpointsExpiration('http://example.com/')
+        self.assertEqual(expires, 1262304000)
+
+    def test_http_expires(self):
+        self.headers = {'expires': 'Fri, 01 Jan 2010 00:00:00 GMT'}
+        url, endpoints, expires = services.getServiceEndpointsExpiration('http://example.com/')
+        self.assertEqual(expires, 1262304000)
+
+    def test_minimum(self):
+        self.expires = '<Expires>2010-01-01T00:00:00Z</Expires>'
+        self.headers = {'expires': 'Fri, 01 Jan 2010 00:01:00 GMT'}
+        url, endpoints, expires = services.getServiceEndpointsExpiration('http://example.com/')
+        self.assertEqual(expires, 1262304000)
+
+    def test_catchXRDSError(self):
+        self.response_text = "This is not XRDS text."
+        self.assertRaises(DiscoveryFailure, services.getServiceEndpointsExpiration, "http://example.invalid/sometest")
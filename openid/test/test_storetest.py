@@ -139,6 +139,13 @@ def testStore(store):
     checkRemove(server_url, assoc.handle, True)
     checkRemove(server_url, assoc3.handle, False)
 
+    # Remove many associations at once
+    store.storeAssociation(server_url, assoc)
+    store.storeAssociation(server_url, assoc2)
+    removed = store.removeAssociations(server_url, [assoc.handle, assoc2.handle, assoc3.handle])
+    assert removed == 2, removed
+    checkRetrieve(server_url, None, None)
+
     checkRetrieve(server_url, None, None)
     checkRetrieve(server_url, assoc.handle, None)
     checkRetrieve(server_url, assoc2.handle, None)
@@ -220,6 +227,26 @@ def testStore(store):
     finally:
         nonceModule.SKEW = orig_skew
 
+    # Lease functions
+    token = store.acquireLease(server_url, 600)
+    assert token is not None
+    assert store.acquireLease(server_url, 600) is None
+    # Other keys are leased independently.
+    other_token = store.acquireLease(server_url + '1', 600)
+    assert other_token is not None
+    assert not store.releaseLease(server_url, other_token)
+    assert store.releaseLease(server_url, token)
+    assert not store.releaseLease(server_url, token)
+    assert store.releaseLease(server_url + '1', other_token)
+
+    # Expired lease can be acquired by anyone.
+    expired_token = store.acquireLease(server_url, 0)
+    assert expired_token is not None
+    token = store.acquireLease(server_url, 600)
+    assert token is not None and token != expired_token
+    assert not store.releaseLease(server_url, expired_token)
+    assert store.releaseLease(server_url, token)
+
 
 class TestFileOpenIDStore(unittest.TestCase):
     """Test `FileOpenIDStore` class."""
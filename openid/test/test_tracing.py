@@ -0,0 +1,85 @@
+"""Tests for `openid.tracing` module."""
+from __future__ import unicode_literals
+
+import unittest
+
+from openid.tracing import Histogram, HistogramTracer, Tracer, trace
+
+
+class RecordingTracer(Tracer):
+    """Tracer which records all events."""
+
+    def __init__(self):
+        self.events = []
+
+    def phaseStarted(self, phase, timestamp, attributes):
+        self.events.append(('start', phase, dict(attributes)))
+
+    def phaseFinished(self, phase, start, end, attributes):
+        assert end >= start
+        self.events.append(('stop', phase, dict(attributes)))
+
+
+class TestTrace(unittest.TestCase):
+    """Test `trace` function."""
+
+    def test_disabled(self):
+        with trace(None, 'phase', mode='test') as phase:
+            phase.set('key', 'value')
+
+    def test_events(self):
+        tracer = RecordingTracer()
+        with trace(tracer, 'phase', mode='test') as phase:
+            phase.set('key', 'value')
+        self.assertEqual(tracer.events, [('start', 'phase', {'mode': 'test'}),
+                                         ('stop', 'phase', {'mode': 'test', 'key': 'value'})])
+
+    def test_error(self):
+        tracer = RecordingTracer()
+        with self.assertRaises(ValueError):
+            with trace(tracer, 'phase'):
+                raise ValueError('Oops')
+        self.assertEqual(tracer.events, [('start', 'phase', {}), ('stop', 'phase', {'error': 'ValueError'})])
+
+
+class TestHistogram(unittest.TestCase):
+    """Test `Histogram` class."""
+
+    def test_empty(self):
+        histogram = Histogram((1, 2))
+        self.assertEqual(histogram.count, 0)
+        self.assertIsNone(histogram.mean)
+        self.assertIsNone(histogram.percentile(50))
+
+    def test_add(self):
+        histogram = Histogram((1, 2))
+        for duration in (0.5, 1, 1.5, 3):
+            histogram.add(duration)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 6)
+        self.assertEqual(histogram.mean, 1.5)
+        self.assertEqual(histogram.min, 0.5)
+        self.assertEqual(histogram.max, 3)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(75), 2)
+        self.assertEqual(histogram.percentile(100), 3)
+
+
+class TestHistogramTracer(unittest.TestCase):
+    """Test `HistogramTracer` class."""
+
+    def test_aggregate(self):
+        tracer = HistogramTracer(bounds=(1, 2))
+        tracer.phaseStarted('phase', 0, {'mode': 'a'})
+        tracer.phaseFinished('phase', 0, 0.5, {'mode': 'a'})
+        tracer.phaseFinished('phase', 1, 2.5, {'mode': 'a'})
+        tracer.phaseFinished('phase', 0, 5, {'mode': 'b'})
+
+        histograms = tracer.getHistograms()
+        self.assertEqual(sorted(histograms), [('phase', (('mode', 'a'), )), ('phase', (('mode', 'b'), ))])
+        self.assertEqual(histograms[('phase', (('mode', 'a'), ))].counts, [1, 1, 0])
+        self.assertEqual(histograms[('phase', (('mode', 'b'), ))].counts, [0, 0, 1])
+
+        tracer.reset()
+        self.assertEqual(tracer.getHistograms(), {})
@@ -5,7 +5,7 @@ import unittest
 
 import six
 
-from openid.server.trustroot import TrustRoot
+from openid.server.trustroot import RealmIndex, TrustRoot
 
 with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'trustroot.txt'), 'rb') as test_data_file:
     trustroot_test_data = test_data_file.read().decode('utf-8')
@@ -55,6 +55,67 @@ class MatchTest(unittest.TestCase):
                 assert not match
 
 
+class ParseCachedTest(unittest.TestCase):
+
+    def test(self):
+        tr = TrustRoot.parseCached('http://*.example.com/')
+        self.assertEqual(tr.host, '.example.com')
+        self.assertIs(TrustRoot.parseCached('http://*.example.com/'), tr)
+
+    def test_invalid(self):
+        self.assertIsNone(TrustRoot.parseCached('http://foo.*.com/'))
+        self.assertIsNone(TrustRoot.parseCached('http://foo.*.com/'))
+
+
+class RealmIndexTest(unittest.TestCase):
+
+    def test_match_data(self):
+        # Each realm matches the same URLs in the index as validateURL does.
+        ph, pdat, mh, mdat = parseTests(trustroot_test_data)
+
+        for expected_match, desc, line in getTests([1, 0], mh, mdat):
+            tr, rt = line.split()
+            index = RealmIndex([tr])
+            match = index.match(rt)
+            if expected_match:
+                self.assertIsNotNone(match, line)
+                self.assertEqual(match.unparsed, tr)
+            else:
+                self.assertIsNone(match, line)
+
+    def test_match_many(self):
+        index = RealmIndex(['http://site%d.example.com/' % i for i in range(1000)])
+        index.add('http://*.example.com/')
+        index.add('https://*.example.org/openid')
+        self.assertEqual(len(index), 1002)
+
+        self.assertEqual(index.match('http://site42.example.com/return').unparsed, 'http://site42.example.com/')
+        self.assertEqual(index.match('http://other.example.com/').unparsed, 'http://*.example.com/')
+        self.assertEqual(index.match('http://example.com/').unparsed, 'http://*.example.com/')
+        self.assertEqual(index.match('https://a.b.example.org/openid?x=1').unparsed, 'https://*.example.org/openid')
+        self.assertIsNone(index.match('https://a.b.example.org/other'))
+        self.assertIsNone(index.match('https://site42.example.com/'))
+        self.assertIsNone(index.match('http://example.net/'))
+        self.assertIsNone(index.match('not a url'))
+
+    def test_precedence(self):
+        index = RealmIndex(['http://*/', 'http://*.example.com/', 'http://*.www.example.com/',
+                            'http://www.example.com/', 'http://www.example.com/path/'])
+        self.assertEqual(index.match('http://www.example.com/path/').unparsed, 'http://www.example.com/')
+        self.assertEqual(index.match('http://www.example.com/').unparsed, 'http://www.example.com/')
+        self.assertEqual(index.match('http://a.www.example.com/').unparsed, 'http://*.www.example.com/')
+        self.assertEqual(index.match('http://a.example.com/').unparsed, 'http://*.example.com/')
+        self.assertEqual(index.match('http://example.org/').unparsed, 'http://*/')
+
+    def test_add(self):
+        index = RealmIndex()
+        realm = index.add('http://example.com/')
+        self.assertEqual(realm.host, 'example.com')
+        self.assertIs(index.add(realm), realm)
+        self.assertRaises(ValueError, index.add, 'http://foo.*.com/')
+        self.assertEqual(len(index), 2)
+
+
 def getTests(grps, head, dat):
     tests = []
     top = head.strip()
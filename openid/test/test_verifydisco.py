@@ -245,6 +245,44 @@ class DiscoveryVerificationTest(TestIdRes):
 # XXX: test the implementation of _discoverAndVerify
 
 
+class TestDiscoverAndVerifyCache(TestIdRes):
+    claimed_id = 'http://example.com/identity'
+
+    def setUp(self):
+        super(TestDiscoverAndVerifyCache, self).setUp()
+        self.to_match = discover.OpenIDServiceEndpoint()
+        self.to_match.claimed_id = self.claimed_id
+        self.to_match.server_url = 'http://example.com/new-endpoint'
+        self.to_match.type_uris = [discover.OPENID_2_0_TYPE]
+        stale = discover.OpenIDServiceEndpoint()
+        stale.claimed_id = self.claimed_id
+        stale.server_url = 'http://example.com/old-endpoint'
+        stale.type_uris = [discover.OPENID_2_0_TYPE]
+        self.cache = discover.DiscoveryCache()
+        self.cache.set(self.claimed_id, (self.claimed_id, [stale]))
+        discover.setDefaultDiscoveryCache(self.cache)
+        self.discovered = [(self.claimed_id, [stale]), (self.claimed_id, [self.to_match])]
+        self.consumer._discover = lambda identifier: self.discovered.pop(0)
+
+    def tearDown(self):
+        discover.setDefaultDiscoveryCache(None)
+        super(TestDiscoverAndVerifyCache, self).tearDown()
+
+    def test_stale(self):
+        with LogCapture():
+            endpoint = self.consumer._discoverAndVerify(self.claimed_id, [self.to_match])
+        self.assertEqual(endpoint, self.to_match)
+        self.assertEqual(self.discovered, [])
+        self.assertNotIn(self.claimed_id, self.cache.cache)
+
+    def test_not_cached(self):
+        self.cache.invalidate(self.claimed_id)
+        with LogCapture():
+            self.assertRaises(discover.DiscoveryFailure, self.consumer._discoverAndVerify, self.claimed_id,
+                              [self.to_match])
+        self.assertEqual(len(self.discovered), 1)
+
+
 class TestVerifyDiscoverySingle(TestIdRes):
     # XXX: more test the implementation of _verifyDiscoverySingle
     def test_endpointWithoutLocalID(self):
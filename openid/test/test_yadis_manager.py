@@ -0,0 +1,93 @@
+"""Tests for `openid.yadis.manager` module."""
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from testfixtures import LogCapture
+
+from openid.consumer.discover import OPENID_2_0_TYPE, OpenIDServiceEndpoint
+from openid.yadis.manager import Discovery, YadisServiceManager
+
+
+def make_endpoint(server_url):
+    endpoint = OpenIDServiceEndpoint()
+    endpoint.server_url = server_url
+    endpoint.claimed_id = 'http://user.example.com/'
+    endpoint.type_uris = [OPENID_2_0_TYPE]
+    return endpoint
+
+
+class TestYadisServiceManager(unittest.TestCase):
+    """Test `YadisServiceManager` class."""
+
+    def setUp(self):
+        self.services = [make_endpoint('http://op1.example.com/'), make_endpoint('http://op2.example.com/')]
+        self.manager = YadisServiceManager('user.example.com', 'http://user.example.com/', self.services, 'key',
+                                           OpenIDServiceEndpoint)
+
+    def test_store(self):
+        session = {}
+        self.manager.next()
+        self.manager.store(session)
+        # The session data is JSON serializable
+        data = json.loads(json.dumps(session['key']))
+
+        manager = YadisServiceManager.fromSessionData(data, 'key', OpenIDServiceEndpoint)
+        self.assertEqual(manager.starting_url, 'user.example.com')
+        self.assertEqual(manager.yadis_url, 'http://user.example.com/')
+        self.assertEqual(manager.session_key, 'key')
+        self.assertEqual(manager.current().server_url, 'http://op1.example.com/')
+        self.assertEqual([s.server_url for s in manager.services], ['http://op2.example.com/'])
+        self.assertEqual(manager.next().server_url, 'http://op2.example.com/')
+
+    def test_store_object(self):
+        session = {}
+        self.manager.service_class = None
+        self.manager.store(session)
+        self.assertIs(session['key'], self.manager)
+
+    def test_invalid(self):
+        for data in (None, [], [2, 'user.example.com', 'http://user.example.com/', [], None]):
+            with self.assertRaises(ValueError):
+                YadisServiceManager.fromSessionData(data, 'key', OpenIDServiceEndpoint)
+
+
+class TestDiscovery(unittest.TestCase):
+    """Test `Discovery` class."""
+
+    def setUp(self):
+        self.session = {}
+        self.discovery = Discovery(self.session, 'http://user.example.com/', service_class=OpenIDServiceEndpoint)
+
+    def discover(self, url):
+        return 'http://user.example.com/', [make_endpoint('http://op1.example.com/'),
+                                            make_endpoint('http://op2.example.com/')]
+
+    def test_getNextService(self):
+        self.assertEqual(self.discovery.getNextService(self.discover).server_url, 'http://op1.example.com/')
+        self.assertIsInstance(self.session[self.discovery.getSessionKey()], list)
+        # The second service is taken from the session
+        self.assertEqual(self.discovery.getNextService(None).server_url, 'http://op2.example.com/')
+        self.assertEqual(self.discovery.cleanup().server_url, 'http://op2.example.com/')
+        self.assertEqual(self.session, {})
+
+    def test_legacy_manager(self):
+        manager = YadisServiceManager('http://user.example.com/', 'http://user.example.com/',
+                                      [make_endpoint('http://op1.example.com/')], self.discovery.getSessionKey())
+        self.session[self.discovery.getSessionKey()] = manager
+        self.assertIs(self.discovery.getManager(), manager)
+
+    def test_invalid_data(self):
+        self.session[self.discovery.getSessionKey()] = [42]
+        with LogCapture() as logbook:
+            self.assertIsNone(self.discovery.getManager())
+        logbook.check(('openid.yadis.manager', 'WARNING',
+                       'Discarding service manager from the session: Unsupported session data of service manager: '
+                       '[42]'))
+        self.assertEqual(self.discovery.getNextService(self.discover).server_url, 'http://op1.example.com/')
+
+    def test_without_service_class(self):
+        self.discovery.getNextService(self.discover)
+        discovery = Discovery(self.session, 'http://user.example.com/')
+        self.assertIsNone(discovery.getManager())
@@ -0,0 +1,249 @@
+"""Timing of the phases of OpenID request processing.
+
+Tracing is disabled by default. To enable it, pass a tracer to the
+L{Server<openid.server.server.Server>}::
+
+    tracer = HistogramTracer()
+    oserver = Server(store, "http://example.com/op", tracer=tracer)
+    ...
+    for (phase, attributes), histogram in tracer.getHistograms().items():
+        print(phase, attributes, histogram.count, histogram.mean)
+
+The tracer gets events for these phases:
+
+ - C{decode} - L{Decoder.decode<openid.server.server.Decoder.decode>}, with C{mode} attribute,
+ - C{handle} - L{Server.handleRequest<openid.server.server.Server.handleRequest>}, with C{mode} and C{assoc_type}
+   attributes, and batches of C{check_authentication} requests in
+   L{Server.handleRequests<openid.server.server.Server.handleRequests>}, with C{mode} and C{batch} attributes,
+ - C{answer} - L{CheckIDRequest.answer<openid.server.server.CheckIDRequest.answer>}, with C{mode} attribute,
+ - C{sign} - L{Signatory.sign<openid.server.server.Signatory.sign>}, with C{assoc_type} attribute,
+ - C{store} - calls to the store made by the signatory, with C{operation} attribute,
+ - C{encode} - L{Encoder.encode<openid.server.server.Encoder.encode>}, with C{encoding} attribute.
+
+If the phase raises an exception, its class name is in the C{error} attribute.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import threading
+import time
+
+__all__ = ['Histogram', 'HistogramTracer', 'Tracer', 'trace']
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    # Python 2
+    _monotonic = time.time
+
+
+class Tracer(object):
+    """Interface of tracers, this implementation ignores all events."""
+
+    def phaseStarted(self, phase, timestamp, attributes):
+        """Called when the phase starts.
+
+        @param phase: The name of the phase.
+        @type phase: six.text_type
+
+        @param timestamp: Monotonic timestamp of the start of the phase.
+        @type timestamp: float
+
+        @param attributes: The attributes of the phase known at its start.
+        @type attributes: Dict[six.text_type, Any]
+        """
+
+    def phaseFinished(self, phase, start, end, attributes):
+        """Called when the phase finishes.
+
+        @param phase: The name of the phase.
+        @type phase: six.text_type
+
+        @param start: Monotonic timestamp of the start of the phase.
+        @type start: float
+
+        @param end: Monotonic timestamp of the end of the phase.
+        @type end: float
+
+        @param attributes: The attributes of the phase.
+        @type attributes: Dict[six.text_type, Any]
+        """
+
+
+class _Phase(object):
+    """Context manager which reports the phase to the tracer."""
+
+    __slots__ = ('tracer', 'name', 'attributes', 'start')
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+
+    def set(self, name, value):
+        """Set the attribute of the phase."""
+        self.attributes[name] = value
+
+    def __enter__(self):
+        self.start = _monotonic()
+        self.tracer.phaseStarted(self.name, self.start, self.attributes)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _monotonic()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer.phaseFinished(self.name, self.start, end, self.attributes)
+
+
+class _NullPhase(object):
+    """Context manager used when tracing is disabled."""
+
+    __slots__ = ()
+
+    def set(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def trace(tracer, phase, **attributes):
+    """Return a context manager which reports the phase to the tracer.
+
+    Example::
+
+        with trace(self.tracer, 'sign') as phase:
+            phase.set('assoc_type', assoc.assoc_type)
+
+    @param tracer: The tracer or C{None} if tracing is disabled.
+    @type tracer: Optional[L{Tracer}]
+
+    @param phase: The name of the phase.
+    @type phase: six.text_type
+    """
+    if tracer is None:
+        return _NULL_PHASE
+    return _Phase(tracer, phase, attributes)
+
+
+class Histogram(object):
+    """Histogram of phase durations.
+
+    @ivar bounds: Upper bounds of the buckets in seconds.
+    @type bounds: Tuple[float, ...]
+
+    @ivar counts: Number of durations in each bucket, the last bucket is for durations over the last bound.
+    @type counts: List[int]
+
+    @ivar count: Number of durations.
+    @type count: int
+
+    @ivar total: Sum of durations.
+    @type total: float
+
+    @ivar min: Minimal duration.
+    @type min: Optional[float]
+
+    @ivar max: Maximal duration.
+    @type max: Optional[float]
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        """Add a duration to the histogram."""
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self):
+        """Return the mean duration or C{None} if there are no durations."""
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket which contains the percentile.
+
+        @param percent: The percentile, between 0 and 100.
+        @type percent: float
+
+        @return: The upper bound in seconds, maximal duration for the last bucket or C{None} if there are no
+            durations.
+        @rtype: Optional[float]
+        """
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return self.max
+
+
+class HistogramTracer(Tracer):
+    """Tracer which aggregates the durations of the phases in histograms.
+
+    Histograms are kept for each combination of the phase and its attributes.
+    The tracer is thread safe.
+
+    @cvar default_bounds: Default upper bounds of the histogram buckets in seconds.
+    @type default_bounds: Tuple[float, ...]
+    """
+
+    default_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, bounds=None):
+        """Create a new tracer.
+
+        @param bounds: Upper bounds of the histogram buckets in seconds.
+        @type bounds: Optional[Sequence[float]]
+        """
+        if bounds is None:
+            bounds = self.default_bounds
+        self.bounds = tuple(sorted(bounds))
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def phaseFinished(self, phase, start, end, attributes):
+        key = (phase, tuple(sorted(attributes.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.bounds)
+            histogram.add(end - start)
+
+    def getHistograms(self):
+        """Return the histograms.
+
+        @return: Histograms by the phase name and its sorted attributes.
+        @rtype: Dict[Tuple[six.text_type, Tuple[Tuple[six.text_type, Any], ...]], Histogram]
+        """
+        with self._lock:
+            return dict(self._histograms)
+
+    def reset(self):
+        """Remove all histograms."""
+        with self._lock:
+            self._histograms.clear()
@@ -37,6 +37,9 @@ class DiscoveryResult(object):
     # The document returned from the xrds_uri
     response_text = None
 
+    # The HTTP headers returned with the response_text
+    headers = None
+
     def __init__(self, request_uri):
         """Initialize the state of the object
 
@@ -67,10 +70,39 @@ def discover(uri):
 
     @raises Exception: Any exception that can be raised by fetching a URL with
         the given fetcher.
+    @raises DiscoveryFailure: When the HTTP response does not have a 200 code.
+    """
+    steps = iterDiscoverySteps(uri)
+    step = next(steps)
+    while not isinstance(step, DiscoveryResult):
+        url, headers = step
+        step = steps.send(fetchers.fetch(url, headers=headers))
+    return step
+
+
+def iterDiscoverySteps(uri):
+    """Perform discovery for a given URI without making any requests.
+
+    The generator yields tuples C{(url, headers)} of requests to be
+    made and expects the L{HTTPResponse<openid.fetchers.HTTPResponse>}
+    to be sent back. The last value yielded is the L{DiscoveryResult}.
+    This way the discovery may be driven by any fetcher, including
+    asynchronous ones.
+
+    Example::
+
+        steps = iterDiscoverySteps(uri)
+        step = next(steps)
+        while not isinstance(step, DiscoveryResult):
+            url, headers = step
+            step = steps.send(fetch(url, headers=headers))
+
+    @param uri: The identity URI, see L{discover}.
+
     @raises DiscoveryFailure: When the HTTP response does not have a 200 code.
     """
     result = DiscoveryResult(uri)
-    resp = fetchers.fetch(uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    resp = yield (uri, {'Accept': YADIS_ACCEPT_HEADER})
     if resp.status not in (200, 206):
         raise DiscoveryFailure(
             'HTTP Response status from identity URL host is not 200. '
@@ -86,7 +118,7 @@ def discover(uri):
     result.xrds_uri = whereIsYadis(resp)
 
     if result.xrds_uri and result.usedYadisLocation():
-        resp = fetchers.fetch(result.xrds_uri)
+        resp = yield (result.xrds_uri, None)
         if resp.status not in (200, 206):
             exc = DiscoveryFailure(
                 'HTTP Response status from Yadis host is not 200. '
@@ -96,7 +128,8 @@ def discover(uri):
         result.content_type = resp.headers.get('content-type')
 
     result.response_text = resp.body
-    return result
+    result.headers = resp.headers
+    yield result
 
 
 def whereIsYadis(resp):
@@ -1,11 +1,25 @@
 from __future__ import unicode_literals
 
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
 
 class YadisServiceManager(object):
     """Holds the state of a list of selected Yadis services, managing
-    storing it in a session and iterating over the services in order."""
+    storing it in a session and iterating over the services in order.
+
+    @ivar service_class: The class of the services, which provides
+        compact session data, see L{toSessionData}. If C{None}, the
+        manager itself is stored in the session.
+    """
+
+    # Version of the compact session data format
+    session_data_version = 1
+
+    service_class = None
 
-    def __init__(self, starting_url, yadis_url, services, session_key):
+    def __init__(self, starting_url, yadis_url, services, session_key, service_class=None):
         # The URL that was used to initiate the Yadis protocol
         self.starting_url = starting_url
 
@@ -20,6 +34,8 @@ class YadisServiceManager(object):
         # Reference to the current service object
         self._current = None
 
+        self.service_class = service_class
+
     def __len__(self):
         """How many untried services remain?"""
         return len(self.services)
@@ -55,7 +71,39 @@ class YadisServiceManager(object):
 
     def store(self, session):
         """Store this object in the session, by its session key."""
-        session[self.session_key] = self
+        if self.service_class is None:
+            session[self.session_key] = self
+        else:
+            session[self.session_key] = self.toSessionData()
+
+    def toSessionData(self):
+        """Return the compact representation of this manager for a session.
+
+        The services are represented by their C{toSessionData} method.
+
+        @rtype: list
+        """
+        current = None if self._current is None else self._current.toSessionData()
+        return [self.session_data_version, self.starting_url, self.yadis_url,
+                [service.toSessionData() for service in self.services], current]
+
+    @classmethod
+    def fromSessionData(cls, data, session_key, service_class):
+        """Create a manager from its compact representation.
+
+        @param service_class: The class of the services, which creates them by C{fromSessionData} class method.
+
+        @see: L{toSessionData}
+        @raises ValueError: If the data are not in a supported format.
+        """
+        if not isinstance(data, (list, tuple)) or len(data) != 5 or data[0] != cls.session_data_version:
+            raise ValueError('Unsupported session data of service manager: %r' % (data,))
+        _, starting_url, yadis_url, services, current = data
+        manager = cls(starting_url, yadis_url, [service_class.fromSessionData(s) for s in services], session_key,
+                      service_class)
+        if current is not None:
+            manager._current = service_class.fromSessionData(current)
+        return manager
 
 
 class Discovery(object):
@@ -74,15 +122,20 @@ class Discovery(object):
 
     @ivar session_key_suffix: The suffix that will be used to identify
         this object in the session object.
+
+    @ivar service_class: The class of the services, which provides
+        compact session data. If C{None}, the service manager object
+        is stored in the session.
     """
 
     DEFAULT_SUFFIX = 'auth'
     PREFIX = '_yadis_services_'
 
-    def __init__(self, session, url, session_key_suffix=None):
+    def __init__(self, session, url, session_key_suffix=None, service_class=None):
         """Initialize a discovery object"""
         self.session = session
         self.url = url
+        self.service_class = service_class
         if session_key_suffix is None:
             session_key_suffix = self.DEFAULT_SUFFIX
 
@@ -158,11 +211,23 @@ class Discovery(object):
             URL, or else None
         """
         manager = self.session.get(self.getSessionKey())
+        if isinstance(manager, (list, tuple)):
+            manager = self._loadManager(manager)
         if (manager is not None and (manager.forURL(self.url) or force)):
             return manager
         else:
             return None
 
+    def _loadManager(self, data):
+        """Return the service manager from its compact representation or C{None} if it can't be loaded."""
+        if self.service_class is None:
+            return None
+        try:
+            return YadisServiceManager.fromSessionData(data, self.getSessionKey(), self.service_class)
+        except ValueError as error:
+            _LOGGER.warning('Discarding service manager from the session: %s', error)
+            return None
+
     def createManager(self, services, yadis_url=None):
         """Create a new YadisService Manager for this starting URL and
         suffix, and store it in the session.
@@ -179,7 +244,7 @@ class Discovery(object):
         if not services:
             return None
 
-        manager = YadisServiceManager(self.url, yadis_url, services, key)
+        manager = YadisServiceManager(self.url, yadis_url, services, key, self.service_class)
         manager.store(self.session)
         return manager
 
@@ -1,9 +1,12 @@
 from __future__ import unicode_literals
 
+import calendar
+
 import six
 
+from openid.cache import getHTTPExpiration
 from openid.yadis.discover import DiscoveryFailure, discover
-from openid.yadis.etxrd import XRDSError, iterServices, parseXRDS
+from openid.yadis.etxrd import XRDSError, getXRDExpiration, getYadisXRD, iterServices, parseXRDS
 from openid.yadis.filters import mkFilter
 
 
@@ -34,6 +37,84 @@ def getServiceEndpoints(input_url, flt=None):
     return (result.normalized_uri, endpoints)
 
 
+def getServiceEndpointsExpiration(input_url, flt=None):
+    """Perform the Yadis protocol on the input URL and return an
+    iterable of resulting endpoint objects and the time they expire.
+
+    The expiration is the earliest of the XRD C{Expires} element and the
+    expiration defined by HTTP cache headers.
+
+    @param flt: A filter object or something that is convertable to
+        a filter object (using mkFilter) that will be used to generate
+        endpoint objects. This defaults to generating BasicEndpoint
+        objects.
+
+    @param input_url: The URL on which to perform the Yadis protocol
+
+    @return: The normalized identity URL, an iterable of endpoint
+        objects generated by the filter function and the expiration
+        timestamp or C{None} if no expiration is defined.
+
+    @rtype: (six.text_type, [endpoint], Optional[float])
+
+    @raises DiscoveryFailure: when Yadis fails to obtain an XRDS document.
+    """
+    return getEndpointsExpiration(discover(input_url), flt)
+
+
+def getEndpointsExpiration(result, flt=None):
+    """Return the endpoint objects and the time they expire from the result of the Yadis protocol.
+
+    @param result: The result of the Yadis discovery.
+    @type result: L{openid.yadis.discover.DiscoveryResult}
+
+    @return: See L{getServiceEndpointsExpiration}.
+    @rtype: (six.text_type, [endpoint], Optional[float])
+
+    @raises DiscoveryFailure: when the result doesn't contain an XRDS document.
+    """
+    try:
+        endpoints, expires = getXRDSEndpointsExpiration(result.normalized_uri, result.response_text,
+                                                        result.headers, flt)
+    except XRDSError as err:
+        raise DiscoveryFailure(six.text_type(err), None)
+    return (result.normalized_uri, endpoints, expires)
+
+
+def getXRDSEndpointsExpiration(normalized_uri, xrd_data, headers=None, flt=None):
+    """Return the endpoint objects and the time they expire from the XRDS document.
+
+    @param normalized_uri: The input URL, after following redirects,
+        as in the Yadis protocol.
+
+    @param xrd_data: The XML text the XRDS file fetched from the
+        normalized URI.
+    @type xrd_data: six.binary_type
+
+    @param headers: HTTP headers of the XRDS document with lower case names.
+    @type headers: Optional[Dict[six.text_type, six.text_type]]
+
+    @return: The endpoint objects and the expiration timestamp or C{None} if no expiration is defined.
+    @rtype: ([endpoint], Optional[float])
+
+    @raises XRDSError: When the XRDS does not parse.
+    """
+    et = parseXRDS(xrd_data)
+    endpoints = _applyFilter(normalized_uri, et, flt)
+    try:
+        xrd_expires = getXRDExpiration(getYadisXRD(et))
+    except ValueError:
+        # Malformed xrd:Expires element is treated as already expired.
+        xrd_expires = 0
+    else:
+        if xrd_expires is not None:
+            xrd_expires = calendar.timegm(xrd_expires.timetuple())
+
+    expirations = [e for e in (xrd_expires, getHTTPExpiration(headers)) if e is not None]
+    expires = min(expirations) if expirations else None
+    return (endpoints, expires)
+
+
 def applyFilter(normalized_uri, xrd_data, flt=None):
     """Generate an iterable of endpoint objects given this input data,
     presumably from the result of performing the Yadis protocol.
@@ -45,8 +126,12 @@ def applyFilter(normalized_uri, xrd_data, flt=None):
         normalized URI.
     @type xrd_data: six.binary_type
     """
+    return _applyFilter(normalized_uri, parseXRDS(xrd_data), flt)
+
+
+def _applyFilter(normalized_uri, et, flt=None):
+    """Generate an iterable of endpoint objects from the parsed XRDS document."""
     flt = mkFilter(flt)
-    et = parseXRDS(xrd_data)
 
     endpoints = []
     for service_element in iterServices(et):
@@ -85,13 +85,10 @@ class ProxyResolver(object):
         for service_type in service_types:
             url = self.queryURL(xri, service_type)
             response = fetchers.fetch(url)
-            if response.status not in (200, 206):
-                # XXX: sucks to fail silently.
-                # print("response not OK:", response)
+            result = self.parseResponse(xri, response)
+            if result is None:
                 continue
-            et = etxrd.parseXRDS(response.body)
-            canonicalID = etxrd.getCanonicalID(xri, et)
-            some_services = list(iterServices(et))
+            canonicalID, some_services = result
             services.extend(some_services)
         # TODO:
         #  * If we do get hits for multiple service_types, we're almost
@@ -99,6 +96,26 @@ class ProxyResolver(object):
         #    broken priority ordering.
         return canonicalID, services
 
+    def parseResponse(self, xri, response):
+        """Parse the response of the proxy resolver.
+
+        @param xri: The resolved XRI.
+        @type xri: six.text_type
+
+        @param response: The response to the query URL.
+        @type response: L{openid.fetchers.HTTPResponse}
+
+        @returns: tuple of (CanonicalID, Service elements) or C{None} if the response is not successful
+        @returntype: Optional[(six.text_type, list of C{ElementTree.Element}s)]
+
+        @raises etxrd.XRDSError: If the response doesn't parse.
+        """
+        if response.status not in (200, 206):
+            # XXX: sucks to fail silently.
+            return None
+        et = etxrd.parseXRDS(response.body)
+        return etxrd.getCanonicalID(xri, et), list(iterServices(et))
+
 
 def _appendArgs(url, args):
     """Append some arguments to an HTTP query.
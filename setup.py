@@ -22,6 +22,8 @@ EXTRAS_REQUIRE = {
     'httplib2': ('httplib2', ),
     'pycurl': ('pycurl', ),
     'requests': ('requests', ),
+    # Optional dependency for asynchronous request handling
+    'futures': ('futures;python_version<"3"', ),
     # Dependencies for Django example
     'djopenid': ('django<1.11.99', ),
 }